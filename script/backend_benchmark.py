@@ -0,0 +1,82 @@
+import argparse
+import glob
+import os
+import time
+
+import cv2
+import numpy as np
+
+import util
+import image_processor
+
+# 推論バックエンド(ultralytics/onnx/tflite)ごとのdetect/poseの処理時間を同じ画像で比較する
+# 1つ目のバックエンドを基準として，bboxのIoUとキーポイントのずれも表示する
+# poseは全てのバックエンドで基準のバックエンドが検出したbboxを使う
+# 実行例: PYTHONPATH=/usr/local/bin/pinode3 python script/backend_benchmark.py /home/pinode3/data/image/image4/20250410 --backends ultralytics onnx tflite
+
+def match_iou(bboxes, reference):
+    """
+    基準のbboxごとに最もIoUの高いbboxとのIoUを返す(対応するbboxが無ければ0)
+    """
+    if len(reference) == 0:
+        return np.array([])
+    if len(bboxes) == 0:
+        return np.zeros(len(reference))
+    return image_processor.calc_iou_matrix(reference, bboxes).max(axis=1)
+
+def summary(name, times):
+    times = np.array(times) * 1000
+    return f"{name:>8}: mean {times.mean():8.2f} ms  p95 {np.percentile(times, 95):8.2f} ms  max {times.max():8.2f} ms"
+
+parser = argparse.ArgumentParser()
+parser.add_argument("images", nargs="+", help="画像ファイル，または画像のフォルダ")
+parser.add_argument("--backends", nargs="+", default=["ultralytics", "onnx"], choices=image_processor.inference_backend.BACKENDS)
+parser.add_argument("--limit", type=int, default=30, help="使用する画像の枚数")
+parser.add_argument("--leaf-num", type=int, default=15, help="POSE推定する葉の数")
+parser.add_argument("--threads", type=int, default=0, help="onnx/tfliteの推論スレッド数．0なら既定値")
+args = parser.parse_args()
+
+setting = util.get_pinode_config()
+server_flag = setting["wilt"]["server_flag"]
+paths = []
+for path in args.images:
+    paths += sorted(glob.glob(os.path.join(path, "*.jpg"))) if os.path.isdir(path) else [path]
+images = [cv2.resize(cv2.imread(path), (1024, 1024)) for path in paths[:args.limit]]
+print(f"images: {len(images)}")
+
+reference = None
+reference_name = None
+for backend in args.backends:
+    try:
+        detect, pose = image_processor.load_models(server_flag, backend, threads=args.threads)
+    except Exception as e:
+        print(f"== {backend}: skipped ({e}) ==")
+        continue
+    # 初回はモデルの準備を含むため計測から除外
+    detect.detect(images[0], 1024, conf=0.3)
+
+    times = {"detect": [], "pose": []}
+    results = []
+    for k, image in enumerate(images):
+        start_time = time.perf_counter()
+        bbox_list = detect.detect(image, 1024, conf=0.3)
+        times["detect"].append(time.perf_counter() - start_time)
+
+        pose_bboxes = (bbox_list if reference is None else reference[k][0])[:args.leaf_num].tolist()
+        start_time = time.perf_counter()
+        keypoints = image_processor.estimate_pose_batch(pose, image, pose_bboxes)
+        times["pose"].append(time.perf_counter() - start_time)
+        results.append((bbox_list, keypoints))
+
+    print(f"== {backend} ==")
+    for name, elapsed in times.items():
+        print(summary(name, elapsed))
+    if reference is None:
+        reference = results
+        reference_name = backend
+        continue
+    ious = np.concatenate([match_iou(bboxes, ref_bboxes) for (bboxes, _), (ref_bboxes, _) in zip(results, reference)])
+    diffs = np.concatenate([np.abs(keypoints - ref_keypoints).ravel() for (_, keypoints), (_, ref_keypoints) in zip(results, reference)])
+    counts = [len(bboxes) - len(ref_bboxes) for (bboxes, _), (ref_bboxes, _) in zip(results, reference)]
+    print(f"   bbox IoU vs {reference_name}: mean {np.mean(ious) if len(ious) else float('nan'):.3f}, min {np.min(ious) if len(ious) else float('nan'):.3f}, bbox count diff {np.abs(counts).sum()}")
+    print(f"   keypoint diff vs {reference_name}: mean {np.nanmean(diffs) if not np.isnan(diffs).all() else float('nan'):.2f} px, max {np.nanmax(diffs) if not np.isnan(diffs).all() else float('nan'):.2f} px")
@@ -0,0 +1,103 @@
+import argparse
+import glob
+import os
+
+import cv2
+
+import util
+import image_processor
+import inference_backend
+
+# detect/poseモデルのfloat16/INT8量子化モデルを作成する
+# onnx: ultralyticsでonnxにexportし(無い場合)，ONNX Runtimeで量子化する．
+#       --calibを指定するとその画像で静的量子化(QDQ)，省略すると重みのみの動的量子化
+# tflite: ultralyticsのexportで "{name}_saved_model/{name}_{precision}.tflite" を作成する(INT8は--dataの較正データが必要)
+# 作成したモデルはconfig.jsonのwilt.backend/wilt.precisionで使用する．
+# 深度推定(DepthAnythingV2)はwilt.depth_precisionをint8にすると読込時に量子化するため，ここでは作成しない
+# 実行例: PYTHONPATH=/usr/local/bin/pinode3 python script/export_quantized.py --format onnx --precision int8 --calib /home/pinode3/data/image/image4/20250410
+
+TASKS = {"detect": 1024, "pose": 640}
+
+class CalibrationReader:
+    """
+    ONNX Runtimeの静的量子化に較正用の入力を1枚ずつ渡す(quantization.CalibrationDataReader)
+    """
+    def __init__(self, input_name, images, size):
+        preprocess = inference_backend.NativeBackend("detect").preprocess
+        self.inputs = iter([{input_name: preprocess([image], size)[0]} for image in images])
+
+    def get_next(self):
+        return next(self.inputs, None)
+
+def calibration_images(calib_dir, task, limit):
+    """
+    較正用の画像．detectは画像全体，poseは検出した葉の切り出し画像
+    """
+    paths = sorted(glob.glob(os.path.join(calib_dir, "*.jpg")))
+    images = [cv2.resize(cv2.imread(path), (1024, 1024)) for path in paths[::max(len(paths) // limit, 1)][:limit]]
+    if task == "detect":
+        return images
+    detect, _ = image_processor.load_models(server_flag, "onnx")
+    clips = []
+    for image in images:
+        for bbox in detect.detect(image, 1024, conf=0.3)[:5]:
+            clip = image_processor.get_frame(image, bbox)[0]
+            clips.append(cv2.resize(clip, (640, 640)))
+    return clips[:limit]
+
+def export_onnx(source, task, precision):
+    float_path = image_processor.find_weight(inference_backend.model_path(source, "onnx"))
+    if not os.path.exists(float_path):
+        from ultralytics import YOLO
+        # poseは全ての葉を1回で推論するため，バッチサイズを可変にする
+        float_path = YOLO(image_processor.find_weight(source)).export(format="onnx", imgsz=TASKS[task], dynamic=task == "pose", simplify=True)
+    if precision == "float32":
+        return float_path
+    output_path = float_path.removesuffix(".onnx") + f"_{precision}.onnx"
+
+    if precision == "float16":
+        import onnx
+        from onnxconverter_common import float16
+        # 入出力はfloat32のままにし，前処理・後処理を変えない
+        onnx.save(float16.convert_float_to_float16(onnx.load(float_path), keep_io_types=True), output_path)
+    elif args.calib:
+        import onnxruntime as ort
+        from onnxruntime import quantization
+        input_name = ort.InferenceSession(float_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+        reader = CalibrationReader(input_name, calibration_images(args.calib, task, args.calib_num), TASKS[task])
+        quantization.quantize_static(
+            float_path, output_path, reader, quant_format=quantization.QuantFormat.QDQ, per_channel=True,
+            activation_type=quantization.QuantType.QUInt8, weight_type=quantization.QuantType.QInt8)
+    else:
+        from onnxruntime import quantization
+        quantization.quantize_dynamic(float_path, output_path, weight_type=quantization.QuantType.QInt8)
+    return output_path
+
+def export_tflite(source, task, precision):
+    from ultralytics import YOLO
+    if precision == "int8" and args.data is None:
+        raise ValueError("INT8のtfliteには較正データ(--data)が必要です")
+    YOLO(image_processor.find_weight(source)).export(
+        format="tflite", imgsz=TASKS[task], half=precision == "float16", int8=precision == "int8", data=args.data)
+    return image_processor.find_weight(inference_backend.model_path(source, "tflite", precision))
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--tasks", nargs="+", default=list(TASKS), choices=list(TASKS))
+parser.add_argument("--format", choices=["onnx", "tflite"], default="onnx")
+parser.add_argument("--precision", choices=inference_backend.PRECISIONS, default="int8")
+parser.add_argument("--calib", default=None, help="onnxの静的量子化に使う画像のフォルダ(1日分の画像など)")
+parser.add_argument("--calib-num", type=int, default=50, help="較正に使う画像の枚数")
+parser.add_argument("--data", default=None, help="tfliteのINT8量子化に使うultralyticsのデータセット(yaml)")
+parser.add_argument("--server-flag", type=int, default=None, help="1: サーバ用，0: エッジ用のモデル．省略時はconfig.jsonの値")
+args = parser.parse_args()
+
+setting = util.get_pinode_config()
+server_flag = setting["wilt"]["server_flag"] if args.server_flag is None else bool(args.server_flag)
+for task, default_path in zip(TASKS, image_processor.DEFAULT_MODELS[bool(server_flag)]):
+    if task not in args.tasks:
+        continue
+    # 量子化の元にする.ptモデル
+    source = inference_backend.model_path(default_path, "onnx").removesuffix(".onnx") + ".pt"
+    export = export_onnx if args.format == "onnx" else export_tflite
+    output_path = export(source, task, args.precision)
+    print(f"{task}: {output_path} ({os.path.getsize(output_path) / 1024 / 1024:.1f} MB)")
@@ -0,0 +1,43 @@
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+import util
+import image_processor
+
+# 葉ごとのPOSE推定(従来)と全葉をまとめたPOSE推定の処理時間を比較する
+# 実行例: PYTHONPATH=/usr/local/bin/pinode3 python script/pose_benchmark.py image.jpg --repeat 10
+
+parser = argparse.ArgumentParser()
+parser.add_argument("image", help="1024x1024にリサイズして使用する入力画像")
+parser.add_argument("--leaf-num", type=int, default=15, help="POSE推定する葉の数")
+parser.add_argument("--repeat", type=int, default=10, help="計測回数")
+args = parser.parse_args()
+
+setting = util.get_pinode_config()
+detect, pose = image_processor.load_configured_models(setting["wilt"])
+image = cv2.resize(cv2.imread(args.image), (1024, 1024))
+
+# 検出結果から葉のbboxを用意する
+bbox_list = detect.detect(image, 1024, conf=0.3).tolist()[:args.leaf_num]
+print(f"leaf num: {len(bbox_list)}")
+
+methods = {
+    "sequential": image_processor.estimate_pose_sequential,
+    "batch": image_processor.estimate_pose_batch,
+}
+keypoints = {}
+for name, method in methods.items():
+    # 初回はモデルの準備を含むため計測から除外
+    keypoints[name] = method(pose, image, bbox_list)
+    elapsed = []
+    for _ in range(args.repeat):
+        start_time = time.perf_counter()
+        method(pose, image, bbox_list)
+        elapsed.append(time.perf_counter() - start_time)
+    print(f"{name:>10}: mean {np.mean(elapsed) * 1000:.1f} ms, min {np.min(elapsed) * 1000:.1f} ms")
+
+diff = np.abs(keypoints["sequential"] - keypoints["batch"])
+print(f"max keypoint diff: {np.nanmax(diff) if not np.isnan(diff).all() else float('nan'):.2f} px")
@@ -0,0 +1,154 @@
+import argparse
+import copy
+import glob
+import os
+import re
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+import util
+import image_processor
+import inference_backend
+from track_store import TrackStore
+from wilt import run_cycle
+
+# 記録済みの1日分の画像をfloat32のモデルと量子化モデルで処理し，量子化してよいかを判断する
+# 1. 画像ごとにdetect/pose/深度推定をそれぞれのモデルで実行し，処理時間とbboxのIoU・キーポイントのずれ・深度の差を比較する
+# 2. 1日分の萎れ指標計算(first_detection/tracking)をそれぞれのモデルで再実行し，final_wiltのずれを比較する
+# 量子化モデルはscript/export_quantized.pyで作成しておく
+# 実行例: PYTHONPATH=/usr/local/bin/pinode3 python script/quantization_check.py /home/pinode3/data/image/image4/20250410 --backend onnx --precision int8
+
+def match_iou(bboxes, reference):
+    """
+    基準のbboxごとに最もIoUの高いbboxとのIoUを返す(対応するbboxが無ければ0)
+    """
+    if len(reference) == 0:
+        return np.array([])
+    if len(bboxes) == 0:
+        return np.zeros(len(reference))
+    return image_processor.calc_iou_matrix(reference, bboxes).max(axis=1)
+
+def timed(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start_time
+
+def replay(images, precision, depth_precision):
+    """
+    1日分の萎れ指標計算を行い，毎分のfinal_wiltと処理時間を返す
+
+    Notes:
+        深度キャッシュを使うと後のreplayが前のreplayの深度を再利用してしまい(運用中のキャッシュにも過去の日付の深度が残る)，
+        オプティカルフローを使うとdetectを実行しない時刻が増えるため，どちらも無効にして毎分の推論を比較する
+    """
+    config = copy.deepcopy(setting)
+    config["wilt"].update(backend=args.backend, precision=precision, depth_precision=depth_precision, detect_model="", pose_model="",
+                          depth_cache=False, flow_tracking=False)
+    util.get_pinode_config = lambda: config
+    store = TrackStore()
+    final_wilts = []
+    times = []
+    for path, now_time in images:
+        img_pro = image_processor.image_processor(store, args.image_dir, now_time, path)
+        store, elapsed = timed(run_cycle, img_pro, store)
+        times.append(elapsed)
+        final_wilts.append(store.latest_global("final_wilt") if store.has_global("final_wilt") else np.nan)
+    return np.array(final_wilts, dtype=float), np.array(times)
+
+def speedup(name, float_times, quant_times, precision):
+    float_ms, quant_ms = np.mean(float_times) * 1000, np.mean(quant_times) * 1000
+    return f"{name:>8}: float32 {float_ms:8.2f} ms  {precision} {quant_ms:8.2f} ms  speedup x{float_ms / quant_ms:.2f}"
+
+parser = argparse.ArgumentParser()
+parser.add_argument("image_dir", help="1日分の画像フォルダ(/home/pinode3/data/image/image4/20250410など)")
+parser.add_argument("--backend", choices=inference_backend.BACKENDS, default=None, help="省略時はconfig.jsonのwilt.backend")
+parser.add_argument("--precision", choices=["float16", "int8"], default="int8")
+parser.add_argument("--depth-precision", choices=["float32", "int8"], default="int8")
+parser.add_argument("--limit", type=int, default=None, help="処理する画像の枚数(先頭から)")
+parser.add_argument("--depth-samples", type=int, default=5, help="深度推定を比較する画像の枚数")
+parser.add_argument("--no-replay", action="store_true", help="萎れ指標計算の再実行を省略する")
+parser.add_argument("--max-wilt-diff", type=float, default=0.05, help="量子化してよいと判断するfinal_wiltのずれの最大値")
+args = parser.parse_args()
+
+setting = util.get_pinode_config()
+wilt_config = setting["wilt"]
+args.backend = args.backend or wilt_config.get("backend", "ultralytics")
+server_flag = wilt_config["server_flag"]
+threads = wilt_config.get("backend_threads", 0)
+encoder = wilt_config.get("depth_encoder", "vits")
+pattern = re.compile(rf"^{setting['device_id']}_{wilt_config['camera_usb']}_{wilt_config['camera_type']}_(\d{{8}}-\d{{4}})\.jpg$")
+images = []
+for path in sorted(glob.glob(os.path.join(args.image_dir, "*.jpg"))):
+    match = pattern.match(os.path.basename(path))
+    if match:
+        images.append((path, datetime.strptime(match.group(1), "%Y%m%d-%H%M")))
+images = images[:args.limit]
+print(f"images: {len(images)}, backend: {args.backend}, precision: {args.precision}, depth precision: {args.depth_precision}")
+
+float_detect, float_pose = image_processor.load_models(server_flag, args.backend, threads=threads)
+quant_detect, quant_pose = image_processor.load_models(server_flag, args.backend, threads=threads, precision=args.precision)
+
+# 1. モデル単体の比較
+times = {name: ([], []) for name in ["detect", "pose", "depth"]}
+ious, keypoint_diffs, keypoint_lost, bbox_count_diffs, depth_diffs = [], [], [], [], []
+for k, (path, _) in enumerate(images):
+    image = cv2.resize(cv2.imread(path), (1024, 1024))
+    float_bboxes, float_time = timed(float_detect.detect, image, 1024, 0.3)
+    quant_bboxes, quant_time = timed(quant_detect.detect, image, 1024, 0.3)
+    times["detect"][0].append(float_time)
+    times["detect"][1].append(quant_time)
+    ious.append(match_iou(quant_bboxes, float_bboxes))
+    bbox_count_diffs.append(len(quant_bboxes) - len(float_bboxes))
+
+    # poseは両方ともfloat32のモデルで検出したbboxを使う
+    bbox_list = float_bboxes.tolist()
+    float_keypoints, float_time = timed(image_processor.estimate_pose_batch, float_pose, image, bbox_list)
+    quant_keypoints, quant_time = timed(image_processor.estimate_pose_batch, quant_pose, image, bbox_list)
+    times["pose"][0].append(float_time)
+    times["pose"][1].append(quant_time)
+    keypoint_diffs.append(np.abs(quant_keypoints - float_keypoints).ravel())
+    # 片方のモデルのみで推定できなかった葉
+    keypoint_lost.append(np.sum(np.isnan(quant_keypoints).any(axis=1) != np.isnan(float_keypoints).any(axis=1)))
+
+    if k < args.depth_samples:
+        float_depth, float_time = timed(image_processor.get_depth_map, image, encoder, True, "float32")
+        quant_depth, quant_time = timed(image_processor.get_depth_map, image, encoder, True, args.depth_precision)
+        times["depth"][0].append(float_time)
+        times["depth"][1].append(quant_time)
+        depth_diffs.append(np.abs(quant_depth.astype(int) - float_depth.astype(int)).mean())
+
+print("== model ==")
+for name, (float_times, quant_times) in times.items():
+    if float_times:
+        print(speedup(name, float_times, quant_times, args.depth_precision if name == "depth" else args.precision))
+ious = np.concatenate(ious) if ious else np.array([])
+keypoint_diffs = np.concatenate(keypoint_diffs) if keypoint_diffs else np.array([np.nan])
+print(f"bbox IoU: mean {np.mean(ious) if len(ious) else float('nan'):.3f}, min {np.min(ious) if len(ious) else float('nan'):.3f}, bbox count diff {np.abs(bbox_count_diffs).sum()} / {len(images)} images")
+if not np.isnan(keypoint_diffs).all():
+    print(f"keypoint diff: mean {np.nanmean(keypoint_diffs):.2f} px, p95 {np.nanpercentile(keypoint_diffs, 95):.2f} px, max {np.nanmax(keypoint_diffs):.2f} px")
+print(f"keypoint lost/gained: {int(np.sum(keypoint_lost))} leaves")
+if depth_diffs:
+    print(f"depth diff (0-255): mean {np.mean(depth_diffs):.2f}")
+
+# 2. 萎れ指標計算の再実行
+if not args.no_replay:
+    # モデル単体の比較で読み込んだモデルを破棄してから実行する
+    image_processor._yolo_models.clear()
+    image_processor.evict_depth_model()
+    float_wilts, float_times = replay(images, "float32", "float32")
+    image_processor._yolo_models.clear()
+    image_processor.evict_depth_model()
+    quant_wilts, quant_times = replay(images, args.precision, args.depth_precision)
+
+    print("== wilt replay ==")
+    print(speedup("cycle", float_times, quant_times, args.precision))
+    diffs = np.abs(quant_wilts - float_wilts)
+    valid = ~np.isnan(diffs)
+    if valid.any():
+        corr = np.corrcoef(float_wilts[valid], quant_wilts[valid])[0, 1] if np.std(float_wilts[valid]) > 0 and np.std(quant_wilts[valid]) > 0 else float("nan")
+        print(f"final_wilt diff: mean {diffs[valid].mean():.4f}, max {diffs[valid].max():.4f} (at {images[int(np.nanargmax(diffs))][1]:%H:%M}), corr {corr:.4f}")
+        print(f"final_wilt range (float32): {np.nanmin(float_wilts):.4f} - {np.nanmax(float_wilts):.4f}")
+        print("quantization:", "OK" if diffs[valid].max() <= args.max_wilt_diff else "NG", f"(max-wilt-diff {args.max_wilt_diff})")
@@ -0,0 +1,193 @@
+import argparse
+import contextlib
+import glob
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+# 記録済みの画像(過去の日付)の萎れ指標計算をやり直す
+# カメラ・日付ごとに1日分の画像を時刻順にfirst_detection/trackingで処理し，--output-dirに通常と同じ配置(画像フォルダ名/日付/result.log)で保存する
+# 稼働中の処理が追記している今日の画像フォルダには書き込まない
+# カメラ・日付の組をプロセスプールで並列に処理する(1日分の処理は前の時刻の結果を使うため順番に行う)
+# 追跡の閾値やモデルを変えた場合は--setでconfig.jsonのwiltの値を上書きする．InfluxDBには書き込まない
+# 実行例: PYTHONPATH=/usr/local/bin/pinode3 python script/reanalyze.py --start 20250410 --end 20250430 --workers 4 --output-dir /home/pinode3/data/reanalysis --set flow_tracking=false
+
+# 結果の既定の保存先(画像フォルダの結果を上書きしない)
+REANALYSIS_DIR = "/home/pinode3/data/reanalysis"
+
+def parse_camera(text):
+    """
+    "04:HDR" または "04:HDR:/home/pinode3/data/image/image4" をカメラの設定にする(画像フォルダの省略時はconfig.jsonの値)
+    """
+    usb, camera_type, *image_dir = text.split(":", 2)
+    camera = {"camera_usb": usb, "camera_type": camera_type}
+    if image_dir:
+        camera["image_dir"] = image_dir[0]
+    return camera
+
+def parse_value(text):
+    """
+    --setの値(JSONとして読めなければ文字列)
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def list_images(day_dir, edge_id, camera, start_time, end_time):
+    """
+    1日分の画像を時刻順に返す
+
+    Returns:
+        images (list): (画像のパス, 撮影時刻)のリスト(動作時間内のみ)
+    """
+    pattern = re.compile(rf"^{re.escape(str(edge_id))}_{re.escape(camera['camera_usb'])}_{re.escape(camera['camera_type'])}_(\d{{8}}-\d{{4}})\.jpg$")
+    images = []
+    for path in sorted(glob.glob(os.path.join(day_dir, "*.jpg"))):
+        match = pattern.match(os.path.basename(path))
+        if match is None:
+            continue
+        now_time = datetime.strptime(match.group(1), "%Y%m%d-%H%M")
+        if start_time <= now_time.time() <= end_time:
+            images.append((path, now_time))
+    return images
+
+def init_worker(config, threads):
+    """
+    プロセスプールの各プロセスで，上書きした設定を使うようにする
+    """
+    import util
+    util.get_pinode_config = lambda *args, **kwargs: config
+    if threads:
+        # 並列に動かすプロセス同士でCPUを取り合わないよう，推論のスレッド数を制限する
+        os.environ["OMP_NUM_THREADS"] = str(threads)
+        try:
+            import torch
+            torch.set_num_threads(threads)
+        except ImportError:
+            pass
+
+def reanalyze_day(camera, date, output_dir, result_format, verbose):
+    """
+    1台のカメラの1日分の萎れ指標計算をやり直し，結果を保存する
+
+    Returns:
+        summary (dict): 処理した画像の数・再検出の回数・最後のfinal_wilt・処理時間
+    """
+    import util
+    import result_log
+    import image_processor
+    from track_store import TrackStore
+    from wilt import run_cycle
+
+    setting = util.get_pinode_config()
+    wilt_config = setting["wilt"]
+    day_dir = os.path.join(camera["image_dir"], date)
+    start_time = datetime.strptime(wilt_config["start_time"], "%H%M").time()
+    end_time = datetime.strptime(wilt_config["end_time"], "%H%M").time()
+    images = list_images(day_dir, setting["device_id"], camera, start_time, end_time)
+
+    start = time.time()
+    store = TrackStore()
+    # 深度キャッシュは時刻で古いファイルを削除するため，並列に処理する日付ごとに分ける
+    cache_dir = tempfile.mkdtemp(prefix="reanalysis_depth_cache_")
+    try:
+        with contextlib.ExitStack() as stack:
+            if not verbose:
+                stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+            for path, now_time in images:
+                img_pro = image_processor.image_processor(store, day_dir, now_time, path, camera=camera)
+                img_pro.depth_cache_dir = cache_dir
+                store = run_cycle(img_pro, store)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    os.makedirs(output_dir, exist_ok=True)
+    if result_format == "csv":
+        util.save_csv(store.to_frame(), os.path.join(output_dir, result_log.CSV_NAME))
+    else:
+        log = result_log.ResultLog(output_dir)
+        log.store = store
+        log.compact()
+    re_detection = store.global_column("re_detection") if store.has_global("re_detection") else []
+    final_wilt = store.latest_global("final_wilt") if store.has_global("final_wilt") else float("nan")
+    return {"images": len(images), "re_detection": int(sum(v == 1 for v in re_detection)),
+            "final_wilt": float(final_wilt), "elapsed": time.time() - start}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--start", required=True, help="開始日(YYYYMMDD)")
+    parser.add_argument("--end", default=None, help="終了日(YYYYMMDD)．省略時は開始日のみ")
+    parser.add_argument("--device", default=None, help="デバイスID．省略時はconfig.jsonのdevice_id")
+    parser.add_argument("--cameras", nargs="+", type=parse_camera, default=None,
+                        help="\"usb:type\" または \"usb:type:画像フォルダ\"．省略時はconfig.jsonのwilt.cameras")
+    parser.add_argument("--output-dir", default=REANALYSIS_DIR, help="結果の保存先(その下に画像フォルダ名/日付のフォルダを作る)")
+    parser.add_argument("--overwrite", action="store_true", help="既存の結果ファイルを上書きする")
+    parser.add_argument("--format", choices=["log", "csv"], default=None, help="結果の保存形式．省略時はconfig.jsonのwilt.result_format")
+    parser.add_argument("--set", nargs="+", default=[], metavar="KEY=VALUE", help="config.jsonのwiltの値を上書きする(値はJSON)")
+    parser.add_argument("--workers", type=int, default=None, help="並列に処理するプロセス数．省略時はCPU数")
+    parser.add_argument("--threads", type=int, default=None, help="プロセスごとの推論スレッド数．省略時はCPU数/プロセス数")
+    parser.add_argument("--verbose", action="store_true", help="1分毎の処理のログを表示する")
+    args = parser.parse_args()
+
+    import util
+    import result_log
+    config = util.get_pinode_config()
+    if args.device is not None:
+        config["device_id"] = args.device
+    for item in args.set:
+        key, value = item.split("=", 1)
+        config["wilt"][key] = parse_value(value)
+    result_format = args.format or config["wilt"].get("result_format", "csv")
+    cameras = util.get_wilt_cameras(config["wilt"])
+    if args.cameras is not None:
+        cameras = [{"image_dir": config["wilt"]["image_dir"], **camera} for camera in args.cameras]
+
+    start_date = datetime.strptime(args.start, "%Y%m%d")
+    end_date = datetime.strptime(args.end or args.start, "%Y%m%d")
+    today = datetime.now().strftime("%Y%m%d")
+    jobs = []
+    for camera in cameras:
+        for days in range((end_date - start_date).days + 1):
+            date = (start_date + timedelta(days=days)).strftime("%Y%m%d")
+            if not os.path.isdir(os.path.join(camera["image_dir"], date)):
+                continue
+            output_dir = os.path.join(args.output_dir, os.path.basename(os.path.normpath(camera["image_dir"])), date)
+            if os.path.realpath(output_dir) == os.path.realpath(os.path.join(camera["image_dir"], today)):
+                print(f"skip {output_dir} (today's live result of the running pipeline)")
+                continue
+            result_name = result_log.CSV_NAME if result_format == "csv" else result_log.LOG_NAME
+            if os.path.exists(os.path.join(output_dir, result_name)) and not args.overwrite:
+                print(f"skip {output_dir} (result exists, use --overwrite)")
+                continue
+            jobs.append((camera, date, output_dir))
+
+    workers = min(args.workers or os.cpu_count(), max(len(jobs), 1))
+    threads = args.threads if args.threads is not None else max(os.cpu_count() // workers, 1)
+    # onnx/tfliteの推論スレッド数
+    config["wilt"]["backend_threads"] = threads
+    print(f"jobs: {len(jobs)} (cameras: {len(cameras)}), workers: {workers}, threads: {threads}, format: {result_format}")
+
+    start = time.time()
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(config, threads)) as executor:
+        futures = {executor.submit(reanalyze_day, camera, date, output_dir, result_format, args.verbose): (camera, date, output_dir)
+                   for camera, date, output_dir in jobs}
+        for future in as_completed(futures):
+            camera, date, output_dir = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                print(f"{camera['camera_usb']}_{camera['camera_type']} {date}: error {e}")
+                continue
+            print(f"{camera['camera_usb']}_{camera['camera_type']} {date}: {summary['images']} images, "
+                  f"re_detection {summary['re_detection']}, final_wilt {summary['final_wilt']:.4f}, "
+                  f"{summary['elapsed']:.1f}s -> {output_dir}")
+    print(f"total: {time.time() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import time
+
+import numpy as np
+from cobs import cobs
+
+from cobs_reader import CobsFrameReader
+
+# SPRESENSEの画像受信(COBSパケットの読込)の処理速度を，従来の1バイトずつの読込と比較する
+# 記録したバイト列(--stream)，または合成した画像のパケット列をメモリ上のシリアルポートから読み込む
+# 記録例: stty -F /dev/ttyUSB0 115200 raw && cat /dev/ttyUSB0 > stream.bin (別の端末から"S"を送信)
+# 実行例: PYTHONPATH=/usr/local/bin/pinode3 python script/serial_packet_benchmark.py --stream stream.bin
+
+BUFF_SIZE = 100
+TYPE_INFO, TYPE_IMAGE, TYPE_FINISH = 0, 1, 2
+
+class ReplaySerial:
+    """
+    バイト列を受信済みのデータとして返すシリアルポート(read(), in_waiting)
+
+    Args:
+        data (bytes): 受信するバイト列
+        chunk (int): in_waitingの上限(ドライバの受信バッファの大きさ)
+    """
+    def __init__(self, data, chunk=4095):
+        self.data = data
+        self.chunk = chunk
+        self.position = 0
+        self.calls = 0
+
+    @property
+    def in_waiting(self):
+        return min(len(self.data) - self.position, self.chunk)
+
+    def read(self, size=1):
+        self.calls += 1
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+def make_stream(image_size, seed=0):
+    """
+    SPRESENSEが送信する1枚分のパケット列(INFO, IMAGE x N, FINISH)を合成する
+    """
+    image = np.random.default_rng(seed).integers(0, 256, image_size, dtype=np.uint8).tobytes()
+    max_index = len(image) // BUFF_SIZE
+    # インデックスは10進数4桁を1バイトずつ送る
+    digits = lambda index: bytes(int(d) for d in f"{index:04d}")
+    packets = [bytes([TYPE_INFO]) + digits(max_index)]
+    for index in range(max_index):
+        packets.append(bytes([TYPE_IMAGE]) + digits(index) + image[index * BUFF_SIZE:(index + 1) * BUFF_SIZE])
+    packets.append(bytes([TYPE_FINISH]) + digits(max_index) + image[max_index * BUFF_SIZE:])
+    return b"".join(cobs.encode(packet) + b"\x00" for packet in packets)
+
+def read_bytewise(ser):
+    """
+    従来のSPRESENSE._get_packet(1バイトずつ読み込み，bytesを連結してcobs.decode)
+    """
+    frames = []
+    while ser.position < len(ser.data):
+        img = b''
+        while True:
+            val = ser.read()
+            if val == b'\x00' or val == b'':
+                break
+            img += val
+        try:
+            decoded = cobs.decode(img)
+        except cobs.DecodeError:
+            continue
+        frames.append(bytes(decoded))
+    return frames
+
+def read_chunked(ser):
+    """
+    CobsFrameReaderで読み込む(比較のため復号したパケットはbytesにする)
+    """
+    reader = CobsFrameReader(ser)
+    frames = []
+    while True:
+        try:
+            frame = reader.read_frame()
+        except ValueError:
+            continue
+        if frame is None:
+            break
+        frames.append(bytes(frame))
+    return frames
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--stream", default=None, help="記録したバイト列のファイル．省略時は合成したパケット列")
+parser.add_argument("--image-size", type=int, default=200_000, help="合成する画像のバイト数")
+parser.add_argument("--chunk", type=int, default=4095, help="1回に読み込める受信済みデータの上限")
+parser.add_argument("--repeat", type=int, default=3, help="計測回数")
+args = parser.parse_args()
+
+if args.stream:
+    with open(args.stream, "rb") as f:
+        data = f.read()
+else:
+    data = make_stream(args.image_size)
+print(f"stream: {len(data)} bytes, {data.count(0)} packets, line time at 115200 baud: {len(data) * 10 / 115200:.1f}s")
+
+results = {}
+for name, read in [("bytewise", read_bytewise), ("chunked", read_chunked)]:
+    times = []
+    for _ in range(args.repeat):
+        ser = ReplaySerial(data, args.chunk)
+        start = time.perf_counter()
+        frames = read(ser)
+        times.append(time.perf_counter() - start)
+    results[name] = frames
+    elapsed = min(times)
+    print(f"{name:>8}: {elapsed * 1000:9.1f} ms  {len(data) / elapsed / 1e6:7.2f} MB/s  read calls {ser.calls:8d}  packets {len(frames)}")
+print("same packets:", results["bytewise"] == results["chunked"])
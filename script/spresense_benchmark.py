@@ -0,0 +1,75 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import camera
+import util
+from spresense_session import SpresenseSession
+from spresense_simulator import SpresenseSimulator, random_image
+
+# SPRESENSEの画像受信(SPRESENSE.save)を疑似端末上のシミュレータ(script/spresense_simulator.py)で計測する
+# BUFF_SIZE・ボーレート・パケットの欠落率の組み合わせごとに，保存までの時間・転送時間・再送の回数を表示する
+# --sessionを指定すると撮影の間もポートを開いたままにする(常駐する撮影プロセスと同じ)．指定しない場合は撮影ごとに開いて閉じる
+# 実機が無くても受信処理の最適化やBUFF_SIZEの変更の効果を確認できる(InfluxDBへの書き込みとUSBの再起動は行わない)
+# 実行例: PYTHONPATH=/usr/local/bin/pinode3 python script/spresense_benchmark.py --buff-sizes 100 200 500 --loss 0 0.01 0.05
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--image", default=None, help="送信する画像ファイル．省略時は乱数のバイト列")
+parser.add_argument("--image-size", type=int, default=60000, help="乱数のバイト列の大きさ")
+parser.add_argument("--buff-sizes", type=int, nargs="+", default=[100], help="1パケットの画像データの大きさ")
+parser.add_argument("--baud", type=int, default=115200, help="0なら送信間隔を空けない")
+parser.add_argument("--loss", type=float, nargs="+", default=[0.0, 0.01], help="画像パケットの欠落率")
+parser.add_argument("--corrupt", type=float, default=0.0, help="画像パケットのサイズ不正の率")
+parser.add_argument("--error", type=float, default=0.0, help="復号できないパケットの率")
+parser.add_argument("--repeat", type=int, default=3, help="組み合わせごとの計測回数")
+parser.add_argument("--session", action="store_true", help="ポートを開いたままにする(SpresenseSession)")
+args = parser.parse_args()
+
+if args.image:
+    with open(args.image, "rb") as f:
+        image = f.read()
+else:
+    image = random_image(args.image_size)
+
+work_dir = tempfile.mkdtemp(prefix="spresense_benchmark_")
+config = util.get_pinode_config()
+config["camera"]["image_dir"] = work_dir
+config["copy_folder"]["realtime_send"] = False
+uploads = []
+camera.upload = lambda edge_id, now_time, fields, tags=None: uploads.append(fields)
+camera.SPRESENSE._reboot = lambda self: print("reboot (skipped)")
+print(f"image: {len(image)} bytes, baud: {args.baud}, corrupt: {args.corrupt}, error: {args.error}, work dir: {work_dir}")
+
+for buff_size in args.buff_sizes:
+    camera.SPRESENSE.BUFF_SIZE = buff_size
+    for loss in args.loss:
+        save_times, stats = [], []
+        ok = 0
+        with SpresenseSimulator(image, buff_size, args.baud, loss, args.corrupt, args.error) as simulator:
+            session = SpresenseSession(simulator.path, camera.SPRESENSE.BAUD_RATE) if args.session else None
+            for k in range(args.repeat):
+                file_name = f"image4/{config['device_id']}_04_HDR_{k:04d}.jpg"
+                uploads.clear()
+                spresense = camera.SPRESENSE(simulator.path, session)
+                spresense.config = config
+                start = time.perf_counter()
+                spresense.save(file_name)
+                save_times.append(time.perf_counter() - start)
+                path = os.path.join(work_dir, file_name)
+                ok += os.path.exists(path) and open(path, "rb").read() == image
+                stats += [fields for fields in uploads if fields.get("spresense_ok")]
+            if session is not None:
+                session.close()
+        line_time = len(image) * (1 + 7 / buff_size) * 10 / args.baud if args.baud else 0
+        summary = f"buff {buff_size:5d} loss {loss:5.3f}: save {np.mean(save_times):6.2f}s"
+        if stats:
+            summary += (f"  transfer {np.mean([s['spresense_elapsed'] for s in stats]):6.2f}s"
+                        f" ({np.mean([s['spresense_bytes_per_sec'] for s in stats]):7.0f} B/s, line {line_time:5.2f}s)"
+                        f"  packets {np.mean([s['spresense_packets'] for s in stats]):7.1f}"
+                        f"  retransmits {np.mean([s['spresense_retransmits'] for s in stats]):6.1f}"
+                        f"  attempts {np.mean([s['spresense_attempt'] for s in stats]):4.2f}"
+                        f"  opened {sum(s['spresense_opened'] for s in stats)}")
+        print(summary + f"  ok {ok}/{args.repeat}")
@@ -0,0 +1,195 @@
+import argparse
+import os
+import queue
+import select
+import threading
+import time
+import tty
+
+import numpy as np
+from cobs import cobs
+
+# SPRESENSEの代わりに画像送信のプロトコルを話す疑似端末(pty)
+# "S"で撮影してTYPE_INFO/TYPE_IMAGE/TYPE_FINISHのパケットを送信し，"R{index}"で再送，"E"で送信を終える
+# パケットはCOBSで符号化して0x00で区切る．ボーレートに合わせて送信間隔を空け，パケットの欠落・破損・エラーを注入できる
+# 単体で起動すると疑似端末のパスを表示し，SPRESENSE(パス)で接続できる
+# 実行例: PYTHONPATH=/usr/local/bin/pinode3 python script/spresense_simulator.py --image sample.jpg --loss 0.01
+
+TYPE_INFO = 0
+TYPE_IMAGE = 1
+TYPE_FINISH = 2
+TYPE_ERROR = 3
+
+def index_digits(index):
+    """
+    インデックスを10進数4桁の1桁ずつのバイト列にする(SPRESENSE._get_packetの逆)
+    """
+    return bytes(int(digit) for digit in f"{index:04d}")
+
+class SpresenseSimulator:
+    """
+    疑似端末上でSPRESENSEの画像送信を模擬するクラス
+
+    Args:
+        image (bytes): 送信する画像
+        buff_size (int): 1パケットの画像データの大きさ(SPRESENSE.BUFF_SIZE)
+        baud (int): ボーレート(1バイト10ビットとして送信間隔を空ける)．0なら待たない
+        loss (float): 画像パケットを送信しない確率
+        corrupt (float): 画像パケットの末尾を欠けさせる確率(サイズ不正)
+        error (float): 画像パケットの代わりに復号できないバイト列を送る確率
+        capture_delay (float): "S"を受け取ってから送信を始めるまでの時間(撮影時間，秒)
+        seed (int): 乱数のシード
+
+    Notes:
+        start()で作成した疑似端末のパス(path)をシリアルポートとして開く．
+        受け取ったコマンドと送信したパケットの数はstatsに記録する
+    """
+    def __init__(self, image, buff_size=100, baud=115200, loss=0.0, corrupt=0.0, error=0.0, capture_delay=0.5, seed=0):
+        self.image = image
+        self.buff_size = buff_size
+        self.baud = baud
+        self.loss = loss
+        self.corrupt = corrupt
+        self.error = error
+        self.capture_delay = capture_delay
+        self.rng = np.random.default_rng(seed)
+        self.max_index = len(image) // buff_size
+        if self.max_index > 9999:
+            raise ValueError(f"image is too large for 4-digit indices: {len(image)} bytes / {buff_size}")
+        self.outgoing = queue.Queue()
+        self.stats = {"captures": 0, "resend_requests": 0, "completes": 0, "packets": 0, "bytes": 0,
+                      "lost": 0, "corrupted": 0, "errors": 0}
+        self.running = False
+        self.master = self.slave = None
+        self.path = None
+
+    def start(self):
+        self.master, self.slave = os.openpty()
+        # エコーや改行の変換をしない
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.running = True
+        self.threads = [threading.Thread(target=self._receive, daemon=True), threading.Thread(target=self._send, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.outgoing.put(None)
+        for thread in self.threads:
+            thread.join(timeout=1)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exctype, excvalue, traceback):
+        self.stop()
+
+    def image_packet(self, index):
+        """
+        インデックスの画像パケット(故障を注入する)．送信しない場合はNone
+        """
+        packet = bytes([TYPE_IMAGE]) + index_digits(index) + self.image[index * self.buff_size:(index + 1) * self.buff_size]
+        r = self.rng.random()
+        if r < self.loss:
+            self.stats["lost"] += 1
+            return None
+        if r < self.loss + self.corrupt:
+            self.stats["corrupted"] += 1
+            return cobs.encode(packet[:-1 - int(self.rng.integers(self.buff_size // 2))]) + b"\x00"
+        if r < self.loss + self.corrupt + self.error:
+            # 長さのコードが不正なフレーム
+            self.stats["errors"] += 1
+            return bytes([0xFF]) + b"\x01" * 10 + b"\x00"
+        return cobs.encode(packet) + b"\x00"
+
+    def capture_packets(self):
+        """
+        "S"に対して送信する1枚分のパケット
+        """
+        yield cobs.encode(bytes([TYPE_INFO]) + index_digits(self.max_index)) + b"\x00"
+        for index in range(self.max_index):
+            yield self.image_packet(index)
+        finish = bytes([TYPE_FINISH]) + index_digits(self.max_index) + self.image[self.max_index * self.buff_size:]
+        yield cobs.encode(finish) + b"\x00"
+
+    def handle(self, command):
+        if command == "S":
+            self.stats["captures"] += 1
+            self.outgoing.put(self.capture_delay)
+            for packet in self.capture_packets():
+                self.outgoing.put(packet)
+        elif command == "E":
+            self.stats["completes"] += 1
+        elif command.startswith("R") and command[1:].isdigit():
+            self.stats["resend_requests"] += 1
+            index = int(command[1:])
+            if index < self.max_index:
+                self.outgoing.put(self.image_packet(index))
+
+    def _receive(self):
+        line = b""
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                break
+            line += data
+            while b"\n" in line:
+                command, line = line.split(b"\n", 1)
+                self.handle(command.decode(errors="replace").strip())
+
+    def _send(self):
+        while self.running:
+            packet = self.outgoing.get()
+            if packet is None:
+                continue
+            if isinstance(packet, float):
+                # 撮影時間
+                time.sleep(packet)
+                continue
+            try:
+                os.write(self.master, packet)
+            except OSError:
+                break
+            self.stats["packets"] += 1
+            self.stats["bytes"] += len(packet)
+            if self.baud:
+                time.sleep(len(packet) * 10 / self.baud)
+
+def random_image(size, seed=0):
+    """
+    JPEGの代わりに送信する乱数のバイト列
+    """
+    return np.random.default_rng(seed).integers(0, 256, size, dtype=np.uint8).tobytes()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", default=None, help="送信する画像ファイル．省略時は乱数のバイト列")
+    parser.add_argument("--image-size", type=int, default=60000, help="乱数のバイト列の大きさ")
+    parser.add_argument("--buff-size", type=int, default=100)
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--corrupt", type=float, default=0.0)
+    parser.add_argument("--error", type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.image:
+        with open(args.image, "rb") as f:
+            image = f.read()
+    else:
+        image = random_image(args.image_size)
+    with SpresenseSimulator(image, args.buff_size, args.baud, args.loss, args.corrupt, args.error) as simulator:
+        print(f"SPRESENSE simulator: {simulator.path} ({len(image)} bytes, {simulator.max_index + 1} packets)")
+        try:
+            while True:
+                time.sleep(10)
+                print(simulator.stats)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,97 @@
+import argparse
+import contextlib
+import os
+import shutil
+import tempfile
+import time
+
+from usb import USB
+from usb_registry import UsbRegistry
+
+# USBポートと機器の対応の取得時間を，毎回調べる場合(USB().get())とキャッシュ(UsbRegistry)で比較する
+# 偽の/dev(ttyUSB_*のシンボリックリンク，v4l/by-path)と/proc/cpuinfoを一時フォルダに作るため，実機が無くても実行できる
+# 撮影プロセスを毎分起動する場合(キャッシュファイルから読む)と常駐する場合(メモリ上の対応を使う)，機器を追加した後の再取得を計測する
+# 実行例: PYTHONPATH=/usr/local/bin/pinode3 python script/usb_discovery_benchmark.py --repeat 100
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--spresense", type=int, nargs="*", default=[4], help="SPRESENSEを接続するポート番号")
+parser.add_argument("--usb-cameras", type=int, nargs="*", default=[1, 2], help="USBカメラを接続するポート番号")
+parser.add_argument("--model", default="Raspberry Pi 4 Model B Rev 1.5", help="/proc/cpuinfoの機種名")
+parser.add_argument("--repeat", type=int, default=50)
+args = parser.parse_args()
+
+# Raspberry Pi 4でのポート番号とv4l/by-pathの名前の対応(USB._get_usb_camera_name)
+PI4_PATHS = {1: "0:1.3:1.0", 2: "0:1.4:1.0", 3: "0:1.1:1.0", 4: "0:1.2:1.0"}
+
+def make_dev(root, spresense, usb_cameras):
+    """
+    偽の/devを作る
+    """
+    dev_dir = os.path.join(root, "dev")
+    by_path = os.path.join(dev_dir, "v4l", "by-path")
+    os.makedirs(by_path)
+    # 実機の/devに近い数のデバイスファイル
+    for k in range(150):
+        open(os.path.join(dev_dir, f"tty{k}"), "w").close()
+    for k, port in enumerate(spresense):
+        open(os.path.join(dev_dir, f"ttyUSB{k}"), "w").close()
+        os.symlink(f"ttyUSB{k}", os.path.join(dev_dir, f"ttyUSB_{port}"))
+    for k, port in enumerate(usb_cameras):
+        add_camera(dev_dir, port, 2 * k)
+    cpuinfo_path = os.path.join(root, "cpuinfo")
+    with open(cpuinfo_path, "w") as f:
+        f.write("processor\t: 0\n" * 4 + f"Model\t\t: {args.model}\n")
+    return dev_dir, cpuinfo_path
+
+def add_camera(dev_dir, port, index):
+    """
+    USBカメラ1台分のデバイスファイル(1台につきvideoが2つ)を追加する
+    """
+    by_path = os.path.join(dev_dir, "v4l", "by-path")
+    for video in (index, index + 1):
+        open(os.path.join(dev_dir, f"video{video}"), "w").close()
+        os.symlink(f"../../video{video}", os.path.join(by_path, f"platform-fd500000.pcie-pci-0000:01:00.0-usb-{PI4_PATHS[port]}-video-index{video - index}"))
+    os.symlink(f"video{index}", os.path.join(dev_dir, f"ttyUSB_{port}"))
+
+def measure(function, repeat):
+    # sudoが無い環境でのUSB._get_usb_camera_nameのエラー表示を抑える
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            result = function()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+root = tempfile.mkdtemp(prefix="usb_discovery_benchmark_")
+try:
+    dev_dir, cpuinfo_path = make_dev(root, args.spresense, args.usb_cameras)
+    usb = USB(dev_dir, cpuinfo_path)
+    cache_path = os.path.join(root, "usb_devices.json")
+
+    scan_ms, devices = measure(usb.get, args.repeat)
+    print(f"devices: {devices}")
+    print(f"USB().get() (scan every time):          {scan_ms:8.3f} ms")
+
+    # 毎分起動する撮影プロセス: キャッシュファイルを読み，/devの更新時刻とデバイスファイルを確認する
+    measure(UsbRegistry(cache_path, usb).get, 1)
+    cold_ms, cached = measure(lambda: UsbRegistry(cache_path, usb).get(), args.repeat)
+    print(f"UsbRegistry (new process, cache file):  {cold_ms:8.3f} ms  (x{scan_ms / cold_ms:.0f})")
+
+    # 常駐する撮影プロセス: メモリ上の対応を使う
+    registry = UsbRegistry(cache_path, usb, watch=True)
+    measure(registry.get, 1)
+    warm_ms, cached = measure(registry.get, args.repeat)
+    print(f"UsbRegistry (resident):                 {warm_ms:8.3f} ms  (x{scan_ms / warm_ms:.0f})")
+    assert cached == devices
+
+    # 機器を追加すると/devの更新時刻が変わり，調べ直す
+    free_ports = sorted({1, 2, 3, 4} - set(args.spresense) - set(args.usb_cameras))
+    if free_ports:
+        scans = registry.scans
+        time.sleep(0.01)
+        add_camera(dev_dir, free_ports[0], 2 * len(args.usb_cameras))
+        _, updated = measure(registry.get, 1)
+        _, scanned = measure(usb.get, 1)
+        print(f"after adding a camera on port {free_ports[0]}: rescanned {registry.scans - scans} time(s), "
+              f"{'ok' if updated == scanned else 'MISMATCH'}")
+finally:
+    shutil.rmtree(root, ignore_errors=True)
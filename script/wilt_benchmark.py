@@ -0,0 +1,191 @@
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+
+import util
+import image_processor
+import result_log
+from track_store import TrackStore
+from wilt import run_cycle
+
+# 萎れ指標計算(image_processor)の処理段階ごとの処理時間を計測する
+# 合成画像と合成した1日分の追跡結果を使い，first_detectionとtrackingを実行する
+# --models stubではdetect/pose/DepthAnythingV2の代わりに軽量なスタブを使うため，Pi以外でも追跡処理側の性能劣化を確認できる
+# 実行例: PYTHONPATH=/usr/local/bin/pinode3 python script/wilt_benchmark.py --history 540 --minutes 30
+
+class StubDetect:
+    """
+    明るい領域の外接矩形を葉のbboxとして返す検出モデルのスタブ(inference_backendと同じ推論API)
+    """
+    def detect(self, image, size, conf):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        contours, _ = cv2.findContours((gray > 40).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        boxes = [[x, y, x + w, y + h] for x, y, w, h in map(cv2.boundingRect, contours) if w * h > 200]
+        return np.array(boxes, dtype=float).reshape(-1, 4)
+
+    def detect_batch(self, images, size, conf):
+        return [self.detect(image, size, conf) for image in images]
+
+class StubPose:
+    """
+    切り出し画像の最も明るい画素の範囲から付け根・先端を返すPOSEモデルのスタブ
+    """
+    def keypoints(self, clips, size, conf):
+        keypoints = np.full((len(clips), 2, 2), np.nan)
+        for k, clip in enumerate(clips):
+            # 4画素おきに見る(スタブ自体の処理時間を小さくするため)
+            gray = clip[::4, ::4].max(axis=-1)
+            if gray.max() == 0:
+                continue
+            ys, xs = np.nonzero(gray >= gray.max() * 0.9)
+            keypoints[k] = [[xs.min() * 4, ys.max() * 4], [xs.max() * 4, ys.min() * 4]]
+        return keypoints
+
+class StubDepth:
+    def infer_image(self, image):
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+def leaf_boxes(minute, leaf_num, rng_seed=0):
+    """
+    合成する葉のbbox(時刻とともに少しずつ動く)
+    """
+    rng = np.random.default_rng(rng_seed)
+    position = rng.uniform(100, 850, (leaf_num, 2))
+    size = rng.uniform(40, 100, (leaf_num, 2))
+    k = np.arange(leaf_num)
+    position = position + np.stack([3 * np.sin(minute / 20 + k), 0.05 * minute * (k % 3)], axis=1)
+    return np.concatenate([position, position + size], axis=1)
+
+def make_image(minute, leaf_num):
+    image = np.zeros((1024, 1024, 3), np.uint8)
+    for k, (x1, y1, x2, y2) in enumerate(leaf_boxes(minute, leaf_num).astype(int)):
+        cv2.rectangle(image, (x1, y1), (x2, y2), (60 + 10 * k % 150, 80, 200), -1)
+        # 葉脈の代わりの模様(葉と一緒に動く．オプティカルフローの特徴点になる)
+        for dx, dy in np.random.default_rng(k).uniform(0.1, 0.9, (20, 2)):
+            cv2.circle(image, (int(x1 + dx * (x2 - x1)), int(y1 + dy * (y2 - y1))), 3, (30 + 10 * k % 150, 60, 150), -1)
+        cv2.line(image, (x1 + 3, y2 - 3), (x2 - 3, y1 + 3 + (minute // 10) % 5), (255, 255, 255), 3)
+    return image
+
+def make_history(start_time, rows, leaf_num):
+    """
+    rows分(1日分)の追跡結果を合成する
+    """
+    store = TrackStore()
+    for minute in range(rows):
+        now_time = start_time + timedelta(minutes=minute)
+        for k, (x1, y1, x2, y2) in enumerate(leaf_boxes(minute, leaf_num)):
+            base_x, base_y, tip_x, tip_y = x1 + 3, y2 - 3, x2 - 3, y1 + 3 + (minute // 10) % 5
+            store.set(now_time, k + 1, {
+                "bbox_x1": x1, "bbox_y1": y1, "bbox_x2": x2, "bbox_y2": y2,
+                "bbox_center_x1": (x1 + x2) / 2, "bbox_center_y1": (y1 + y2) / 2,
+                "center_x": (x1 + x2) / 2, "center_y": (y1 + y2) / 2,
+                "base_x": base_x, "base_y": base_y, "tip_x": tip_x, "tip_y": tip_y,
+                "angle": np.arctan2(tip_y - base_y, tip_x - base_x), "length": np.hypot(tip_x - base_x, tip_y - base_y),
+            })
+        for field, value in [("re_detection", 0), ("all_leaf_num", leaf_num), ("now_leaf_num", leaf_num), ("final_wilt", 0)]:
+            store.set_global(now_time, field, value)
+    return store
+
+def summary(name, times):
+    times = np.array(times) * 1000
+    return f"{name:>16}: mean {times.mean():8.2f} ms  p95 {np.percentile(times, 95):8.2f} ms  max {times.max():8.2f} ms"
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--models", choices=["stub", "real"], default="stub", help="stub: スタブモデル, real: config.jsonのモデル")
+parser.add_argument("--history", type=int, default=540, help="合成する追跡結果の行数(分)")
+parser.add_argument("--minutes", type=int, default=30, help="計測するtrackingの回数")
+parser.add_argument("--first", type=int, default=5, help="計測するfirst_detectionの回数")
+parser.add_argument("--leaf-num", type=int, default=15, help="合成画像の葉の数")
+parser.add_argument("--format", choices=["log", "csv"], default="log", help="追跡結果の保存形式")
+parser.add_argument("--work-dir", default=None, help="合成画像と追跡結果の保存先．省略時は一時フォルダ")
+parser.add_argument("--depth-cache", action="store_true", help="first_detectionで深度キャッシュを使う(保存先はwork dir)")
+parser.add_argument("--flow-tracking", action="store_true", help="trackingでオプティカルフローによるbboxの追跡を使う(config.jsonのwilt.flow_trackingに関わらず)")
+parser.add_argument("--missing-every", type=int, default=0, help="trackingのN分に1回画像を読み込めない空のファイルにする(撮影の失敗)．0なら欠落させない")
+args = parser.parse_args()
+
+setting = util.get_pinode_config()
+wilt_config = setting["wilt"]
+if args.models == "stub":
+    stub_models = (StubDetect(), StubPose())
+    image_processor.load_configured_models = lambda wilt_config: stub_models
+    image_processor._depth_models[wilt_config.get("depth_encoder", "vits")] = StubDepth()
+pose_batch = wilt_config.get("pose_batch", True)
+
+work_dir = args.work_dir or tempfile.mkdtemp(prefix="wilt_benchmark_")
+start_time = datetime(2025, 4, 10, 7, 0)
+image_dir = os.path.join(work_dir, start_time.strftime("%Y%m%d"))
+os.makedirs(image_dir, exist_ok=True)
+def is_missing(minute):
+    return args.missing_every > 0 and minute >= args.history and (minute - args.history) % args.missing_every == args.missing_every - 1
+
+for minute in list(range(args.first)) + list(range(args.history, args.history + args.minutes)):
+    file_name = f"{setting['device_id']}_{wilt_config['camera_usb']}_{wilt_config['camera_type']}_{(start_time + timedelta(minutes=minute)).strftime('%Y%m%d-%H%M')}.jpg"
+    if is_missing(minute):
+        # 前の時刻の画像で代わりに処理されないよう，同じ名前の空のファイルを置く
+        open(os.path.join(image_dir, file_name), "wb").close()
+        continue
+    cv2.imwrite(os.path.join(image_dir, file_name), make_image(minute, args.leaf_num))
+print(f"work dir: {work_dir}, models: {args.models}, backend: {wilt_config.get('backend', 'ultralytics')}, pose_batch: {pose_batch}")
+
+def run(store, now_time, first):
+    img_pro = image_processor.image_processor(store, image_dir, now_time)
+    img_pro.pose_batch = pose_batch
+    img_pro.depth_cache = args.depth_cache
+    img_pro.flow_tracking = args.flow_tracking or img_pro.flow_tracking
+    img_pro.depth_cache_dir = os.path.join(work_dir, "depth_cache")
+    if args.models == "stub":
+        img_pro.depth_keep_loaded = True
+    start = time.perf_counter()
+    store = img_pro.first_detection() if first else run_cycle(img_pro, store)
+    img_pro.stage_times["total"] = time.perf_counter() - start
+    return store, img_pro.stage_times
+
+results = {"first_detection": {}, "tracking": {}}
+for minute in range(args.first):
+    _, stage_times = run(TrackStore(), start_time + timedelta(minutes=minute), first=True)
+    for name, elapsed in stage_times.items():
+        results["first_detection"].setdefault(name, []).append(elapsed)
+
+# 1日分の追跡結果を保存してからtrackingを計測する(保存・読込も計測する)
+csv_path = os.path.join(image_dir, result_log.CSV_NAME)
+history = make_history(start_time, args.history, args.leaf_num)
+if args.format == "csv":
+    util.save_csv(history.to_frame(), csv_path)
+else:
+    log = result_log.ResultLog(image_dir)
+    log.store = history
+    log.compact()
+for minute in range(args.history, args.history + args.minutes):
+    now_time = start_time + timedelta(minutes=minute)
+    load_start = time.perf_counter()
+    store = TrackStore.from_frame(util.read_csv(csv_path)) if args.format == "csv" else log.load()
+    load_time = time.perf_counter() - load_start
+
+    store, stage_times = run(store, now_time, first=False)
+
+    save_start = time.perf_counter()
+    if args.format == "csv":
+        util.save_csv(store.to_frame(), csv_path)
+    else:
+        log.append(now_time)
+    stage_times["io_load"] = load_time
+    stage_times["io_save"] = time.perf_counter() - save_start
+    for name, elapsed in stage_times.items():
+        results["tracking"].setdefault(name, []).append(elapsed)
+
+missing_num = sum(is_missing(minute) for minute in range(args.history, args.history + args.minutes))
+if args.format == "log":
+    # 画像が欠落した時刻を含めて，追記したログを読み直すと同じ結果になること
+    reloaded = result_log.ResultLog(image_dir).load().to_frame()
+    print(f"missing images: {missing_num}, rows: {len(store)}, result.log reload: {'ok' if reloaded.equals(store.to_frame()) else 'MISMATCH'}")
+flow_num = int(np.nansum(store.global_column("flow_tracking")[args.history:])) if store.has_global("flow_tracking") else 0
+print(f"leaves: {int(store.global_column('now_leaf_num')[-1])}, re_detection: {int(np.nansum(store.global_column('re_detection')[args.history:]))}, flow tracking: {flow_num} / {args.minutes}, final_wilt: {store.global_column('final_wilt')[-1]:.4f}")
+for method, stages in results.items():
+    print(f"== {method} ({len(stages.get('total', []))} runs) ==")
+    for name, times in stages.items():
+        print(summary(name, times))
@@ -0,0 +1,146 @@
+import argparse
+import os
+import sys
+import warnings
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# PYTHONPATHを指定しない場合はリポジトリのsrcから読み込む(インストール先が無い開発環境でも実行できる)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+from track_store import TrackStore
+from wilt_engine import WiltEngine
+
+# WiltEngineによる逐次計算の結果が，従来の1日分の全再計算(pandas)と一致するかを確認する
+# 欠損・途中から追跡される葉・追跡対象の入れ替わりを含む合成データを1分ずつ処理し，
+# 毎分の葉ごとの萎れ指標とfinal_wiltを比較する
+# 実行例: PYTHONPATH=/usr/local/bin/pinode3 python script/wilt_engine_check.py --minutes 600
+#         python script/wilt_engine_check.py --minutes 600 (リポジトリのsrcを使う)
+
+DETECT_SIZE = 1024
+# 従来の処理は列を1つずつ追加するためPerformanceWarningが大量に出る
+warnings.simplefilter("ignore", pd.errors.PerformanceWarning)
+
+def reference_cal_wilt(df, key_list):
+    """
+    従来のimage_processor.cal_wilt(1日分の全再計算)
+    """
+    for key in key_list:
+        if len(df) < 35 or f"{key}_angle" not in df.columns:
+            df[f"{key}_wilt"] = 0
+            continue
+        lookback_index = df.index[-30] if len(df) > 30 else df.index[0]
+        leaf_length = df[f"{key}_length"].mean()
+        try:
+            if np.isnan(df[f"{key}_angle"].dropna().loc[lookback_index]):
+                df[f"{key}_wilt"] = 0
+                continue
+            if np.pi / 2 <= df[f"{key}_angle"].loc[lookback_index] <= 3 * np.pi / 2:
+                df[f"{key}_angle_diff"] = df[f"{key}_angle"].dropna().loc[lookback_index] - df[f"{key}_angle"]
+            else:
+                df[f"{key}_angle_diff"] = df[f"{key}_angle"] - df[f"{key}_angle"].dropna().loc[lookback_index]
+            df[f"{key}_sin"] = np.sin(df[f"{key}_angle_diff"]) * -1
+            df[f"{key}_center_diff"] = (DETECT_SIZE - df[f"{key}_center_y"]) - (DETECT_SIZE - df[f"{key}_center_y"].dropna().loc[lookback_index])
+            df[f"{key}_std_center_diff"] = df[f"{key}_center_diff"] / leaf_length
+            df[f"{key}_wilt"] = df[f"{key}_sin"] + df[f"{key}_std_center_diff"]
+            df[f"{key}_wilt"] = df[f"{key}_wilt"].rolling(5).mean().interpolate()
+        except KeyError:
+            df[f"{key}_wilt"] = 0
+    return df
+
+def reference_cal_final_wilt(df, key_list, top_n=None):
+    """
+    従来のimage_processor.cal_final_wilt(1日分の全再計算)
+    """
+    if len(df) < 35:
+        return 0, []
+    candidates = []
+    for key in key_list:
+        wilt_series = df[f"{key}_wilt"].dropna()
+        angle_series = df[f"{key}_angle"].dropna()
+        tracking_time = len(wilt_series[wilt_series != 0])
+        if tracking_time < 10 or len(angle_series) < 5:
+            continue
+        std_diff = angle_series.diff().dropna().std()
+        if std_diff == 0 or np.isnan(std_diff):
+            continue
+        candidates.append((key, tracking_time, 1 / std_diff))
+    if len(candidates) == 0:
+        return 0, []
+    candidates.sort(key=lambda x: (x[1], x[2]), reverse=True)
+    top_keys = candidates if top_n is None else candidates[:top_n]
+    max_tracking = max([t for _, t, _ in top_keys])
+    max_smoothness = max([s for _, _, s in top_keys])
+    weighted_wilts = []
+    total_weight = 0
+    for key, tracking_time, smoothness in top_keys:
+        weight = (tracking_time / max_tracking + smoothness / max_smoothness) / 2
+        weighted_wilts.append(df[f"{key}_wilt"].fillna(0) * weight)
+        total_weight += weight
+    return (sum(weighted_wilts) / total_weight).iloc[-1], [key for key, _, _ in top_keys]
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--minutes", type=int, default=600, help="処理する分数")
+parser.add_argument("--leaf-num", type=int, default=12, help="葉の数")
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+rng = np.random.default_rng(args.seed)
+day = datetime(2025, 4, 10, 7, 0)
+# 葉ごとの出現時刻と，角度・中心座標・長さのランダムウォーク
+appear = rng.integers(0, args.minutes // 2, args.leaf_num)
+appear[:args.leaf_num // 2] = 0
+angle = rng.uniform(0, 2 * np.pi, args.leaf_num)
+center_y = rng.uniform(100, 900, args.leaf_num)
+length = rng.uniform(40, 150, args.leaf_num)
+
+df = pd.DataFrame()
+store = TrackStore()
+max_error = 0
+nonzero = 0
+for m in range(args.minutes):
+    now_time = day + timedelta(minutes=m)
+    angle += rng.normal(0, 0.01, args.leaf_num)
+    center_y += rng.normal(0, 0.5, args.leaf_num)
+    # 途中で見失う葉や，一時的に欠損する値
+    key_list = [key for key in range(1, args.leaf_num + 1) if appear[key - 1] <= m and not (m // 60 + key) % 7 == 0]
+    row = store.row(now_time)
+    df.loc[now_time, "now_leaf_num"] = len(key_list)
+    for key in key_list:
+        values = {"bbox_x1": 0.0, "center_y": center_y[key - 1], "angle": angle[key - 1], "length": length[key - 1] + rng.normal(0, 3)}
+        if rng.random() < 0.05:
+            values["angle"] = np.nan
+        if rng.random() < 0.03:
+            values["center_y"] = np.nan
+        for field, value in values.items():
+            df.loc[now_time, f"{key}_{field}"] = value
+        store.set(now_time, key, values)
+
+    # 従来の全再計算
+    df = reference_cal_wilt(df, key_list)
+    expected, expected_keys = reference_cal_final_wilt(df, key_list)
+
+    # 逐次計算(image_processor.cal_wilt/cal_final_wiltと同じ手順)
+    engine = store.wilt_engine
+    if engine is None or engine.rows != row:
+        engine = store.wilt_engine = WiltEngine.from_store(store, rows=row, detect_size=DETECT_SIZE)
+    for key in store.leaf_ids():
+        engine.update(row, key, *[store.column(key, field)[row] if store.has(key, field) else np.nan for field in ["angle", "center_y", "length"]])
+    wilts = {}
+    for key in key_list:
+        result = engine.cal_wilt(key, store.column(key, "angle")[row], store.column(key, "center_y")[row])
+        wilts[key] = result["wilt"]
+        assert np.isclose(result["wilt"], df[f"{key}_wilt"].iloc[-1], rtol=1e-9, atol=1e-12, equal_nan=True), (now_time, key, result["wilt"], df[f"{key}_wilt"].iloc[-1])
+    actual, actual_keys = engine.cal_final_wilt(wilts)
+    assert np.isclose(actual, expected, rtol=1e-9, atol=1e-12), (now_time, actual, expected)
+    assert actual_keys == expected_keys, (now_time, actual_keys, expected_keys)
+    max_error = max(max_error, abs(actual - expected))
+    nonzero += actual != 0
+
+    # 保存・再読込(wilt.pyの1分毎の処理)を模擬して，保存済みの行から状態を作り直す場合も確認する
+    if m % 97 == 0:
+        store = TrackStore.from_frame(store.to_frame())
+
+print(f"{args.minutes} minutes, {args.leaf_num} leaves: OK ({nonzero} minutes with final_wilt != 0, max error {max_error:.2e})")
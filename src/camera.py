@@ -1,46 +1,194 @@
 import cv2
+import heapq
 import timeout_decorator
 import subprocess
+import threading
 import time
-from cobs import cobs
-import serial
 import json
 import datetime as dt
 
 from pathlib import Path
 
 from usb import USB
+from usb_registry import UsbRegistry
+from spresense_session import SpresenseSession
+from camera_stream import CameraStream, frame_to_jpeg
 import util
+from cobs_reader import CobsFrameReader
+import frame_ring
+from image_writer import writer
+from wilt import SOCKET_PATH, upload
 
 class Camera:
     """
     カメラ撮影を行うためのクラス
+
+    Args:
+        sessions (SpresenseSessions): 常駐する撮影プロセスでSPRESENSEのポートを開いたままにする場合に指定する
+        streams (CameraStreams): 常駐する撮影プロセスでUSBカメラを開いたままにする場合に指定する
+        registry (UsbRegistry): USBポートと機器の対応のキャッシュ.Noneならcamera.usb_cache_pathに保存した対応を使う
     """
-    def __init__(self):
+    # 前回の撮影が終わっていないポートと，その撮影のスレッド({port: thread})
+    busy = {}
+    busy_lock = threading.Lock()
+
+    def __init__(self, sessions=None, streams=None, registry=None):
         self.config = util.get_pinode_config()
+        self.sessions = sessions
+        self.streams = streams
+        self.registry = registry or UsbRegistry(self.config['camera'].get('usb_cache_path') or None)
+        # wilt_serverが共有メモリを作成していれば，萎れ指標計算用カメラの画像をファイルを経由せずに渡す
+        self.frame_ring = None
+        if self.config["wilt"].get("frame_ring", False):
+            self.frame_ring = frame_ring.FrameRing.attach(self.config["wilt"].get("frame_ring_name", frame_ring.RING_NAME))
+
+    def _handoff(self, file_name):
+        """
+        萎れ指標計算用カメラの画像であれば，共有メモリに書き込んでwilt_serverに通知する関数を返す
+
+        Args:
+            file_name (str): 保存するファイル名
+
+        Returns:
+            handoff (function): handoff(jpeg=..., frame=...)で画像を渡す関数．対象外の場合はNone
+        """
+        wilt_config = self.config["wilt"]
+        name = Path(file_name).name
+        prefixes = tuple(f"{self.config['device_id']}_{camera['camera_usb']}_{camera['camera_type']}_" for camera in util.get_wilt_cameras(wilt_config))
+        if self.frame_ring is None or not name.startswith(prefixes):
+            return None
+
+        def handoff(jpeg=None, frame=None):
+            if frame is not None:
+                # 検出サイズにリサイズしてから渡す(wilt_serverでのリサイズを省略する)
+                frame = cv2.resize(frame, (wilt_config["image_width"], wilt_config["image_height"]))
+            seq = self.frame_ring.publish(name, jpeg=jpeg, frame=frame)
+            if seq is not None:
+                print("frame handoff:", frame_ring.notify(seq, wilt_config.get("socket_path", SOCKET_PATH)))
+        return handoff
 
     def save_images(self):
         """
         デバイスに応じたカメラ撮影を行うメソッド.ポート番号,PinodeのデバイスID,時刻をファイル名としてSPRESENSEとUSBカメラで撮影した画像を保存する
         
+        Returns:
+            summary (dict): ポートごとの撮影結果({port: {"type": 機器, "status": ok/failed/error/timeout/busy, "elapsed": 秒}})
+
         Attributes:
             devices: (port,identify,name)
             port(int): USB接続している機器のポート番号
             identify(str): ポート番号に対するデバイス名(SPRESENSE or USB Camera)
             name (int): (SPRESENSEの場合)接続ポート番号ごとのデバイスファイルパス
                  (str): (USB Cameraの場合)デバイスID 
-                          
+
+        Notes:
+            ポートごとに1つのスレッドで同時に撮影する(SPRESENSEのシリアル転送とUSBカメラの読込を重ねる).
+            ファイル名の時刻は全てのポートで撮影開始時の時刻にそろえる
+
+            ポートごとにcamera.time_outの秒数(SPRESENSEはsave内で再試行するためmax_retry_count倍)まで待ち,
+            終わらないポートはtimeoutとする.ただし待つのは次の分の0秒の1秒前までとし(毎分の撮影を遅らせないため),
+            それまでに終わらないSPRESENSEの再試行はrunningとしてバックグラウンドで続ける.
+            そのスレッドが終わるまでは,次の撮影でそのポートをbusyとして飛ばす(wait_busyで終了を待てる)
+
+            撮影に失敗したポートがあれば,USBポートと機器の対応を次回調べ直す(デバイスファイルが変わった場合のため)
         """
+        start_time = time.perf_counter()
+        now = dt.datetime.now()
         # now_dateは20250409のような形
-        now_date = dt.datetime.now().strftime('%Y%m%d')
-        devices = USB().get()
+        now_date = now.strftime('%Y%m%d')
+        now_time = now.strftime('%Y%m%d-%H%M')
+        # 次の分の撮影を始めるまでに結果をまとめる
+        minute_left = 60 - now.second - now.microsecond / 1e6 - 1
+        time_out = self.config['camera'].get('time_out', {})
+        retry_count = self.config['camera'].get('max_retry_count', {})
+        devices = self.registry.get()
+        if self.sessions is not None:
+            # 取り外されたSPRESENSEのポートを閉じる
+            self.sessions.retain([name for port, type, name in devices if type == 'SPRESENSE'])
+        if self.streams is not None:
+            self.streams.retain([name for port, type, name in devices if type == 'USB Camera'])
+
+        summary = {}
+        workers = {}
         for port, type, name in devices:
+            with Camera.busy_lock:
+                if port in Camera.busy:
+                    print(f"port {port} is still capturing, skip")
+                    summary[port] = {"type": type, "status": "busy", "elapsed": 0.0}
+                    continue
             if type == 'SPRESENSE':
-                file_name = "image{:1}/{}/{}_{:02}_HDR_{}.jpg".format(port, now_date, self.config['device_id'], port, dt.datetime.now().strftime('%Y%m%d-%H%M'))
-                SPRESENSE(name).save(file_name)
-            elif type == 'USB Camera':
-                file_name = "image{:1}/{}/{}_{:02}_RGB_{}.jpg".format(port, now_date, self.config['device_id'], port, dt.datetime.now().strftime('%Y%m%d-%H%M'))
-                UsbCamera(name).save(file_name)
+                file_name = "image{:1}/{}/{}_{:02}_HDR_{}.jpg".format(port, now_date, self.config['device_id'], port, now_time)
+                session = self.sessions.get(name) if self.sessions is not None else None
+                device = SPRESENSE(name, session)
+                timeout = time_out.get('SPRESENSE', 50) * retry_count.get('SPRESENSE', 3)
+            else:
+                file_name = "image{:1}/{}/{}_{:02}_RGB_{}.jpg".format(port, now_date, self.config['device_id'], port, now_time)
+                stream = self.streams.get(name) if self.streams is not None else None
+                timeout = time_out.get('usb_camera', 20)
+                device = UsbCamera(name, stream, timeout)
+            result = {"type": type, "status": "timeout", "elapsed": timeout}
+            thread = threading.Thread(target=self._capture, args=(port, device, file_name, result), daemon=True)
+            with Camera.busy_lock:
+                Camera.busy[port] = thread
+            thread.start()
+            workers[port] = (thread, timeout, result)
+
+        for port, (thread, timeout, result) in workers.items():
+            thread.join(max(min(timeout, minute_left) - (time.perf_counter() - start_time), 0))
+            if not thread.is_alive():
+                summary[port] = dict(result)
+            elif time.perf_counter() - start_time < timeout:
+                summary[port] = {"type": result["type"], "status": "running", "elapsed": time.perf_counter() - start_time}
+            else:
+                summary[port] = {"type": result["type"], "status": "timeout", "elapsed": timeout}
+
+        if any(result["status"] in ("failed", "error") for result in summary.values()):
+            self.registry.invalidate()
+        total = time.perf_counter() - start_time
+        print(f"capture {now_time}: {total:.1f}s, " + ", ".join(f"port {port} {r['type']} {r['status']} {r['elapsed']:.1f}s" for port, r in sorted(summary.items())))
+        threading.Thread(target=self._upload_summary, args=(now.replace(second=0, microsecond=0), summary)).start()
+        return summary
+
+    def _capture(self, port, device, file_name, result):
+        """
+        1ポート分の撮影(save_imagesのスレッド).結果と時間をresultに書き込む
+        """
+        start_time = time.perf_counter()
+        try:
+            result["status"] = "ok" if device.save(file_name, self._handoff(file_name)) else "failed"
+        except Exception as e:
+            print(f"port {port}: {e}")
+            result["status"] = "error"
+        finally:
+            result["elapsed"] = time.perf_counter() - start_time
+            with Camera.busy_lock:
+                Camera.busy.pop(port, None)
+
+    @classmethod
+    def wait_busy(cls, timeout=None):
+        """
+        バックグラウンドで続いている撮影(busyのポート)が終わるまで最大timeout秒待つ
+
+        Returns:
+            done (bool): 全ての撮影が終わった場合はTrue
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        with cls.busy_lock:
+            threads = list(cls.busy.values())
+        for thread in threads:
+            thread.join(None if deadline is None else max(deadline - time.perf_counter(), 0))
+        return not any(thread.is_alive() for thread in threads)
+
+    def _upload_summary(self, now_time, summary):
+        """
+        ポートごとの撮影時間と成否をInfluxDBに書き込む(capture_time, capture_ok, cameraタグはポート番号)
+        """
+        for port, result in summary.items():
+            # 前回から続いている撮影と,まだ終わっていない撮影は結果が決まっていない
+            if result["status"] in ("busy", "running"):
+                continue
+            fields = {"capture_time": result["elapsed"], "capture_ok": int(result["status"] == "ok")}
+            upload(self.config["device_id"], now_time, fields, {"camera": f"{port:02}"})
 
 class SPRESENSE:
     """
@@ -48,6 +196,7 @@ class SPRESENSE:
         
     Args:
         port_num(str): 接続ポート番号ごとのデバイスファイルパス
+        session(SpresenseSession): 撮影の間も開いたままにするシリアル接続.Noneなら撮影ごとにポートを開いて閉じる
             
     Notes:
         BAUD_RATE(int): SPRESENSE Main Boardとの通信のためのボーレート
@@ -61,6 +210,10 @@ class SPRESENSE:
         TYPE_FINISH(int): SPRESENSEから送られてきたパケットのタイプ(送信終了データ)
         
         TYPE_ERROR(int): SPRESENSEから送られてきたパケットのタイプ(エラーデータ)
+
+        RESEND_BATCH(int): 1回にまとめて再送を要求するパケット数
+
+        RESEND_TIMEOUT(float): 再送を要求したパケットが届かない場合に再度要求するまでの時間(秒)
     """
     BAUD_RATE   = 115200  
     BUFF_SIZE   = 100  
@@ -68,17 +221,23 @@ class SPRESENSE:
     TYPE_IMAGE  = 1
     TYPE_FINISH = 2
     TYPE_ERROR  = 3
+    # 1回にまとめて再送を要求するパケット数と,届かない場合に再度要求するまでの時間(秒)
+    RESEND_BATCH   = 32
+    RESEND_TIMEOUT = 1.0
 
-    def __init__(self, port_num):
+    def __init__(self, port_num, session=None):
         self.port_num = port_num
         self.config = util.get_pinode_config()
+        self.session = session
 
-    def save(self, file_name):
+    def save(self, file_name, handoff=None):
         """
         SPRESENSEから受け取ったバイナリ画像を保存する
         
         Args:
             file_name (str): 保存するファイル名
+            handoff (function): 画像を共有メモリでwilt_serverに渡す関数．指定した場合はファイル保存より先に渡し，
+                ファイルへの書き込み(とscpでの送信)はImageWriterのスレッドで行う
         
         Returns:    
             True (bool): データ保存が正常に終了
@@ -87,38 +246,72 @@ class SPRESENSE:
         Notes:
             ・3回実行を行いエラーが発生した場合は終了する
             
-            ・シリアル通信の接続に時間がかかるため2秒間sleep
+            ・シリアル通信の接続に時間がかかるため,ポートを開いた直後のみ2秒間(camera.spresense_settle)sleep.
+              sessionを指定した場合は開いたままのポートを使い,sleepしない
             
-            ・エラーが発生した場合再起動
+            ・エラーが発生した場合ポートを閉じ,このSPRESENSEのみ再起動
 
         """
         self.local_file_path = Path(self.config['camera']['image_dir']) / file_name
         self.local_file_path.parent.mkdir(parents=True, exist_ok=True)
 
+        session = self.session or SpresenseSession(self.port_num, self.BAUD_RATE, self.config['camera'].get('spresense_settle', 2))
         for i in range(3):
             try:
-                with serial.Serial(self.port_num, self.BAUD_RATE, timeout=3) as ser:
-                    time.sleep(2)
-                    img = self._get_image_data(ser)
+                try:
+                    ser, opened = session.acquire()
+                    img, stats = self._get_image_data(ser)
+                finally:
+                    if self.session is None:
+                        session.close()
+                send = self._send_and_remove if self.config['copy_folder']['realtime_send'] else None
+                if handoff is not None:
+                    jpeg = bytes(img)
+                    handoff(jpeg=jpeg)
+                    writer.write(self.local_file_path, jpeg=jpeg, done=send)
+                else:
                     print(f"save image : {self.local_file_path}")
                     with open(self.local_file_path, "wb") as f:
                         f.write(img)
-
-                # 転送と削除
-                if self.config['copy_folder']['realtime_send']:
-                    if self._send_scp():
-                        print(f"sent and removed: {self.local_file_path}")
-                        self.local_file_path.unlink()
-                    else:
-                        print("scp failed, keeping local file")
-
+                    if send is not None:
+                        send()
+                print(f"transfer: {stats['packets']} packets, {stats['retransmits']} retransmits, {stats['bytes_per_sec']:.0f} B/s, {stats['elapsed']:.1f}s")
+                self._upload_stats(file_name, {**stats, "ok": 1, "attempt": i + 1, "opened": int(opened)})
                 return True
             except Exception as e:
                 print(e)
+                self._upload_stats(file_name, {"ok": 0, "attempt": i + 1})
+                session.close()
                 self._reboot()
         print("failed to get image")
         return False
 
+    def _upload_stats(self, file_name, stats):
+        """
+        画像転送の統計をInfluxDBに書き込む(ケーブルやポートの不良を確認するため)
+
+        Args:
+            file_name (str): 保存するファイル名(USBポート番号をcameraタグにする)
+            stats (dict): _get_image_dataの統計と,ok(成功なら1), attempt(何回目の試行か), opened(ポートを開き直したなら1)
+
+        Notes:
+            フィールド名は"spresense_{統計名}"とする
+        """
+        port = Path(file_name).name.split("_")[1]
+        fields = {f"spresense_{name}": value for name, value in stats.items()}
+        # InfluxDBに接続できない場合に次のカメラの撮影を待たせないよう，別のスレッドで書き込む
+        threading.Thread(target=upload, args=(self.config["device_id"], dt.datetime.now().replace(second=0, microsecond=0), fields, {"camera": port})).start()
+
+    def _send_and_remove(self):
+        """
+        保存済みの画像をリモートサーバに送信し，送信できたらローカルのファイルを削除する
+        """
+        if self._send_scp():
+            print(f"sent and removed: {self.local_file_path}")
+            self.local_file_path.unlink()
+        else:
+            print("scp failed, keeping local file")
+
     def _send_scp(self):
         """
         保存済みの画像をリモートサーバにscpで送信する（コマンドはフルパス指定）
@@ -153,30 +346,28 @@ class SPRESENSE:
 
     def _reboot(self):
         """Function
-        USB機器の電源供給を一度切り再び入れる
+        このSPRESENSEのUSB機器の電源供給を一度切り再び入れる(同じハブの他のカメラはリセットしない)
         """
-        subprocess.call("sudo sh -c \"echo -n \"1-1\" > /sys/bus/usb/drivers/usb/unbind\"", shell=True)
-        time.sleep(1)
-        subprocess.call("sudo sh -c \"echo -n \"1-1\" > /sys/bus/usb/drivers/usb/bind\"", shell=True)
+        print("usb reset:", USB().reset(self.port_num))
         time.sleep(5)
 
-    def _get_packet(self, ser):
+    def _get_packet(self, reader):
         """Function
         接続しているシリアルポートから1パケット分データの受信を行う
         
         Args:
-            ser (serial.Serial):
+            reader (CobsFrameReader): 接続しているシリアルのパケット読込
 
         Returns:
-            [decoded[0],index,decoded[5:]] :list (int,int,bytearray)
+            [decoded[0],index,decoded[5:]] :list (int,int,memoryview)
             
         Attributes:
             index (int): decodedは最初の4桁がインデックス番号.4桁の数値をint型に変換し画像インデックスとして使用
             decoded[0] (int): SPRESENSEから送られてきたパケットのタイプ(画像データ)
-            decoded[5:](bytearray): 画像データ本体
+            decoded[5:](memoryview): 画像データ本体(次のパケットの受信で上書きされる)
 
         Notes:
-            1バイトずつシリアル通信で画像を取得しパケット終了文字x00が来るまでデータを受け取る. その後,cobs.decodeで終了文字列を画像に対応するものに戻す
+            受信済みのデータをまとめて読み込み,パケット終了文字x00で区切る. その後,COBSを復号して終了文字列を画像に対応するものに戻す
 
             [参考]シリアル通信で受け取る正常な画像データは以下のような構造を持つ
                 
@@ -200,13 +391,7 @@ class SPRESENSE:
     
         """
         try:
-            img = b''
-            while True:
-                val = ser.read()
-                if val == b'\x00':
-                    break
-                img += val
-            decoded = cobs.decode(img)
+            decoded = reader.read_frame()
             index = int(decoded[1]) * 1000 + int(decoded[2]) * 100 + int(decoded[3]) * 10 + int(decoded[4])
             return decoded[0], index, decoded[5:]
         except Exception as e:
@@ -251,19 +436,20 @@ class SPRESENSE:
         """
         ser.write(str.encode('E\n'))
 
-    def _send_request_resend(self, ser, index):
+    def _send_request_resend(self, ser, indexes):
         """
         画像の再送を要求するパケットをSPRESENSEに送信する
         
         Args:
             ser (serial.Serial): 接続しているシリアル
-            index (int): 再送するインデックス番号
+            indexes (list[int]): 再送するインデックス番号
         
         Notes:
-            "R"+index番号をSPRESENSEに送信するとインデックス番号に対応するデータを再送してくれる
+            "R"+index番号をSPRESENSEに送信するとインデックス番号に対応するデータを再送してくれる.
+            複数のインデックスの要求は1行ずつ連結し,1回で書き込む
         
         """
-        ser.write(str.encode(f'R{index}\n'))
+        ser.write("".join(f'R{index}\n' for index in indexes).encode())
 
     @timeout_decorator.timeout(50, use_signals=False)
     def _get_image_data(self, ser):
@@ -274,69 +460,89 @@ class SPRESENSE:
             ser (serial.Serial): 接続しているシリアル
 
         Returns:
-            img (bytearray): すべての画像データ
+            (img, stats) (tuple): すべての画像データ(bytearray)と転送の統計(dict)
             
         Attributes:
             img (bytearray): 送信されたバイナリ画像データ.  size = 最大index値 * BUFF_SIZE(100)
-            resend_index_list (list[int]): 再送してほしいインデックスのリスト
-            finish_flag (list[bool]): データ受信完了時にSPRESENSEに終了信号を送信するために使用
-            send_flg (list[bool]): 正常に受信できたかを管理するリスト,すべてFalseとして初期化され,正常受信でTrueに変更
+            missing (set[int]): まだ正常に受信できていないインデックスの集合.TYPE_INFOで全てのインデックスとして初期化され,正常受信で削除
+            requested (set[int]): 最後にまとめて再送を要求したインデックス
+            finish_flag (bool): データ受信完了時にSPRESENSEに終了信号を送信するために使用
+            stats (dict): packets(受信したパケット数), retransmits(再送を要求した数), corrupt(サイズが不正なパケット数),
+                errors(復号できなかったパケット数), bytes, elapsed(秒), bytes_per_sec
         
         Notes:
             各信号とその信号を受け取った際の実施事項
                 
                 TYPE_INFO: 画像が撮影時に一番最初に送られる信号
-                    この信号を受け取った後,以下の要素を初期化: img,max_index,sendflg
+                    この信号を受け取った後,以下の要素を初期化: img,max_index,missing
                 
                 TYPE_IMAGE: データが画像であった場合に送られる信号
-                    正常な受信が行われたため,imgにデータを追加し,send_flgを書き換える
+                    正常な受信が行われたため,imgにデータを追加し,missingから削除する
                 
                 TYPE_FINISH: 最後の画像データの場合に送られる信号
                     正常な受信が行われたため,imgにデータを追加し,finish_flgを書き換える
                 
                 TYPE_ERROR: データ受信に問題があった場合に送られる信号
         
-            finish_flagがTrueの場合: send_flagがFalseであるもの,resend_index_listに含まれているものに対して再送命令. 
+            finish_flagがTrueの場合: missingのうちインデックスの小さいものからRESEND_BATCH個の再送命令をまとめて送信する.
+            要求した全てのデータが届くか,RESEND_TIMEOUT秒経っても届かない場合に次の再送命令を送信する(同じインデックスを連続して要求しない).
             すべてのデータが完全に送られるまでWhile分のループを実行
         """
-        img = b''
-        resend_index_list = []
+        img = bytearray()
+        max_index = 0
+        missing = set()
+        requested = set()
+        request_time = 0
         finish_flag = False
-        send_flg = []
+        stats = {"packets": 0, "retransmits": 0, "corrupt": 0, "errors": 0}
+        start_time = time.perf_counter()
 
+        reader = CobsFrameReader(ser)
         self._send_request_image(ser)
 
         while True:
-            code, index, data = self._get_packet(ser)
+            code, index, data = self._get_packet(reader)
 
             if code == self.TYPE_INFO:
                 img = bytearray(index * self.BUFF_SIZE)
                 max_index = index
-                send_flg = [False] * max_index
+                missing = set(range(max_index))
+                requested = set()
             elif code == self.TYPE_IMAGE:
-                if self._check_packet(data):
+                stats["packets"] += 1
+                if not 0 <= index < max_index:
+                    stats["errors"] += 1
+                elif self._check_packet(data):
                     img[index*self.BUFF_SIZE:(index+1)*self.BUFF_SIZE] = data
-                    send_flg[index] = True
-                    if index in resend_index_list:
-                        resend_index_list.remove(index)
+                    missing.discard(index)
                 else:
-                    resend_index_list.append(index)
+                    # 次の再送命令ですぐに要求し直す
+                    stats["corrupt"] += 1
+                    requested.discard(index)
             elif code == self.TYPE_FINISH:
-                img += data
+                stats["packets"] += 1
+                if not finish_flag:
+                    img += data
                 finish_flag = True
             elif code == self.TYPE_ERROR:
+                stats["errors"] += 1
                 print('cant get data')
 
             if finish_flag:
-                if False in send_flg:
-                    print("resend", send_flg.index(False))
-                    self._send_request_resend(ser, send_flg.index(False))
-                for index in resend_index_list:
-                    self._send_request_resend(ser, index)
-                if (len(resend_index_list) == 0) and (not (False in send_flg)):
+                if not missing:
                     self._send_complete_image(ser)
                     break
-        return img
+                if not (requested & missing) or time.perf_counter() - request_time > self.RESEND_TIMEOUT:
+                    requested = set(heapq.nsmallest(self.RESEND_BATCH, missing))
+                    print("resend", len(requested), "packets from", min(requested))
+                    self._send_request_resend(ser, sorted(requested))
+                    request_time = time.perf_counter()
+                    stats["retransmits"] += len(requested)
+
+        stats["bytes"] = len(img)
+        stats["elapsed"] = time.perf_counter() - start_time
+        stats["bytes_per_sec"] = len(img) / stats["elapsed"]
+        return img, stats
 
 class UsbCamera:
     """
@@ -344,19 +550,24 @@ class UsbCamera:
     
     Args:
         device_name (int): デバイスID(カメラインデックス)
+        stream (CameraStream): 開いたままのカメラの読込.Noneなら撮影ごとにカメラを開く
+        timeout (float): 撮影のタイムアウト(秒)
     """
-    def __init__(self, device_name):
+    def __init__(self, device_name, stream=None, timeout=20):
         
         self.config = util.get_pinode_config()
         self.device_name = device_name
+        self.stream = stream
+        self.timeout = timeout
     
-    @timeout_decorator.timeout(20)
-    def save(self, file_name):
+    def save(self, file_name, handoff=None):
         """
-        USBカメラで撮影した写真の保存. 20秒のタイムアウト設定
+        USBカメラで撮影した写真の保存. timeout秒(camera.time_out.usb_camera)のタイムアウト設定
 
         Args:
             filename (str): 保存ファイル名
+            handoff (function): 画像を共有メモリでwilt_serverに渡す関数．指定した場合はファイル保存より先に渡し，
+                ファイルへの書き込みはImageWriterのスレッドで行う
         
         Returns:
             True (bool)
@@ -366,19 +577,80 @@ class UsbCamera:
             カメラ読み込みを50回実行
                 (理由)撮影が始まってすぐの段階ではカメラ補正がうまく働かず適切な写真を取得できない.
                 回数を繰り返すことで適切な画像取得が可能. (Timeoutも試したがうまく動作せず)
+
+            読み込みはCameraStreamのスレッドで行い,timeout秒までに50枚目が読めなければ失敗とする.
+            その場合もread()は一定時間で戻るため,読込スレッドは終わりカメラを閉じる(撮影のスレッドが残り続けない)
+
+            streamを指定した場合は,補正済みの最新の画像をすぐに使う(開いた直後は補正が済むまで最大timeout秒待つ)
+
+            camera.usb_mjpegがtrueの場合はカメラのMJPGのデータをそのままファイルに書き込み,復号と再符号化を行わない.
+            wilt_serverには画像をJPEGのまま渡し,萎れ指標計算で必要になった時点で復号する.
+            カメラがMJPGに対応していない場合は従来通り符号化して保存する
+
+            撮影にかかった時間とCPU時間(この撮影のスレッド分)を表示し,InfluxDBに書き込む
         """
-        cap = cv2.VideoCapture(self.device_name, cv2.CAP_V4L)
-        for _ in range(50):
-            ret, frame = cap.read()
-        if not ret:
+        camera_config = self.config['camera']
+        mjpeg = camera_config.get('usb_mjpeg', False)
+        start_time = time.perf_counter()
+        cpu_start = time.thread_time()
+        stream = self.stream
+        if stream is None:
+            stream = CameraStream(self.device_name, None, 50, mjpeg, camera_config.get('usb_width', 0), camera_config.get('usb_height', 0)).start()
+        try:
+            frame = stream.latest(timeout=self.timeout)
+        finally:
+            if self.stream is None:
+                # 読込スレッドの終了は待たない(応答しないカメラでもread()が戻った時点で閉じる)
+                stream.stop(timeout=0)
+        if frame is None:
+            print(f"camera {self.device_name} is not ready")
             return False
+        jpeg = frame_to_jpeg(frame) if mjpeg else None
+        if jpeg is None and frame.ndim != 3:
+            # JPEGでない未変換のバッファは,復号できなければ保存しない
+            frame = cv2.imdecode(frame.reshape(-1), cv2.IMREAD_COLOR)
+            if frame is None:
+                print(f"camera {self.device_name} returned an undecodable frame")
+                return False
+        if handoff is not None:
+            if jpeg is not None:
+                handoff(jpeg=jpeg)
+            else:
+                handoff(frame=frame)
 
         self.local_file_path = str(Path(self.config['camera']['image_dir']) / Path(file_name))
-        Path(self.local_file_path).parent.mkdir(parents=True, exist_ok=True)
-        print(f"save image : {self.local_file_path}")
-        cv2.imwrite(self.local_file_path, frame)
+        if handoff is not None:
+            # wilt_serverには渡し済みのため，書き込みを待たない
+            writer.write(self.local_file_path, jpeg=jpeg, frame=frame)
+        else:
+            Path(self.local_file_path).parent.mkdir(parents=True, exist_ok=True)
+            print(f"save image : {self.local_file_path}")
+            if jpeg is not None:
+                with open(self.local_file_path, "wb") as f:
+                    f.write(jpeg)
+            else:
+                cv2.imwrite(self.local_file_path, frame)
+
+        stats = {"time": time.perf_counter() - start_time, "cpu": time.thread_time() - cpu_start, "mjpeg": int(jpeg is not None)}
+        if self.stream is not None and self.stream.read_frames:
+            # 読込スレッドでの1枚あたりのCPU時間(MJPGなら復号しない分小さくなる)
+            stats["stream_cpu"] = self.stream.read_cpu / self.stream.read_frames
+        print(f"capture: {stats['time']:.2f}s, cpu {stats['cpu']:.3f}s, mjpeg {stats['mjpeg']}")
+        self._upload_stats(file_name, stats)
         return True
 
+    def _upload_stats(self, file_name, stats):
+        """
+        撮影の時間とCPU時間をInfluxDBに書き込む(フィールド名は"usb_camera_{統計名}")
+
+        Args:
+            file_name (str): 保存するファイル名(USBポート番号をcameraタグにする)
+            stats (dict): time(秒), cpu(秒), mjpeg(MJPGをそのまま保存したなら1)など
+        """
+        port = Path(file_name).name.split("_")[1]
+        fields = {f"usb_camera_{name}": value for name, value in stats.items()}
+        threading.Thread(target=upload, args=(self.config["device_id"], dt.datetime.now().replace(second=0, microsecond=0), fields, {"camera": port})).start()
+
 if __name__ == "__main__":
     camera = Camera()
     camera.save_images()
\ No newline at end of file
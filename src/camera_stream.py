@@ -0,0 +1,227 @@
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# JPEGのマーカー
+SOI = b"\xff\xd8"
+DHT = b"\xff\xc4"
+SOS = b"\xff\xda"
+
+# 1回のread()で画像を待つ最大の時間(秒)．カメラが応答しない場合もread()が戻り，読込スレッドが終わるようにする
+os.environ.setdefault("OPENCV_VIDEOIO_V4L_SELECT_TIMEOUT", "5")
+
+_standard_dht = None
+
+def standard_dht():
+    """
+    JPEGの標準ハフマンテーブル(DHTセグメント)．OpenCVで小さな画像を符号化して取り出す
+    """
+    global _standard_dht
+    if _standard_dht is None:
+        _, encoded = cv2.imencode(".jpg", np.zeros((8, 8, 3), np.uint8))
+        encoded = encoded.tobytes()
+        segments = []
+        i = len(SOI)
+        while encoded[i:i + 2] != SOS:
+            length = int.from_bytes(encoded[i + 2:i + 4], "big")
+            if encoded[i:i + 2] == DHT:
+                segments.append(encoded[i:i + 2 + length])
+            i += 2 + length
+        _standard_dht = b"".join(segments)
+    return _standard_dht
+
+def open_capture(device_name, mjpeg=False, width=0, height=0):
+    """
+    USBカメラを開く
+
+    Args:
+        device_name (int): デバイスID(カメラインデックス)
+        mjpeg (bool): MJPG形式を要求し，read()で復号しないJPEGのバイト列(shape (1, N)のuint8)を受け取る
+        width (int): 要求する幅．0ならカメラの既定値
+        height (int): 要求する高さ．0ならカメラの既定値
+
+    Notes:
+        カメラがMJPGを受け付けなかった場合(YUYVなど)は，read()で従来通り復号済みのBGRの画像を受け取る
+        (変換を無効にするとYUYVのバッファもそのまま返されるため)
+    """
+    cap = cv2.VideoCapture(device_name, cv2.CAP_V4L)
+    fourcc = cv2.VideoWriter_fourcc(*"MJPG")
+    if mjpeg:
+        cap.set(cv2.CAP_PROP_FOURCC, fourcc)
+    if width and height:
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    if mjpeg:
+        if int(cap.get(cv2.CAP_PROP_FOURCC)) == fourcc:
+            # 0にするとV4L2のバッファをそのまま返す(MJPGの場合は復号しない)
+            cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        else:
+            print(f"camera {device_name} does not accept MJPG, decode frames")
+            cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+    return cap
+
+def frame_to_jpeg(frame):
+    """
+    open_capture(mjpeg=True)で読み込んだ画像をJPEGファイルとして保存できるバイト列にする
+
+    Returns:
+        jpeg (bytes): JPEGのバイト列．復号済みの画像やJPEGでないバッファの場合はNone
+
+    Notes:
+        USBカメラのMJPGはハフマンテーブルを省略していることがあるため，無ければ標準のテーブルを挿入する
+    """
+    if frame.ndim != 2 or frame.shape[0] != 1:
+        return None
+    jpeg = frame.tobytes()
+    if not jpeg.startswith(SOI):
+        return None
+    sos = jpeg.find(SOS)
+    if sos >= 0 and jpeg.find(DHT, 0, sos) < 0:
+        jpeg = jpeg[:sos] + standard_dht() + jpeg[sos:]
+    return jpeg
+
+class CameraStream:
+    """
+    USBカメラを開いたままにし，別のスレッドで読み込んだ最新の画像のみを保持するクラス
+
+    Args:
+        device_name (int): デバイスID(カメラインデックス)
+        fps (float): 撮影の間に画像を読み込む頻度(カメラにも同じフレームレートを要求する)．Noneなら落とさずに読み込み続ける
+        warmup_frames (int): 開いた直後に読み捨てる画像の数(露出の補正が安定するまで)
+        mjpeg (bool): 復号しないJPEGのバイト列を保持する(open_capture)
+        width (int): 要求する幅．0ならカメラの既定値
+        height (int): 要求する高さ．0ならカメラの既定値
+
+    Notes:
+        開いた直後はwarmup_frames枚を待たずに読み込み，その後はfps毎秒に落として読み込み続ける
+        (露出の補正を保ったまま，USBの帯域とCPUを節約する)．
+        latest()は補正済みの最新の画像をすぐに返す
+
+        読込に失敗した場合(取り外しなど)はカメラを閉じ，1秒後に開き直す．1回のread()は
+        OPENCV_VIDEOIO_V4L_SELECT_TIMEOUT秒で戻るため，カメラが応答しなくてもstop()の後に読込スレッドは終わり，カメラを閉じる
+
+        読込スレッドのCPU時間の合計をread_cpuに記録する(1枚あたりはread_cpu / read_frames)
+    """
+    def __init__(self, device_name, fps=1.0, warmup_frames=50, mjpeg=False, width=0, height=0):
+        self.device_name = device_name
+        self.fps = fps
+        self.warmup_frames = warmup_frames
+        self.mjpeg = mjpeg
+        self.width = width
+        self.height = height
+        self.read_cpu = 0.0
+        self.read_frames = 0
+        self.frame = None
+        self.frame_time = None
+        # 開いてから読み込んだ画像の数
+        self.frames = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        """
+        読込を止める．timeout秒まで読込スレッドの終了(カメラを閉じる)を待つ
+        """
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=timeout)
+
+    @property
+    def warm(self):
+        return self.frames >= self.warmup_frames
+
+    def _open(self):
+        cap = open_capture(self.device_name, self.mjpeg, self.width, self.height)
+        # 古い画像がドライバのバッファに溜まらないようにする(対応していないドライバでは無視される)
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return cap
+
+    def _run(self):
+        while self.running:
+            cap = self._open()
+            with self.condition:
+                self.frames = 0
+            while self.running and cap.isOpened():
+                start = time.perf_counter()
+                cpu_start = time.thread_time()
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                self.read_cpu += time.thread_time() - cpu_start
+                self.read_frames += 1
+                with self.condition:
+                    self.frame = frame
+                    self.frame_time = time.time()
+                    self.frames += 1
+                    if self.frames == self.warmup_frames and self.fps:
+                        # 補正が済んだら低いフレームレートで読み込み続ける
+                        cap.set(cv2.CAP_PROP_FPS, self.fps)
+                    self.condition.notify_all()
+                if self.warm and self.fps:
+                    time.sleep(max(1 / self.fps - (time.perf_counter() - start), 0))
+            cap.release()
+            if self.running:
+                print(f"camera {self.device_name} read failed, reopen")
+                time.sleep(1)
+
+    def latest(self, timeout=None):
+        """
+        補正済みの最新の画像を返す
+
+        Args:
+            timeout (float): 補正が済んでいない場合に待つ時間(秒)．Noneなら待ち続ける
+
+        Returns:
+            frame (ndarray): 最新の画像．timeout秒以内に補正が済まなければNone
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.warm, timeout=timeout):
+                return None
+            return self.frame.copy()
+
+class CameraStreams:
+    """
+    接続しているUSBカメラごとのCameraStreamを保持するクラス(常駐する撮影プロセスで使う)
+
+    Args:
+        fps (float): 撮影の間に画像を読み込む頻度
+        warmup_frames (int): 開いた直後に読み捨てる画像の数
+        mjpeg (bool): 復号しないJPEGのバイト列を保持する
+        width (int): 要求する幅．0ならカメラの既定値
+        height (int): 要求する高さ．0ならカメラの既定値
+    """
+    def __init__(self, fps=1.0, warmup_frames=50, mjpeg=False, width=0, height=0):
+        self.fps = fps
+        self.warmup_frames = warmup_frames
+        self.mjpeg = mjpeg
+        self.width = width
+        self.height = height
+        self.streams = {}
+
+    def get(self, device_name):
+        if device_name not in self.streams:
+            self.streams[device_name] = CameraStream(device_name, self.fps, self.warmup_frames, self.mjpeg, self.width, self.height).start()
+        return self.streams[device_name]
+
+    def retain(self, device_names):
+        """
+        接続されていないカメラの読込を止める
+        """
+        for device_name in list(self.streams):
+            if device_name not in device_names:
+                self.streams.pop(device_name).stop()
+
+    def close(self):
+        for stream in self.streams.values():
+            stream.stop()
+        self.streams = {}
@@ -0,0 +1,97 @@
+# パケットの区切り文字(COBSで符号化したデータには含まれない)
+DELIMITER = 0
+
+def cobs_decode_into(src, start, end, out):
+    """
+    COBSで符号化されたsrc[start:end]を復号し，outの先頭に書き込む
+
+    Args:
+        src (bytearray or memoryview): 符号化されたデータ(区切り文字を含まない)
+        start (int): 復号する範囲の先頭
+        end (int): 復号する範囲の末尾(含まない)
+        out (memoryview): 書き込み先(end - start以上の長さ)
+
+    Returns:
+        length (int): 復号したデータの長さ
+
+    Notes:
+        cobs.cobs.decodeと同じ結果になる．不正なデータの場合はValueErrorを送出する
+    """
+    n = 0
+    i = start
+    while i < end:
+        code = src[i]
+        if code == DELIMITER:
+            raise ValueError("zero byte found in COBS encoded data")
+        i += 1
+        block_end = i + code - 1
+        if block_end > end:
+            raise ValueError("not enough input bytes for COBS length code")
+        out[n:n + code - 1] = src[i:block_end]
+        n += code - 1
+        i = block_end
+        # 0xFFのブロックと最後のブロックの後ろには0が無い
+        if code < 0xFF and i < end:
+            out[n] = 0
+            n += 1
+    return n
+
+class CobsFrameReader:
+    """
+    シリアルポートから受信したバイト列を区切り文字(0x00)でパケットに分け，COBSを復号するクラス
+
+    Args:
+        ser (serial.Serial): 接続しているシリアル(read(), in_waitingがあればよい)
+        max_frame (int): 1パケットの最大長(復号用のバッファの大きさ)
+
+    Notes:
+        受信済みのバイト(in_waiting，無ければ1バイト待つ)をまとめて読み込み，使い回すバッファに追加する．
+        バッファから区切り文字を探してパケットを取り出し，確保済みの出力バッファに復号する(1バイトずつのread()や
+        パケットごとのbytesの連結を行わない)
+
+        read_frame()が返すmemoryviewは次のread_frame()で上書きされる
+    """
+    def __init__(self, ser, max_frame=1024):
+        self.ser = ser
+        self.buffer = bytearray()
+        # バッファ内の未処理のデータの先頭
+        self.start = 0
+        self.decoded = bytearray(max_frame)
+
+    def _fill(self):
+        """
+        受信済みのデータをバッファに追加する．タイムアウトした場合はFalse
+        """
+        if self.start:
+            # 処理済みのデータを捨てる(読込1回につき1回だけ詰める)
+            del self.buffer[:self.start]
+            self.start = 0
+        chunk = self.ser.read(max(self.ser.in_waiting, 1))
+        if not chunk:
+            return False
+        self.buffer += chunk
+        return True
+
+    def read_frame(self):
+        """
+        1パケット分のデータを受信して復号する
+
+        Returns:
+            frame (memoryview): 復号したデータ．タイムアウトした場合はNone
+
+        Notes:
+            復号できないパケットはValueErrorを送出する(そのパケットは読み捨てる)
+        """
+        while True:
+            end = self.buffer.find(DELIMITER, self.start)
+            if end >= 0:
+                break
+            if not self._fill():
+                return None
+        start, self.start = self.start, end + 1
+        if end - start > len(self.decoded):
+            self.decoded = bytearray(end - start)
+        out = memoryview(self.decoded)
+        with memoryview(self.buffer) as src:
+            length = cobs_decode_into(src, start, end, out)
+        return out[:length]
@@ -5,6 +5,7 @@ import os
 import shutil
 
 import util
+import result_log
 
 def copy_folder_to_remote(local_folder, remote_ip, remote_user, remote_path, password):
     """
@@ -25,6 +26,12 @@ def copy_folder_to_remote(local_folder, remote_ip, remote_user, remote_path, pas
         print(f"⚠️ {local_folder} が存在しません。処理をスキップします。")
         return
 
+    # 萎れ指標の結果(result.log)があればresult.csvを作成してからコピーする
+    try:
+        result_log.export_csv(local_folder)
+    except Exception as e:
+        print(f"❌ result.csv作成エラー: {e}")
+
     # コピーコマンド
     scp_command = [
         "sshpass", "-p", password,
@@ -1,7 +1,59 @@
+import time
+from datetime import datetime, timedelta
+
+import util
 from sensor import Sensor
 from camera import Camera
+from spresense_session import SpresenseSessions
+from camera_stream import CameraStreams
+from usb_registry import UsbRegistry
+from image_writer import writer
 from wilt import cal_wilt
 
+def run_resident():
+    """
+    常駐して毎分0秒にセンサの取得とカメラ撮影を行う(camera.residentがtrueの場合)
+
+    Notes:
+        SPRESENSEのポートを撮影の間も開いたままにし，毎回のポートを開く処理と2秒の待ち時間を省く．
+        camera.usb_streamがtrueの場合はUSBカメラも開いたままにし，補正済みの最新の画像を使う(毎回50枚を読み捨てない)．
+        USBポートと機器の対応はueventで接続・取り外しを検出するまで使い回す．
+        data_collector.timerは起動中のサービスを再度起動しないため，最初の起動以降はこのプロセスが撮影を続ける．
+        次に起動する時刻は予定していた分から決め，撮影が次の分の0秒を過ぎて終わった場合はすぐにその分の撮影を行う(分を飛ばさない)
+    """
+    camera_config = util.get_pinode_config()["camera"]
+    registry = UsbRegistry(camera_config.get("usb_cache_path") or None, watch=True)
+    sessions = SpresenseSessions(settle=camera_config.get("spresense_settle", 2))
+    streams = None
+    if camera_config.get("usb_stream", False):
+        streams = CameraStreams(camera_config.get("usb_stream_fps", 1), camera_config.get("usb_warmup_frames", 50),
+                                camera_config.get("usb_mjpeg", False), camera_config.get("usb_width", 0), camera_config.get("usb_height", 0))
+    scheduled = datetime.now().replace(second=0, microsecond=0)
+    try:
+        while True:
+            try:
+                Sensor().upload_csv()
+                Camera(sessions, streams, registry).save_images()
+            except Exception as e:
+                print(e)
+            # 次の分の0秒まで待つ
+            scheduled += timedelta(minutes=1)
+            now = datetime.now()
+            if scheduled < now.replace(second=0, microsecond=0):
+                # 1分以上かかった場合は過ぎた分を飛ばし，今の分を撮影する
+                scheduled = now.replace(second=0, microsecond=0)
+            time.sleep(max((scheduled - now).total_seconds(), 0))
+    finally:
+        sessions.close()
+        if streams is not None:
+            streams.close()
+
 if __name__ == "__main__":
-    Sensor().upload_csv()
-    Camera().save_images()
\ No newline at end of file
+    if util.get_pinode_config()["camera"].get("resident", False):
+        run_resident()
+    else:
+        Sensor().upload_csv()
+        Camera().save_images()
+        # プロセスの終了で再試行中のSPRESENSEの撮影が打ち切られないよう，終わるまで待つ
+        Camera.wait_busy()
+        writer.flush()
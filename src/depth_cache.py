@@ -0,0 +1,169 @@
+import glob
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+
+# 類似度の計算に使う縮小画像のサイズ
+THUMBNAIL_SIZE = 64
+STATS_NAME = "stats.json"
+
+def thumbnail(image):
+    """
+    類似度の計算に使う縮小したグレースケール画像(平均0，分散1に正規化)
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA).astype(np.float32)
+    return (small - small.mean()) / (small.std() + 1e-6)
+
+def similarity(thumb1, thumb2):
+    """
+    縮小画像の正規化相互相関(1なら同じ画像．明るさが一様に変わっただけなら1に近い)
+    """
+    return float((thumb1 * thumb2).mean())
+
+class DepthCache:
+    """
+    深度推定(DepthAnythingV2)の結果をカメラ・時間帯ごとにディスクに保存し，再検出時に使い回すクラス
+
+    Args:
+        cache_dir (str): 保存先のフォルダ
+        camera (str): カメラの識別子("{camera_usb}_{camera_type}")
+        bucket_minutes (int): 深度を保存する時間帯の長さ(分)．同じ時間帯の深度は上書きする
+        max_age (int): 使い回す深度の古さの上限(分)．これより古いファイルは削除する
+        threshold (float): 使い回す画像の類似度の下限
+
+    Notes:
+        深度はfirst_detectionで葉を選ぶためだけに使い，カメラと植物は数分ではほとんど動かない．
+        新しい順に保存済みの深度を探し，撮影画像の縮小画像の類似度がthreshold以上なら深度推定を省略する
+
+        深度はuint8の配列として，類似度の計算に使う縮小画像と一緒に"{camera}_{%Y%m%d-%H%M}.npz"に保存する．
+        ヒット率と省略できた時間はstats.jsonに記録する
+    """
+    def __init__(self, cache_dir, camera, bucket_minutes=10, max_age=60, threshold=0.95):
+        self.cache_dir = cache_dir
+        self.camera = camera
+        self.bucket_minutes = bucket_minutes
+        self.max_age = max_age
+        self.threshold = threshold
+        self.stats_path = os.path.join(cache_dir, STATS_NAME)
+        # 直前のlookup()で省略できた時間の推定値(秒)
+        self.saved = 0.0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def bucket(self, now_time):
+        return now_time.replace(minute=now_time.minute - now_time.minute % self.bucket_minutes, second=0, microsecond=0)
+
+    def _path(self, bucket):
+        return os.path.join(self.cache_dir, f"{self.camera}_{bucket.strftime('%Y%m%d-%H%M')}.npz")
+
+    def _entries(self, now_time):
+        """
+        max_age以内の保存済みの深度のパス(新しい順)．古いファイルは削除する
+        """
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, f"{self.camera}_*.npz")):
+            try:
+                bucket = datetime.strptime(os.path.basename(path)[len(self.camera) + 1:-4], "%Y%m%d-%H%M")
+            except ValueError:
+                continue
+            if bucket < now_time - timedelta(minutes=self.max_age):
+                os.remove(path)
+            elif bucket <= now_time:
+                entries.append((bucket, path))
+        return [path for _, path in sorted(entries, reverse=True)]
+
+    def lookup(self, image, now_time):
+        """
+        使い回せる深度を返す．無ければNone
+
+        Args:
+            image (ndarray): 深度推定する画像
+            now_time (datetime): 処理対象の時刻
+        """
+        thumb = thumbnail(image)
+        for path in self._entries(now_time):
+            try:
+                with np.load(path) as data:
+                    score = similarity(thumb, data["thumbnail"])
+                    if score < self.threshold:
+                        continue
+                    depth = data["depth"]
+            except (OSError, ValueError, KeyError) as e:
+                # 書き込み途中などで壊れたファイル
+                print("depth cache error:", path, e)
+                continue
+            if depth.shape == image.shape[:2]:
+                print(f"depth cache hit: {os.path.basename(path)} (similarity {score:.3f})")
+                self.saved = self._update_stats(hit=True)
+                return depth
+        self.saved = self._update_stats(hit=False)
+        return None
+
+    def store(self, image, now_time, depth, elapsed):
+        """
+        深度推定の結果を保存する
+
+        Args:
+            image (ndarray): 深度推定した画像
+            now_time (datetime): 処理対象の時刻
+            depth (ndarray): 深度(uint8)
+            elapsed (float): 深度推定にかかった時間(秒)．省略できた時間の推定に使う
+        """
+        path = self._path(self.bucket(now_time))
+        tmp_path = path + ".tmp.npz"
+        np.savez_compressed(tmp_path, depth=depth.astype(np.uint8), thumbnail=thumbnail(image))
+        os.replace(tmp_path, path)
+        stats = self.stats()
+        stats["depth_time"] += elapsed
+        stats["depth_runs"] += 1
+        self._save_stats(stats)
+
+    def stats(self):
+        """
+        ヒット数・ミス数・深度推定の合計時間と回数・省略できた時間の推定値(秒)
+        """
+        stats = {"hits": 0, "misses": 0, "depth_time": 0.0, "depth_runs": 0, "saved_time": 0.0}
+        if os.path.exists(self.stats_path):
+            try:
+                with open(self.stats_path) as f:
+                    stats.update(json.load(f))
+            except (OSError, ValueError):
+                pass
+        return stats
+
+    def _update_stats(self, hit):
+        """
+        ヒット・ミスを記録し，省略できた時間の推定値(ヒットした場合は深度推定の平均時間)を返す
+        """
+        stats = self.stats()
+        saved = 0.0
+        if hit:
+            stats["hits"] += 1
+            saved = stats["depth_time"] / stats["depth_runs"] if stats["depth_runs"] else 0.0
+            stats["saved_time"] += saved
+        else:
+            stats["misses"] += 1
+        self._save_stats(stats)
+        return saved
+
+    def _save_stats(self, stats):
+        with open(self.stats_path, "w") as f:
+            json.dump(stats, f)
+
+def report(cache_dir):
+    with open(os.path.join(cache_dir, STATS_NAME)) as f:
+        stats = json.load(f)
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = stats["hits"] / lookups if lookups else 0
+    mean_time = stats["depth_time"] / stats["depth_runs"] if stats["depth_runs"] else 0
+    return (f"lookups: {lookups}, hits: {stats['hits']} ({hit_rate:.1%}), depth runs: {stats['depth_runs']} "
+            f"(mean {mean_time:.2f}s), saved: {stats['saved_time']:.1f}s")
+
+if __name__ == "__main__":
+    # 実行例: python depth_cache.py /home/pinode3/data/depth_cache
+    for cache_dir in sys.argv[1:]:
+        print(cache_dir, report(cache_dir))
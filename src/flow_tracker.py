@@ -0,0 +1,83 @@
+import cv2
+import numpy as np
+
+class FlowTracker:
+    """
+    縮小した画像の疎なオプティカルフロー(Lucas-Kanade)で，前の時刻の葉のbboxを現在の画像に移動させるクラス
+
+    Args:
+        scale (float): フローを計算する画像の縮小率(1024 -> 256なら0.25)
+        min_points (int): bboxの移動量の推定に必要な特徴点の数
+        max_error (float): 順方向・逆方向に追跡した特徴点の位置のずれの上限(縮小画像の画素)
+
+    Notes:
+        bbox内の特徴点を前の画像から現在の画像へ追跡し，さらに逆向きに追跡して元の位置に戻る点のみを使う．
+        bboxは特徴点の移動量の中央値だけ平行移動する(大きさは変えない)
+
+        信頼度は，bbox内で検出した特徴点のうち追跡できた点の割合とする．
+        特徴点がmin_points未満の葉は信頼度0とする
+    """
+    def __init__(self, scale=0.25, min_points=5, max_error=1.0):
+        self.scale = scale
+        self.min_points = min_points
+        self.max_error = max_error
+        self.lk_params = {"winSize": (15, 15), "maxLevel": 2,
+                          "criteria": (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03)}
+
+    def frame(self, image):
+        """
+        フローの計算に使う縮小したグレースケール画像
+        """
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        return cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+    def propagate(self, prev_frame, frame, bboxes):
+        """
+        前の画像のbboxを現在の画像に移動させる
+
+        Args:
+            prev_frame (ndarray): 前の時刻のframe()
+            frame (ndarray): 現在の時刻のframe()
+            bboxes (ndarray): shape (N, 4) の前の時刻のbbox(元の画像の座標)
+
+        Returns:
+            (bboxes, confidence) (tuple): shape (N, 4) の移動後のbboxと，shape (N,) の信頼度(0-1)
+        """
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        moved = bboxes.copy()
+        confidence = np.zeros(len(bboxes))
+
+        # 葉ごとにbbox内の特徴点を検出し，まとめて追跡する
+        points, owners = [], []
+        for k, bbox in enumerate(bboxes):
+            if np.isnan(bbox).any():
+                continue
+            # bboxの縁(葉の輪郭)の特徴点も使うため，少し広げた範囲から検出する
+            x1, y1, x2, y2 = np.clip(np.round(bbox * self.scale).astype(int) + [-2, -2, 2, 2], 0, [prev_frame.shape[1], prev_frame.shape[0]] * 2)
+            if x2 - x1 < 3 or y2 - y1 < 3:
+                continue
+            corners = cv2.goodFeaturesToTrack(prev_frame[y1:y2, x1:x2], maxCorners=30, qualityLevel=0.01, minDistance=3)
+            if corners is None or len(corners) < self.min_points:
+                continue
+            points.append(corners.reshape(-1, 2) + [x1, y1])
+            owners += [k] * len(corners)
+        if not points:
+            return moved, confidence
+
+        points = np.concatenate(points).astype(np.float32)
+        owners = np.array(owners)
+        forward, status, _ = cv2.calcOpticalFlowPyrLK(prev_frame, frame, points, None, **self.lk_params)
+        backward, back_status, _ = cv2.calcOpticalFlowPyrLK(frame, prev_frame, forward, None, **self.lk_params)
+        error = np.linalg.norm(backward - points, axis=1)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & (error < self.max_error)
+
+        displacement = (forward - points) / self.scale
+        for k in np.unique(owners):
+            leaf = owners == k
+            leaf_good = leaf & good
+            if leaf_good.sum() < self.min_points:
+                continue
+            dx, dy = np.median(displacement[leaf_good], axis=0)
+            moved[k] = bboxes[k] + [dx, dy, dx, dy]
+            confidence[k] = leaf_good.sum() / leaf.sum()
+        return moved, confidence
@@ -0,0 +1,159 @@
+import json
+import socket
+import struct
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import cv2
+import numpy as np
+
+RING_NAME = "pinode3_frames"
+
+# 共有メモリ先頭のヘッダ(識別子, スロット数, スロットのデータサイズ, 最後に書き込んだ通し番号)
+HEADER = struct.Struct("<8sIIQ")
+MAGIC = b"PN3FRAME"
+HEADER_SIZE = 64
+# スロットのヘッダ(通し番号, 撮影時刻, データ長, 種類, 高さ, 幅, チャンネル数, ファイル名)
+SLOT_HEADER = struct.Struct("<QdIBHHB128s")
+SLOT_HEADER_SIZE = 256
+# スロットに保存するデータの種類
+KIND_JPEG = 1
+KIND_RAW = 2
+
+class FrameRing:
+    """
+    撮影した画像を共有メモリのリングバッファで萎れ指標計算プロセス(wilt_server)に渡すクラス
+
+    Args:
+        shm (SharedMemory): 共有メモリ
+        owner (bool): 共有メモリを作成したプロセスかどうか(作成したプロセスのみ終了時に削除する)
+
+    Notes:
+        wilt_serverがcreate()で共有メモリを作成し，撮影プロセス(data_collector)はattach()で接続して
+        publish()で書き込む．書き込んだ通し番号をUNIXソケットで通知し，wilt_serverはread()で読み出す
+
+        SPRESENSEの画像はJPEGのまま，USBカメラの画像はデコード済みの配列(検出サイズにリサイズしたもの)を書き込む
+        (camera.usb_mjpegの場合はUSBカメラの画像もJPEGのまま)
+
+        書き込みは1プロセスずつ行う前提とする(プロセス内の複数のスレッドからの書き込みはロックで順番に行う)．読み出し中に同じスロットが上書きされた場合は
+        通し番号の前後比較で検出し，Noneを返す(画像ファイルからの処理に任せる)
+    """
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+        self.lock = threading.Lock()
+        magic, self.slots, self.slot_size, _ = HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{shm.name} is not a frame ring")
+
+    @classmethod
+    def create(cls, name=RING_NAME, slots=4, slot_size=1024 * 1024 * 3):
+        """
+        共有メモリを作成する(wilt_server)．同じ名前の共有メモリが残っていれば作り直す
+        """
+        size = HEADER_SIZE + slots * (SLOT_HEADER_SIZE + slot_size)
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            old = shared_memory.SharedMemory(name)
+            old.close()
+            old.unlink()
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        HEADER.pack_into(shm.buf, 0, MAGIC, slots, slot_size, 0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name=RING_NAME):
+        """
+        wilt_serverが作成した共有メモリに接続する(撮影プロセス)．存在しない場合はNone
+        """
+        try:
+            shm = shared_memory.SharedMemory(name)
+        except FileNotFoundError:
+            return None
+        # 接続しただけのプロセスの終了時に共有メモリが削除されないよう，resource_trackerの管理から外す
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm)
+
+    def _slot_offset(self, seq):
+        return HEADER_SIZE + (seq % self.slots) * (SLOT_HEADER_SIZE + self.slot_size)
+
+    def publish(self, name, jpeg=None, frame=None, capture_time=None):
+        """
+        画像を書き込む
+
+        Args:
+            name (str): 画像のファイル名
+            jpeg (bytes): JPEGのデータ
+            frame (ndarray): デコード済みの画像(uint8, HxWx3)．jpegとどちらか一方を指定する
+            capture_time (float): 撮影時刻(time.time())．Noneなら現在時刻
+
+        Returns:
+            seq (int): 書き込んだ通し番号．データが大きすぎる場合はNone
+        """
+        if frame is not None:
+            data = np.ascontiguousarray(frame, dtype=np.uint8)
+            kind, (height, width, channels) = KIND_RAW, data.shape
+        else:
+            data = np.frombuffer(jpeg, dtype=np.uint8)
+            kind, height, width, channels = KIND_JPEG, 0, 0, 0
+        if data.nbytes > self.slot_size:
+            print(f"frame is too large for the ring: {data.nbytes} bytes")
+            return None
+
+        capture_time = capture_time or time.time()
+        with self.lock:
+            seq = HEADER.unpack_from(self.shm.buf, 0)[3] + 1
+            offset = self._slot_offset(seq)
+            # 書き込み中は通し番号を0にする
+            struct.pack_into("<Q", self.shm.buf, offset, 0)
+            self.shm.buf[offset + SLOT_HEADER_SIZE:offset + SLOT_HEADER_SIZE + data.nbytes] = data.reshape(-1)
+            SLOT_HEADER.pack_into(self.shm.buf, offset, 0, capture_time, data.nbytes, kind, height, width, channels, name.encode())
+            struct.pack_into("<Q", self.shm.buf, offset, seq)
+            HEADER.pack_into(self.shm.buf, 0, MAGIC, self.slots, self.slot_size, seq)
+        return seq
+
+    def read(self, seq):
+        """
+        通し番号の画像を読み出す
+
+        Returns:
+            (name, capture_time, image) (tuple): ファイル名，撮影時刻，画像(BGR)．上書きされていた場合はNone
+        """
+        offset = self._slot_offset(seq)
+        slot_seq, capture_time, length, kind, height, width, channels, name = SLOT_HEADER.unpack_from(self.shm.buf, offset)
+        if slot_seq != seq:
+            return None
+        data = bytes(self.shm.buf[offset + SLOT_HEADER_SIZE:offset + SLOT_HEADER_SIZE + length])
+        # コピー中に上書きされていないか確認
+        if struct.unpack_from("<Q", self.shm.buf, offset)[0] != seq:
+            return None
+        if kind == KIND_RAW:
+            image = np.frombuffer(data, dtype=np.uint8).reshape(height, width, channels)
+        else:
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return name.rstrip(b"\0").decode(), capture_time, image
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def notify(seq, socket_path, timeout=5):
+    """
+    書き込んだ画像の通し番号をwilt_serverに通知する(処理の完了は待たない)
+
+    Returns:
+        response (dict): wilt_serverからの応答．wilt_serverに接続できない場合はNone
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            sock.sendall((json.dumps({"cmd": "frame", "seq": seq}) + "\n").encode())
+            with sock.makefile("r") as f:
+                return json.loads(f.readline())
+    except OSError as e:
+        print("frame notify failed:", e)
+        return None
@@ -1,40 +1,216 @@
 import cv2
+import gc
 import numpy as np
 from datetime import datetime, timedelta
 import os
 import pandas as pd
 import sys
-import torch
+import threading
 import time
 
-from ultralytics import YOLO
+# torch/ultralytics/Depth-Anything-V2は読込が重いため，モデルを読み込む時に読み込む
+# (スタブモデルでのベンチマークなど，実際のモデルを使わない場合はインストールされていなくてもよい)
 
 try:
-    sys.path.append("/usr/local/bin/pinode3/Depth-Anything-V2")
-    from depth_anything_v2.dpt import DepthAnythingV2
+    from scipy.optimize import linear_sum_assignment
 except ImportError:
-    sys.path.append("/home/pi/20250410_PiNode3_ForTomato/Depth-Anything-V2")
-    from depth_anything_v2.dpt import DepthAnythingV2
+    linear_sum_assignment = None
 
 import util
+import inference_backend
+from track_store import TrackStore
+from wilt_engine import WiltEngine
+from profiler import StageProfiler
+from depth_cache import DepthCache
+from flow_tracker import FlowTracker
+
+# 常駐プロセスでモデルを使い回すためのキャッシュ
+_yolo_models = {}
+_depth_models = {}
+# カメラ・保存先ごとの深度キャッシュ(毎分の処理で作り直さない)
+_depth_caches = {}
+# 複数のカメラをスレッドで処理する場合に同じモデルを重複して読み込まないためのロック
+_model_lock = threading.RLock()
+
+DEPTH_MODEL_CONFIGS = {
+    'vits': {'encoder': 'vits', 'features': 64, 'out_channels': [48, 96, 192, 384]},
+    'vitb': {'encoder': 'vitb', 'features': 128, 'out_channels': [96, 192, 384, 768]},
+    'vitl': {'encoder': 'vitl', 'features': 256, 'out_channels': [256, 512, 1024, 1024]},
+    'vitg': {'encoder': 'vitg', 'features': 384, 'out_channels': [1536, 1536, 1536, 1536]}
+}
+# ultralyticsで使うモデル(server_flag: (detect, pose))．onnx/tfliteはexportしたファイル名に読み替える
+DEFAULT_MODELS = {
+    True: ("weights/detect/20250510_detect.pt", "weights/pose/20250510_pose.pt"),
+    False: ("weights/detect/20241106_detect_saved_model/20241106_detect_float32.tflite", "weights/pose/20241217_3200aug.pt"),
+}
+WEIGHT_DIRS = ["", "/home/pi/20250410_PiNode3_ForTomato"]
+DEPTH_MODEL_DIRS = [
+    "/usr/local/bin/pinode3/Depth-Anything-V2",
+    "/home/pi/20250410_PiNode3_ForTomato/Depth-Anything-V2",
+]
 
-def get_depth_map(image):
-    encoder = "vits"  # モデルの種類を指定
-    model_configs = {
-        'vits': {'encoder': 'vits', 'features': 64, 'out_channels': [48, 96, 192, 384]},
-        'vitb': {'encoder': 'vitb', 'features': 128, 'out_channels': [96, 192, 384, 768]},
-        'vitl': {'encoder': 'vitl', 'features': 256, 'out_channels': [256, 512, 1024, 1024]},
-        'vitg': {'encoder': 'vitg', 'features': 384, 'out_channels': [1536, 1536, 1536, 1536]}
-    }
-    depth_model = DepthAnythingV2(**model_configs[encoder])
+def import_depth_anything():
+    """
+    Depth-Anything-V2のモデルクラスを読み込む
+    """
     try:
-        depth_model.load_state_dict(torch.load(f"/usr/local/bin/pinode3/Depth-Anything-V2/depth_anything_v2_{encoder}.pth", map_location="cpu"))
-    except FileNotFoundError:
-        depth_model.load_state_dict(torch.load(f"/home/pi/20250410_PiNode3_ForTomato/Depth-Anything-V2/depth_anything_v2_{encoder}.pth", map_location="cpu"))
-    #以下2行はGPUテスト用
-    # depth_model.eval()
-    # depth_model = depth_model.to('cuda')
-
+        sys.path.append("/usr/local/bin/pinode3/Depth-Anything-V2")
+        from depth_anything_v2.dpt import DepthAnythingV2
+    except ImportError:
+        sys.path.append("/home/pi/20250410_PiNode3_ForTomato/Depth-Anything-V2")
+        from depth_anything_v2.dpt import DepthAnythingV2
+    return DepthAnythingV2
+
+def load_models(server_flag, backend="ultralytics", detect_model=None, pose_model=None, threads=0, precision="float32"):
+    """
+    detect/poseモデルを読み込む．一度読み込んだモデルはプロセス内で使い回す
+
+    Args:
+        server_flag (bool): Trueならサーバ用(.pt)，Falseならエッジ用(tflite)のモデルを使用
+        backend (str): 推論バックエンド(ultralytics/onnx/tflite)
+        detect_model (str): detectモデルのパス．Noneならserver_flagとbackendから決める
+        pose_model (str): poseモデルのパス．Noneならserver_flagとbackendから決める
+        threads (int): 推論のスレッド数(onnx/tfliteのみ)．0なら既定値
+        precision (str): モデルの精度(float32/float16/int8)．detect_model/pose_modelを指定した場合は使わない
+
+    Returns:
+        (detect, pose) (tuple): 推論バックエンド(inference_backend)
+    """
+    default_detect, default_pose = DEFAULT_MODELS[bool(server_flag)]
+    detect_path = find_weight(detect_model) if detect_model else find_model(default_detect, backend, precision)
+    pose_path = find_weight(pose_model) if pose_model else find_model(default_pose, backend, precision)
+    key = (backend, detect_path, pose_path)
+    with _model_lock:
+        if key not in _yolo_models:
+            detect = inference_backend.load_backend(detect_path, "detect", backend, threads)
+            pose = inference_backend.load_backend(pose_path, "pose", backend, threads)
+            _yolo_models[key] = (detect, pose)
+        return _yolo_models[key]
+
+def load_configured_models(wilt_config):
+    """
+    config.jsonのwiltの設定(server_flag, backend, detect_model, pose_model, backend_threads, precision)でモデルを読み込む
+    """
+    return load_models(
+        wilt_config["server_flag"], wilt_config.get("backend", "ultralytics"),
+        wilt_config.get("detect_model") or None, wilt_config.get("pose_model") or None,
+        wilt_config.get("backend_threads", 0), wilt_config.get("precision", "float32"))
+
+def find_weight(path):
+    """
+    モデルファイルを実行ディレクトリ，リポジトリの順に探す．見つからなければそのまま返す
+    """
+    for weight_dir in WEIGHT_DIRS:
+        candidate = os.path.join(weight_dir, path)
+        if os.path.exists(candidate):
+            return candidate
+    return path
+
+def find_model(path, backend, precision="float32"):
+    """
+    既定のモデルのパスから，バックエンドと精度に対応するモデルファイルを探す
+
+    Notes:
+        float16/int8のモデルが見つからない場合(script/export_quantized.pyで作成していない)は，
+        警告を表示してfloat32のモデルを使う
+    """
+    weight = find_weight(inference_backend.model_path(path, backend, precision))
+    if precision != "float32" and not os.path.exists(weight):
+        print(f"WARNING: {precision} model {weight} not found, precision is ignored and the float32 model is used")
+        weight = find_weight(inference_backend.model_path(path, backend))
+    return weight
+
+def depth_model_key(encoder, precision="float32"):
+    """
+    _depth_modelsのキー(float32はencoderのみ，量子化したモデルは"{encoder}_{precision}")
+    """
+    return encoder if precision == "float32" else f"{encoder}_{precision}"
+
+def load_depth_model(encoder="vits", mmap=True, precision="float32"):
+    """
+    DepthAnythingV2モデルを読み込む．一度読み込んだモデルはencoder・精度毎にプロセス内で使い回す
+
+    Args:
+        encoder (str): モデルの種類(vits/vitb/vitl/vitg)
+        mmap (bool): Trueなら重みファイルをメモリマップで読み込む
+        precision (str): "float32" または "int8"
+
+    Returns:
+        depth_model (DepthAnythingV2)
+
+    Notes:
+        mmap=Trueの場合はmetaデバイス上でモデルを作り，メモリマップした重みをそのまま割り当てる．
+        乱数での初期化と重みのコピーが不要になり，重みのページはメモリ不足時にカーネルが解放できる
+
+        int8の場合はViTエンコーダのLinear層をINT8に動的量子化する(DPTヘッドの畳み込みはfloat32のまま)．
+        量子化した重みはメモリ上にコピーされる
+    """
+    key = depth_model_key(encoder, precision)
+    with _model_lock:
+        if key not in _depth_models:
+            if precision not in ("float32", "int8"):
+                raise ValueError(f"unsupported depth precision: {precision}")
+            for model_dir in DEPTH_MODEL_DIRS:
+                model_path = os.path.join(model_dir, f"depth_anything_v2_{encoder}.pth")
+                if os.path.exists(model_path):
+                    break
+            else:
+                raise FileNotFoundError(f"depth_anything_v2_{encoder}.pth not found")
+
+            import torch
+            DepthAnythingV2 = import_depth_anything()
+            if mmap:
+                state_dict = torch.load(model_path, map_location="cpu", mmap=True, weights_only=True)
+                with torch.device("meta"):
+                    depth_model = DepthAnythingV2(**DEPTH_MODEL_CONFIGS[encoder])
+                depth_model.load_state_dict(state_dict, assign=True)
+                # 重みファイルに含まれないバッファが残っている場合は通常の読込に切り替える
+                if any(t.is_meta for t in list(depth_model.parameters()) + list(depth_model.buffers())):
+                    depth_model = DepthAnythingV2(**DEPTH_MODEL_CONFIGS[encoder])
+                    depth_model.load_state_dict(state_dict)
+            else:
+                depth_model = DepthAnythingV2(**DEPTH_MODEL_CONFIGS[encoder])
+                depth_model.load_state_dict(torch.load(model_path, map_location="cpu"))
+            depth_model.eval()
+            if precision == "int8":
+                depth_model = torch.ao.quantization.quantize_dynamic(depth_model, {torch.nn.Linear}, dtype=torch.qint8)
+            #以下1行はGPUテスト用
+            # depth_model = depth_model.to('cuda')
+            _depth_models[key] = depth_model
+        return _depth_models[key]
+
+def evict_depth_model(encoder=None, precision="float32"):
+    """
+    キャッシュしているDepthAnythingV2モデルを破棄してメモリを解放する
+
+    Args:
+        encoder (str): 破棄するモデルの種類．Noneなら全て破棄
+        precision (str): 破棄するモデルの精度
+    """
+    with _model_lock:
+        if encoder is None:
+            _depth_models.clear()
+        else:
+            _depth_models.pop(depth_model_key(encoder, precision), None)
+        gc.collect()
+
+def get_depth_cache(cache_dir, camera, **options):
+    """
+    カメラ・保存先ごとのDepthCacheを返す．一度作ったものはプロセス内で使い回す
+
+    Args:
+        cache_dir (str): 保存先のフォルダ
+        camera (str): カメラの識別子("{camera_usb}_{camera_type}")
+        options: DepthCacheのbucket_minutes, max_age, threshold
+    """
+    key = (cache_dir, camera, tuple(sorted(options.items())))
+    with _model_lock:
+        if key not in _depth_caches:
+            _depth_caches[key] = DepthCache(cache_dir, camera, **options)
+        return _depth_caches[key]
+
+def get_depth_map(image, encoder="vits", mmap=True, precision="float32"):
+    depth_model = load_depth_model(encoder, mmap, precision)
     depth_image = depth_model.infer_image(image)
     depth = (depth_image - depth_image.min()) / (depth_image.max() - depth_image.min()) * 255  # 0-255にスケーリング
     depth = depth.astype(np.uint8)
@@ -137,20 +313,70 @@ def get_first_bbox(bbox_list, depth, height=1024, width=1024, leaf_num=5):
 
 #bboxどうしのIoUを計算する関数
 def calc_iou(bbox1, bbox2):
-    #BBox1とbbox2をfloat型に変換
-    bbox1 = list(map(float, bbox1))
-    bbox2 = list(map(float, bbox2))
-    x1 = max(bbox1[0], bbox2[0])
-    y1 = max(bbox1[1], bbox2[1])
-    x2 = min(bbox1[2], bbox2[2])
-    y2 = min(bbox1[3], bbox2[3])
-    intersection = max(0, x2 - x1) * max(0, y2 - y1)
-    area1 = (bbox1[2] - bbox1[0]) * (bbox1[3] - bbox1[1])
-    area2 = (bbox2[2] - bbox2[0]) * (bbox2[3] - bbox2[1])
-    union = area1 + area2 - intersection
-    iou = intersection / union
+    return float(calc_iou_matrix([bbox1], [bbox2])[0, 0])
+
+def calc_iou_matrix(bboxes1, bboxes2):
+    """
+    2つのbboxリストの全ての組み合わせのIoUを一度に計算する
+
+    Args:
+        bboxes1 (array_like): shape (N, 4) のbbox [x1, y1, x2, y2]
+        bboxes2 (array_like): shape (M, 4) のbbox [x1, y1, x2, y2]
+
+    Returns:
+        iou (ndarray): shape (N, M) のIoU行列．座標がNaNのbboxとのIoUはNaN
+    """
+    bboxes1 = np.asarray(bboxes1, dtype=np.float64).reshape(-1, 4)
+    bboxes2 = np.asarray(bboxes2, dtype=np.float64).reshape(-1, 4)
+    x1 = np.maximum(bboxes1[:, None, 0], bboxes2[None, :, 0])
+    y1 = np.maximum(bboxes1[:, None, 1], bboxes2[None, :, 1])
+    x2 = np.minimum(bboxes1[:, None, 2], bboxes2[None, :, 2])
+    y2 = np.minimum(bboxes1[:, None, 3], bboxes2[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area1 = (bboxes1[:, 2] - bboxes1[:, 0]) * (bboxes1[:, 3] - bboxes1[:, 1])
+    area2 = (bboxes2[:, 2] - bboxes2[:, 0]) * (bboxes2[:, 3] - bboxes2[:, 1])
+    union = area1[:, None] + area2[None, :] - intersection
+    with np.errstate(divide="ignore", invalid="ignore"):
+        iou = np.where(union > 0, intersection / union, 0.0)
+    iou[np.isnan(union)] = np.nan
     return iou
 
+def assign_bbox(iou, threshold):
+    """
+    IoU行列から，1つの検出bboxが複数の追跡bboxに割り当てられないように対応付けを行う
+
+    Args:
+        iou (ndarray): shape (N, M) のIoU行列(追跡bbox x 検出bbox)
+        threshold (float): 対応付けるIoUの下限
+
+    Returns:
+        pairs (list[tuple]): (追跡bboxの行番号, 検出bboxの列番号) のリスト
+
+    Notes:
+        scipyがあればハンガリアン法でIoUの合計が最大になる組み合わせを求め，
+        なければIoUの大きい組から順に割り当てる
+    """
+    score = np.nan_to_num(iou, nan=0.0)
+    score = np.where(score >= threshold, score, 0.0)
+    if score.size == 0:
+        return []
+    if linear_sum_assignment is not None:
+        rows, cols = linear_sum_assignment(score, maximize=True)
+        return [(int(r), int(c)) for r, c in zip(rows, cols) if score[r, c] >= threshold and score[r, c] > 0]
+
+    pairs = []
+    used_rows, used_cols = set(), set()
+    order = np.argsort(score, axis=None)[::-1]
+    for r, c in zip(*np.unravel_index(order, score.shape)):
+        if score[r, c] < threshold or score[r, c] == 0:
+            break
+        if r in used_rows or c in used_cols:
+            continue
+        pairs.append((int(r), int(c)))
+        used_rows.add(r)
+        used_cols.add(c)
+    return pairs
+
 def get_frame(frame, bbox):
     x1, y1, x2, y2 = bbox
     # print("input:", x1, y1, x2, y2)
@@ -170,212 +396,398 @@ def get_frame(frame, bbox):
     # print("output:", x1,y1,x2,y2)
     return frame[y1:y2, x1:x2], x1, y1, x2, y2
 
+def estimate_pose_sequential(pose, image, bbox_list, pose_size=640):
+    """
+    葉ごとに切り出した画像を1枚ずつPOSE推定する
+
+    Args:
+        pose (inference_backend): poseモデルの推論バックエンド
+        image (ndarray): 入力画像
+        bbox_list (list): 葉のbboxのリスト
+        pose_size (int): POSE推定の入力サイズ
+
+    Returns:
+        keypoints (ndarray): shape (N, 4) の [base_x, base_y, tip_x, tip_y]．推定できなかった葉はNaN
+    """
+    keypoints = np.full((len(bbox_list), 4), np.nan)
+    for k, bbox in enumerate(bbox_list):
+        # bboxから画像を切り出して640x640にリサイズ
+        clip, new_x1, new_y1, new_x2, new_y2 = get_frame(image, bbox)
+        clip = cv2.resize(clip, (pose_size, pose_size))
+        # POSE推定
+        (base_x, base_y), (tip_x, tip_y) = pose.keypoints(clip[None], pose_size, conf=0.1)[0]
+        if np.isnan(base_x):
+            continue
+        base_x = base_x /pose_size * (new_x2 - new_x1) + new_x1
+        base_y = base_y /pose_size * (new_y2 - new_y1) + new_y1
+        tip_x = tip_x /pose_size * (new_x2 - new_x1) + new_x1
+        tip_y = tip_y /pose_size * (new_y2 - new_y1) + new_y1
+        keypoints[k] = [base_x, base_y, tip_x, tip_y]
+    return keypoints
+
+def estimate_pose_batch(pose, image, bbox_list, pose_size=640):
+    """
+    全ての葉の切り出し画像を1つのバッチにまとめ，1回の推論でPOSE推定する
+
+    Args:
+        pose (inference_backend): poseモデルの推論バックエンド
+        image (ndarray): 入力画像
+        bbox_list (list): 葉のbboxのリスト
+        pose_size (int): POSE推定の入力サイズ
+
+    Returns:
+        keypoints (ndarray): shape (N, 4) の [base_x, base_y, tip_x, tip_y]．推定できなかった葉はNaN
+    """
+    n = len(bbox_list)
+    keypoints = np.full((n, 4), np.nan)
+    if n == 0:
+        return keypoints
+
+    # 切り出し画像は確保済みのバッファに直接リサイズして書き込む
+    batch = np.empty((n, pose_size, pose_size, 3), dtype=np.uint8)
+    regions = np.empty((n, 4))
+    for k, bbox in enumerate(bbox_list):
+        clip, new_x1, new_y1, new_x2, new_y2 = get_frame(image, bbox)
+        cv2.resize(clip, (pose_size, pose_size), dst=batch[k])
+        regions[k] = [new_x1, new_y1, new_x2, new_y2]
+
+    clip_xys = pose.keypoints(batch, pose_size, conf=0.1)
+
+    # 切り出し画像上の座標を元画像の座標に変換
+    scale = (regions[:, 2:] - regions[:, :2]) / pose_size
+    xys = clip_xys * scale[:, None, :] + regions[:, None, :2]
+    keypoints[:] = xys.reshape(n, 4)
+    return keypoints
+
 class image_processor:
-    def __init__(self, df, image_dir, now_time):
+    """
+    Args:
+        store (TrackStore): 追跡結果(result.csvのDataFrameでもよい)
+        image_dir (str): その日の画像フォルダ
+        now_time (datetime): 処理対象の時刻
+        image_path (str): 処理する画像のパス．Noneならnow_timeから探す
+        image (ndarray): 共有メモリで受け取った画像．Noneなら画像ファイルを読み込む
+        camera (dict): カメラの設定(util.get_wilt_cameras)．Noneならconfig.jsonのwilt.camera_usb/camera_type
+        models (tuple): (detect, pose)の推論バックエンド．Noneならconfig.jsonの設定で読み込む
+    """
+    def __init__(self, store, image_dir, now_time, image_path=None, image=None, camera=None, models=None):
         setting = util.get_pinode_config()
         self.edge_id = setting["device_id"]
-        self.df = df
+        # 追跡結果はTrackStoreで保持する(result.csvのDataFrameが渡された場合は変換する)
+        self.store = store if isinstance(store, TrackStore) else TrackStore.from_frame(store)
         self.image_dir = image_dir
+        # 画像フォルダの監視で通知された画像(Noneならnow_timeから探す)
+        self.image_path = image_path
+        # 共有メモリで受け取った画像(Noneなら画像ファイルを読み込む)
+        self.image = image
         self.tracking_num = setting["wilt"]["tracking_num"]
         self.now_time = now_time
         self.server_flag = setting["wilt"]["server_flag"]
-        self.camera_usb = setting["wilt"]["camera_usb"]
-        self.camera_type = setting["wilt"]["camera_type"]
+        camera = camera or util.get_wilt_cameras(setting["wilt"])[0]
+        self.camera_usb = camera["camera_usb"]
+        self.camera_type = camera["camera_type"]
+        self.pose_batch = setting["wilt"].get("pose_batch", True)
+        self.depth_encoder = setting["wilt"].get("depth_encoder", "vits")
+        self.depth_mmap = setting["wilt"].get("depth_mmap", True)
+        self.depth_precision = setting["wilt"].get("depth_precision", "float32")
+        # オプティカルフローによるbboxの追跡(detectモデルはflow_interval分毎，またはフローの信頼度が低い時のみ実行)．
+        # 毎分detectする場合との比較で検証するまでは既定で無効とする
+        self.flow_tracking = setting["wilt"].get("flow_tracking", False)
+        self.flow_interval = setting["wilt"].get("flow_interval", 10)
+        self.flow_min_confidence = setting["wilt"].get("flow_min_confidence", 0.5)
+        self.flow_tracker = FlowTracker(setting["wilt"].get("flow_scale", 0.25))
+        # 深度キャッシュ(再検出時に似た画像の深度を使い回す)．萎れ指標の値が変わりうるため既定で無効とする
+        self.depth_cache = setting["wilt"].get("depth_cache", False)
+        self.depth_cache_dir = setting["wilt"].get("depth_cache_dir", "/home/pinode3/data/depth_cache")
+        self.depth_cache_options = {
+            "bucket_minutes": setting["wilt"].get("depth_cache_bucket", 10),
+            "max_age": setting["wilt"].get("depth_cache_max_age", 60),
+            "threshold": setting["wilt"].get("depth_cache_similarity", 0.95),
+        }
+        self.depth_keep_loaded = setting["wilt"].get("depth_keep_loaded", True)
+
+
+        self.detect, self.pose = models or load_configured_models(setting["wilt"])
 
-        if self.server_flag:
-            self.detect = YOLO("weights/detect/20250510_detect.pt")
-            self.pose = YOLO("weights/pose/20250510_pose.pt")
-        else:
-            try:
-                self.detect = YOLO("weights/detect/20241106_detect_saved_model/20241106_detect_float32.tflite")
-                self.pose = YOLO("weights/pose/20241217_3200aug.pt")
-            except Exception as e:
-                # print("Error loading model:", e)
-                self.detect = YOLO("/home/pi/20250410_PiNode3_ForTomato/weights/detect/20241106_detect_saved_model/20241106_detect_float32.tflite")
-                self.pose = YOLO("/home/pi/20250410_PiNode3_ForTomato/weights/pose/20241217_3200aug.pt")
-        
         self.detect_size = 1024
         self.pose_size = 640
         self.key_list = []
+        self.wilts = {}
+        # 処理段階ごとの実時間・CPU時間・ピークメモリ
+        self.profiler = StageProfiler(setting["wilt"].get("profile_memory", True))
+        # 処理段階ごとの処理時間(秒)
+        self.stage_times = self.profiler.wall
     
     def get(self):
-        return self.df
-
-    def first_detection(self):
-        # image_dirの中で最も新しい画像を取得．
-        # 01_20250208_0701.jpgの形式．0701部分が時分を表す
-        images = os.listdir(self.image_dir)
-
-        if not images:
-            print("画像フォルダが存在しません")
-            return self.df
-
+        return self.store
+
+    def stage(self, name):
+        """
+        処理段階の実時間・CPU時間・ピークメモリを記録する(同じ段階が複数回あれば時間は合計する)
+        """
+        return self.profiler.stage(name)
+
+    def get_depth(self, image):
+        """
+        深度推定を行う．深度キャッシュが有効なら，似た画像の保存済みの深度を使い回す
+        """
+        cache = None
+        if self.depth_cache:
+            cache = get_depth_cache(self.depth_cache_dir, f"{self.camera_usb}_{self.camera_type}", **self.depth_cache_options)
+            depth = cache.lookup(image, self.now_time)
+            self.profiler.record("depth_cache_hit", int(depth is not None))
+            self.profiler.record("depth_saved_time", cache.saved)
+            if depth is not None:
+                return depth
+
+        start_time = time.perf_counter()
+        depth = get_depth_map(image, self.depth_encoder, self.depth_mmap, self.depth_precision)
+        if not self.depth_keep_loaded:
+            evict_depth_model(self.depth_encoder, self.depth_precision)
+        if cache is not None:
+            cache.store(image, self.now_time, depth, time.perf_counter() - start_time)
+        return depth
+
+    def find_image(self):
+        """
+        処理する画像のパスを返す
+
+        Notes:
+            画像フォルダの監視で通知された画像があればそれを使う．無ければnow_timeから2分前までの画像を
+            "{device}_{usb}_{type}_{%Y%m%d-%H%M}.jpg"の形式のファイル名で探す(フォルダ全体は走査しない)
+        """
+        if self.image_path is not None and os.path.exists(self.image_path):
+            print("file_name:", os.path.basename(self.image_path))
+            return self.image_path
         #now_timeの画像を取得
         for i in range(3):
             check_time = self.now_time - timedelta(minutes=i)
             file_name = f"{self.edge_id}_{self.camera_usb}_{self.camera_type}_{check_time.strftime('%Y%m%d-%H%M')}.jpg"
             print("file_name:", file_name)
-            if file_name in images:
-                break  # 見つかったらループ終了
-        else:
-            print("エラー: 対応する画像ファイルが3回試行しても見つかりません")
-            return self.df
-        image = cv2.imread(os.path.join(self.image_dir, file_name))
-        image = cv2.resize(image, (self.detect_size, self.detect_size))
+            if os.path.exists(os.path.join(self.image_dir, file_name)):
+                return os.path.join(self.image_dir, file_name)
+        print("エラー: 対応する画像ファイルが3回試行しても見つかりません")
+        return None
+
+    def load_image(self):
+        """
+        処理する画像を読み込み，検出サイズにリサイズして返す．画像が無い場合はNone
+        """
+        if self.image is not None:
+            if self.image.shape[:2] == (self.detect_size, self.detect_size):
+                return self.image
+            return cv2.resize(self.image, (self.detect_size, self.detect_size))
+        image_path = self.find_image()
+        if image_path is None:
+            return None
+        image = cv2.imread(image_path)
+        if image is None:
+            print("エラー: 画像を読み込めません", image_path)
+            return None
+        return cv2.resize(image, (self.detect_size, self.detect_size))
+
+    def first_detection(self):
+        with self.stage("image_load"):
+            image = self.load_image()
+        if image is None:
+            return self.store
         # 深度推定
-        depth = get_depth_map(image)
+        with self.stage("depth"):
+            depth = self.get_depth(image)
 
         # 葉のBBox検出
-        results = self.detect.predict(image, imgsz=self.detect_size, conf=0.3, save=False, project="/tmp")
-
-        result = results[0]
-        bbox_list = [box.xyxy[0].tolist() for box in result.boxes]
-        tracking_list = get_first_bbox(bbox_list, depth, self.detect_size, self.detect_size, leaf_num=self.tracking_num)
-
-        # dfに保存
-        leaf_num = 0
-        if "all_leaf_num" in self.df.columns:
-            try:
-                leaf_num = self.df["all_leaf_num"].dropna().iloc[-1]
-            except:
-                pass
-        key_list = []
-        for i in range(len(tracking_list[0])):
-            leaf_id = int(leaf_num + i + 1)
-            x1, y1, x2, y2 = tracking_list[0][i]
+        with self.stage("detect"):
+            bbox_list = self.detect.detect(image, self.detect_size, conf=0.3).tolist()
+
+        with self.stage("bbox"):
+            tracking_list = get_first_bbox(bbox_list, depth, self.detect_size, self.detect_size, leaf_num=self.tracking_num)
+
+            # storeに保存
+            leaf_num = self.store.latest_global("all_leaf_num") if self.store.has_global("all_leaf_num") else 0
+            if np.isnan(leaf_num):
+                leaf_num = 0
+            key_list = []
+            for i in range(len(tracking_list[0])):
+                leaf_id = int(leaf_num + i + 1)
+                x1, y1, x2, y2 = tracking_list[0][i]
+            
+                self.store.set(self.now_time, leaf_id, {
+                    "bbox_x1": x1, "bbox_y1": y1, "bbox_x2": x2, "bbox_y2": y2,
+                    "bbox_center_x1": (x1 + x2) / 2, "bbox_center_y1": (y1 + y2) / 2,
+                })
+                key_list.append(leaf_id)
+            self.key_list = key_list
+            self.store.set_global(self.now_time, "re_detection", 0)
+            self.store.set_global(self.now_time, "all_leaf_num", leaf_num + leaf_num+len(tracking_list[0]))
+            self.store.set_global(self.now_time, "now_leaf_num", len(tracking_list[0]))
+
+        # 次の時刻のオプティカルフローに使う縮小画像
+        if self.flow_tracking:
+            self.store.flow_frame = (self.now_time, self.flow_tracker.frame(image))
+
+        # pose推定
+        with self.stage("pose"):
+            self.estimate_pose(image)
+        print("key_list:", self.key_list)
+            # 萎れ指標を計算
+        with self.stage("cal_wilt"):
+            self.cal_wilt()
+        with self.stage("cal_final_wilt"):
+            self.cal_final_wilt()
         
-            self.df.loc[self.now_time, [f'{leaf_id}_bbox_x1', f'{leaf_id}_bbox_y1', 
-                                        f'{leaf_id}_bbox_x2', f'{leaf_id}_bbox_y2', 
-                                        f'{leaf_id}_bbox_center_x1', f'{leaf_id}_bbox_center_y1']] = [
-                x1, y1, x2, y2, (x1 + x2) / 2, (y1 + y2) / 2
-            ]
-            key_list.append(leaf_id)
-        self.key_list = key_list
-        self.df.loc[self.now_time, ['re_detection', 'all_leaf_num', 'now_leaf_num']] = [
-            0, leaf_num + leaf_num+len(tracking_list[0]), len(tracking_list[0])
-]
+        return self.store
 
+    def estimate_pose(self, image):
+        """
+        key_listの葉についてPOSE推定を行い，付け根・先端座標と角度・長さをstoreに保存する
 
-        # pose推定
-        for i in self.key_list:
-            x1 = self.df[str(i) + "_bbox_x1"].dropna().iloc[-1]
-            y1 = self.df[str(i) + "_bbox_y1"].dropna().iloc[-1]
-            x2 = self.df[str(i) + "_bbox_x2"].dropna().iloc[-1]
-            y2 = self.df[str(i) + "_bbox_y2"].dropna().iloc[-1]
-            # bboxから画像を切り出して640x640にリサイズ
-            clip, new_x1, new_y1, new_x2, new_y2 = get_frame(image, [x1, y1, x2, y2])
-            clip = cv2.resize(clip, (self.pose_size, self.pose_size))
-            # POSE推定
-            pose_results = self.pose.predict(clip, imgsz=640, conf=0.1, save=False, project="/tmp")
-            xys = pose_results[0].keypoints.xy[0].tolist()
-            # xysが空ならclipを保存
-            if len(xys) == 0:
+        Notes:
+            pose_batchがTrueなら全ての葉をまとめて1回で推論し，Falseなら葉ごとに推論する．
+            POSE推定できなかった葉はkey_listから削除する
+        """
+        bbox_list = self.store.latest_bboxes(self.key_list).tolist()
+
+        if self.pose_batch:
+            keypoints = estimate_pose_batch(self.pose, image, bbox_list, self.pose_size)
+        else:
+            keypoints = estimate_pose_sequential(self.pose, image, bbox_list, self.pose_size)
+
+        base_x, base_y, tip_x, tip_y = keypoints.T
+        angle = np.arctan2(tip_y - base_y, tip_x - base_x)
+        length = np.sqrt((tip_x - base_x) ** 2 + (tip_y - base_y) ** 2)
+
+        for k, i in enumerate(self.key_list.copy()):
+            if np.isnan(keypoints[k]).any():
                 # cv2.imwrite(f"clips/error_{self.now_time}.jpg", clip)
                 print("xysが空です。")
                 # key_listから削除
                 self.key_list.remove(i)
                 continue
-            base_x, base_y = xys[0][0], xys[0][1]
-            tip_x, tip_y = xys[1][0], xys[1][1]
-            base_x = base_x /self.pose_size * (new_x2 - new_x1) + new_x1
-            base_y = base_y /self.pose_size * (new_y2 - new_y1) + new_y1
-            tip_x = tip_x /self.pose_size * (new_x2 - new_x1) + new_x1
-            tip_y = tip_y /self.pose_size * (new_y2 - new_y1) + new_y1
-            # dfに保存
-            self.df.loc[self.now_time, [f'{i}_base_x', f'{i}_base_y', f'{i}_tip_x', f'{i}_tip_y', f'{i}_angle', f'{i}_length']] = [
-                base_x, base_y, tip_x, tip_y,
-                np.arctan2(tip_y - base_y, tip_x - base_x),
-                np.sqrt((tip_x - base_x) ** 2 + (tip_y - base_y) ** 2)
-            ]
-        print(self.df)
-            # 萎れ指標を計算
-        self.cal_wilt()
-        self.cal_final_wilt()
-        # print(self.df)
-        
-        return self.df
+            # storeに保存
+            self.store.set(self.now_time, i, {
+                "base_x": base_x[k], "base_y": base_y[k], "tip_x": tip_x[k], "tip_y": tip_y[k],
+                "angle": angle[k], "length": length[k],
+            })
 
     def get_best_bbox(self, bbox_list):
-        for i in self.key_list:
-            bbox = [self.df[str(i) + "_bbox_x1"].dropna().iloc[-1], self.df[str(i) + "_bbox_y1"].dropna().iloc[-1], self.df[str(i) + "_bbox_x2"].dropna().iloc[-1], self.df[str(i) + "_bbox_y2"].dropna().iloc[-1]]
-            #floatに変換
-            bbox = list(map(float, bbox))
-            best_iou = 0
-            for bbox2 in bbox_list:
-                iou = calc_iou(bbox, bbox2)
-                if iou > best_iou:
-                    best_iou = iou
-                    best_bbox = bbox2
-            if best_iou < 0.25:
-                best_bbox = bbox
-            # dfを更新
-            self.df.loc[self.now_time, [f'{i}_bbox_x1', f'{i}_bbox_y1', f'{i}_bbox_x2', f'{i}_bbox_y2', f'{i}_center_x', f'{i}_center_y']] = [
-                best_bbox[0], best_bbox[1], best_bbox[2], best_bbox[3],
-                (best_bbox[0] + best_bbox[2]) / 2,
-                (best_bbox[1] + best_bbox[3]) / 2
-            ]
-
-        return self.df
+        # 追跡中のbboxと検出bboxのIoUを一括で計算し，検出bboxが重複しないように対応付ける
+        track_bboxes = self.store.latest_bboxes(self.key_list)
+        detect_bboxes = np.asarray(bbox_list, dtype=np.float64).reshape(-1, 4)
+        iou = calc_iou_matrix(track_bboxes, detect_bboxes)
+
+        # IoUが0.25未満の場合は前回のbboxを使う
+        best_bboxes = track_bboxes.copy()
+        for row, col in assign_bbox(iou, 0.25):
+            best_bboxes[row] = detect_bboxes[col]
+
+        return self.set_bboxes(best_bboxes)
+
+    def set_bboxes(self, bboxes):
+        """
+        key_listの葉の最新時刻のbboxと中心座標をstoreに保存する
+        """
+        for bbox, i in zip(bboxes, self.key_list):
+            self.store.set(self.now_time, i, {
+                "bbox_x1": bbox[0], "bbox_y1": bbox[1], "bbox_x2": bbox[2], "bbox_y2": bbox[3],
+                "center_x": (bbox[0] + bbox[2]) / 2,
+                "center_y": (bbox[1] + bbox[3]) / 2,
+            })
+        return self.store
+
+    def previous_flow_frame(self):
+        """
+        前の時刻のフロー計算用の縮小画像を返す．保持していなければ前の時刻の画像ファイルから作成する．無ければNone
+
+        Notes:
+            result_formatがcsvの場合はresult.csvから毎回読み込むため画像を保持しておらず，時刻も文字列になっている．
+            前の時刻の画像が見つからない場合はNoneを返し，detectモデルでの検出に任せる(再検出にはしない)
+        """
+        prev_time = self.store.times[-1]
+        if self.store.flow_frame is not None and self.store.flow_frame[0] == prev_time:
+            return self.store.flow_frame[1]
+        try:
+            file_name = f"{self.edge_id}_{self.camera_usb}_{self.camera_type}_{pd.Timestamp(prev_time).strftime('%Y%m%d-%H%M')}.jpg"
+        except (ValueError, TypeError) as e:
+            print("flow frame lookup failed:", e)
+            return None
+        image = cv2.imread(os.path.join(self.image_dir, file_name))
+        if image is None:
+            return None
+        return self.flow_tracker.frame(cv2.resize(image, (self.detect_size, self.detect_size)))
+
+    def propagate_bbox(self, frame):
+        """
+        key_listの葉の前の時刻のbboxをオプティカルフローで現在の画像に移動させる
+
+        Returns:
+            bboxes (ndarray): shape (N, 4) の移動後のbbox．detectモデルで検出すべき場合はNone
+
+        Notes:
+            直近flow_interval - 1分続けてフローで追跡した場合や，いずれかの葉のフローの信頼度が
+            flow_min_confidence未満の場合はdetectモデルで検出する
+        """
+        if not self.flow_tracking or self.flow_interval <= 1 or len(self.key_list) == 0:
+            return None
+        if self.store.has_global("flow_tracking"):
+            recent = self.store.global_column("flow_tracking")[-(self.flow_interval - 1):]
+            if len(recent) == self.flow_interval - 1 and np.all(recent == 1):
+                return None
+        prev_frame = self.previous_flow_frame()
+        if prev_frame is None:
+            return None
+        bboxes, confidence = self.flow_tracker.propagate(prev_frame, frame, self.store.latest_bboxes(self.key_list))
+        if confidence.min() < self.flow_min_confidence:
+            print(f"flow confidence is low: {confidence.min():.2f}")
+            return None
+        return bboxes
 
     # 更新されていないbboxがある場合、そのbboxを削除する関数
     def check_bbox(self):
-        if len(self.df[str(self.key_list[0]) + '_bbox_x1'].dropna()) < 35:
-            return self.df, self.key_list
+        if len(self.store.valid(self.key_list[0], 'bbox_x1')) < 35:
+            return self.store, self.key_list
         for i in self.key_list.copy():
-            col_prefix = str(i) + '_bbox_'
-            x1 = self.df[col_prefix + 'x1'].dropna()
-            y1 = self.df[col_prefix + 'y1'].dropna()
-            x2 = self.df[col_prefix + 'x2'].dropna()
-            y2 = self.df[col_prefix + 'y2'].dropna()
+            x1 = self.store.valid(i, 'bbox_x1')
+            y1 = self.store.valid(i, 'bbox_y1')
+            x2 = self.store.valid(i, 'bbox_x2')
+            y2 = self.store.valid(i, 'bbox_y2')
 
             if len(x1) < 35:
                 continue
             # 30, 20, 10, 1分前（フレームインデックスで）を仮定
             # 各インデックスのbbox座標を取得
-            bbox30 = [x1.iloc[-30], y1.iloc[-30], x2.iloc[-30], y2.iloc[-30]]
-            bbox20 = [x1.iloc[-20], y1.iloc[-20], x2.iloc[-20], y2.iloc[-20]]
-            bbox10 = [x1.iloc[-10], y1.iloc[-10], x2.iloc[-10], y2.iloc[-10]]
-            bbox1  = [x1.iloc[-1],  y1.iloc[-1],  x2.iloc[-1],  y2.iloc[-1]]
+            bbox30 = [x1[-30], y1[-30], x2[-30], y2[-30]]
+            bbox20 = [x1[-20], y1[-20], x2[-20], y2[-20]]
+            bbox10 = [x1[-10], y1[-10], x2[-10], y2[-10]]
+            bbox1  = [x1[-1],  y1[-1],  x2[-1],  y2[-1]]
 
             # すべてのbboxが同じなら削除対象
             if bbox1 == bbox10 == bbox20 == bbox30:
                 self.key_list.remove(i)
-        return self.df, self.key_list
+        return self.store, self.key_list
     
-    # IOUが0.8以上のbboxがある場合、数字の小さいほうのbboxを削除する関数
+    # IOUが0.4より大きいbboxがある場合、数字の大きいほうのbboxを削除する関数
     def check_bbox2(self):
-        for i in self.key_list.copy():
-            bbox = [self.df[str(i) + "_bbox_x1"].dropna().iloc[-1], self.df[str(i) + "_bbox_y1"].dropna().iloc[-1], self.df[str(i) + "_bbox_x2"].dropna().iloc[-1], self.df[str(i) + "_bbox_y2"].dropna().iloc[-1]]
-            for j in self.key_list:
-                if i == j:
-                    continue
-                bbox2 = [self.df[str(j) + "_bbox_x1"].dropna().iloc[-1], self.df[str(j) + "_bbox_y1"].dropna().iloc[-1], self.df[str(j) + "_bbox_x2"].dropna().iloc[-1], self.df[str(j) + "_bbox_y2"].dropna().iloc[-1]]
-                iou = calc_iou(bbox, bbox2)
-                if iou > 0.4:
-                    if i > j:
-                        try:
-                            self.key_list.remove(i)
-                        except:
-                            continue
-                    else:
-                        try:
-                            self.key_list.remove(j)
-                        except:
-                            continue
-        return self.df, self.key_list
+        ids = np.array(self.key_list)
+        bboxes = self.store.latest_bboxes(self.key_list)
+        iou = calc_iou_matrix(bboxes, bboxes)
+        # 自分より小さい数字のbboxと重なっているIDを削除
+        overlap = (iou > 0.4) & (ids[None, :] < ids[:, None])
+        remove_ids = set(ids[overlap.any(axis=1)].tolist())
+        self.key_list = [i for i in self.key_list if i not in remove_ids]
+        return self.store, self.key_list
 
     def check_bbox3(self):
         angle_diff_list = []
 
         for i in self.key_list.copy():
-            angle_series = self.df[str(i) + '_angle'].dropna()
+            angle_series = self.store.valid(i, 'angle')
 
             # 十分なデータがない場合はスキップ
             if len(angle_series) < 15:
-                return self.df, self.key_list
+                return self.store, self.key_list
 
             # 階差（差分）を計算して合計を求める
-            angle_diffs = np.abs(np.diff(angle_series.iloc[-10:]))  # 直近10点の差分の絶対値
+            angle_diffs = np.abs(np.diff(angle_series[-10:]))  # 直近10点の差分の絶対値
             total_diff = np.sum(angle_diffs)
             angle_diff_list.append((i, total_diff))
 
@@ -385,246 +797,143 @@ class image_processor:
             if total_diff > threshold:
                 self.key_list.remove(i)
 
-        return self.df, self.key_list
+        return self.store, self.key_list
 
     # 現在のkey_listのIDのbboxとそれより小さい数字のbboxのIoUを計算し，IoUが0.7以上ならIDを小さい数字に変更する関数
     def check_bbox4(self):
-        for i in self.key_list.copy():
-            bbox = [self.df[str(i) + "_bbox_x1"].dropna().iloc[-1], self.df[str(i) + "_bbox_y1"].dropna().iloc[-1], self.df[str(i) + "_bbox_x2"].dropna().iloc[-1], self.df[str(i) + "_bbox_y2"].dropna().iloc[-1]]
-            past_id_list = []
-            # i より小さい数字のloop
-            for j in range(i-1, 0, -1):
-                try:
-                    bbox2 = [self.df[str(j) + "_bbox_x1"].dropna().iloc[-1], self.df[str(j) + "_bbox_y1"].dropna().iloc[-1], self.df[str(j) + "_bbox_x2"].dropna().iloc[-1], self.df[str(j) + "_bbox_y2"].dropna().iloc[-1]]
-                    iou = calc_iou(bbox, bbox2)
-                except:
-                    continue
-                if iou > 0.7:
-                    past_id_list.append(j)
+        past_ids = np.array(self.store.leaf_ids())
+        if len(self.key_list) == 0 or len(past_ids) == 0:
+            return
+        ids = np.array(self.key_list)
+        iou = calc_iou_matrix(self.store.latest_bboxes(self.key_list), self.store.latest_bboxes(past_ids))
+        candidate = (iou > 0.7) & (past_ids[None, :] < ids[:, None])
+        for k, i in enumerate(ids.tolist()):
+            if not candidate[k].any():
+                continue
             # 過去のbboxの中で一番小さい数字を取得
-            if len(past_id_list) > 0:
-                min_id = min(past_id_list)
-                # key_listからiを削除して、min_idを追加
-                self.key_list.remove(i)
+            min_id = int(past_ids[candidate[k]].min())
+            # key_listからiを削除して、min_idを追加
+            self.key_list.remove(i)
+            if min_id not in self.key_list:
                 self.key_list.append(min_id)
 
     def cal_wilt(self):
-                # b'' を NaN に変換し、その後 NaN のある行を削除
-        self.df.replace({b'': np.nan}, inplace=True)
-        # self.df.dropna(inplace=True)
-
+        """
+        最新時刻の葉ごとの萎れ指標を計算する
+
+        Notes:
+            WiltEngineで直近30時点と移動平均の窓のみから逐次計算し，最新時刻の行のみを書き込む．
+            過去の行は書き換えない
+        """
+        row = self.store.row(self.now_time)
+
+        def value(key, field):
+            return self.store.column(key, field)[row] if self.store.has(key, field) else np.nan
+
+        engine = self.store.wilt_engine
+        if engine is None or engine.rows != row:
+            # 初回や途中から読み込んだ場合は保存済みの行から状態を作成する
+            engine = WiltEngine.from_store(self.store, rows=row, detect_size=self.detect_size)
+            self.store.wilt_engine = engine
+        for key in self.store.leaf_ids():
+            engine.update(row, key, value(key, "angle"), value(key, "center_y"), value(key, "length"))
+
+        self.wilts = {}
         for key in self.key_list:
-            if not str(key) + "_bbox_x1" in self.df.columns:
+            if not self.store.has(key, "bbox_x1"):
                 print(key)
                 continue
-            if len(self.df[str(key) + "_angle"]) < 35:
-                self.df[str(key) + "_wilt"] = 0
-                continue
-            # 現時点(self.now_time) - 30分のタイムスタンプを作成
-            if len(self.df) > 30:
-                lookback_index = self.df.index[-30]
-            else:
-                lookback_index = self.df.index[0]  # データが30行未満なら最初の行を使用
-                
-            leaf_length = self.df.loc[:, str(key) + '_length'].mean()
-            # 30時点前が無ければcontinue
-            try:
-                if np.isnan(self.df[str(key) + "_angle"].dropna().loc[lookback_index]):
-                    self.df[str(key) + "_wilt"] = 0
-                    continue
-                if np.pi / 2 <= self.df[str(key) + "_angle"].loc[lookback_index] <= 3 * np.pi / 2:
-                    self.df[str(key) + "_angle_diff"] = self.df[str(key) + "_angle"].dropna().loc[lookback_index] - self.df[str(key) + "_angle"]
-                else:
-                    self.df[str(key) + "_angle_diff"] = self.df[str(key) + "_angle"] - self.df[str(key) + "_angle"].dropna().loc[lookback_index]
-                
-                self.df[str(key) + "_sin"] = np.sin(self.df[str(key) + "_angle_diff"]) * -1
-                self.df[str(key) + "_center_diff"] = (self.detect_size - self.df[str(key) + "_center_y"]) - (self.detect_size - self.df[str(key) + "_center_y"].dropna().loc[lookback_index])
-                self.df[str(key) + "_std_center_diff"] = self.df[str(key) + "_center_diff"] / leaf_length
-                self.df[str(key) + "_wilt"] = self.df[str(key) + "_sin"] + self.df[str(key) + "_std_center_diff"]
-                self.df[str(key) + "_wilt"] = self.df[str(key) + "_wilt"].rolling(5).mean().interpolate()
-            except:
-                self.df[str(key) + "_wilt"] = 0
-                continue       
-        return self.df
+            values = engine.cal_wilt(key, value(key, "angle"), value(key, "center_y"))
+            self.store.set(self.now_time, key, values)
+            self.wilts[key] = values["wilt"]
+        return self.store
 
     def cal_final_wilt(self, top_n=None):
-        if len(self.df) < 35:
-            self.df["final_wilt"] = 0
-            return self.df
-
-        candidates = []
-
-        for key in self.key_list:
-            wilt_col = f"{key}_wilt"
-            angle_col = f"{key}_angle"
-
-            if wilt_col not in self.df.columns or angle_col not in self.df.columns:
-                continue
-
-            wilt_series = self.df[wilt_col].dropna()
-            angle_series = self.df[angle_col].dropna()
-
-            # 追跡時間（wiltが0でないデータ点の数）
-            tracking_time = len(wilt_series[wilt_series != 0])
-            if tracking_time < 10:
-                continue
-
-            # 角度変化の滑らかさ（差分の標準偏差の逆数）
-            if len(angle_series) < 5:
-                continue
-            angle_diff = angle_series.diff().dropna()
-            std_diff = angle_diff.std()
-            if std_diff == 0 or np.isnan(std_diff):
-                continue
-            smoothness = 1 / std_diff
-
-            candidates.append((key, tracking_time, smoothness))
-
-        if len(candidates) == 0:
-            self.df["final_wilt"] = 0
-            return self.df
-
-        # tracking_time 降順、同点は smoothness 降順でソート
-        candidates.sort(key=lambda x: (x[1], x[2]), reverse=True)
-
-        # 対象とする上位N個を決定（top_nがNoneなら全て）
-        top_keys = candidates if top_n is None else candidates[:top_n]
-
-        # 正規化のための最大値を取得
-        max_tracking = max([t for _, t, _ in top_keys])
-        max_smoothness = max([s for _, _, s in top_keys])
-
-        # 重み計算と合成
-        weighted_wilts = []
-        total_weight = 0
-        for key, tracking_time, smoothness in top_keys:
-            tracking_score = tracking_time / max_tracking if max_tracking > 0 else 0
-            smooth_score = smoothness / max_smoothness if max_smoothness > 0 else 0
-            weight = (tracking_score + smooth_score) / 2
-
-            weighted_wilts.append(self.df[f"{key}_wilt"].fillna(0) * weight)
-            total_weight += weight
-
-        if total_weight == 0:
-            self.df["final_wilt"] = 0
-        else:
-            self.df["final_wilt"] = sum(weighted_wilts) / total_weight
-
+        """
+        葉ごとの萎れ指標から最新時刻の萎れ指標(final_wilt)を計算する
+        """
+        final_wilt, top_keys = self.store.wilt_engine.cal_final_wilt(self.wilts, top_n)
+        self.store.set_global(self.now_time, "final_wilt", final_wilt)
         # 選ばれたキーの記録（最大3つ）
-        for i, (key, _, _) in enumerate(top_keys[:3]):
-            self.df.loc[self.now_time, f"{i+1}_top_key"] = key
+        for i, key in enumerate(top_keys[:3]):
+            self.store.set_global(self.now_time, f"{i+1}_top_key", key)
+        return self.store
 
-        return self.df
-    
     def get_key_list(self):
-        latest_row = self.df.iloc[-1]
-        bbox_ids = [int(col.split("_")[0]) for col in self.df.columns 
-                    if "_bbox_x1" in col and not pd.isna(latest_row[col])]
-
-        return bbox_ids
+        return [i for i in self.store.leaf_ids() if not np.isnan(self.store.column(i, "bbox_x1")[-1])]
 
     # 検出したbboxの座標が，過去のbboxと重なっていた場合に過去のbboxを復活させる関数 
     def revive_bbox(self, bbox_list):
-        # self.dfの列名である，"_bbox_x1"の前の数字のリスト
-        past_bbox_list = [
-        int(re.match(r"(\d+)_bbox_x1", col).group(1))
-        for col in self.df.columns
-        if re.match(r"\d+_bbox_x1", col)
-        ]
-        # past_bbox_list内で，self.key_listに含まれないものを取得
-        past_bbox_list = [i for i in past_bbox_list if i not in self.key_list]
-        for i in past_bbox_list:
-            # 過去のbboxの座標
-            bbox = [
-                self.df[str(i) + "_bbox_x1"].dropna().iloc[-1],
-                self.df[str(i) + "_bbox_y1"].dropna().iloc[-1],
-                self.df[str(i) + "_bbox_x2"].dropna().iloc[-1],
-                self.df[str(i) + "_bbox_y2"].dropna().iloc[-1]
-            ]
-            # 過去のbboxと現在のbboxのIoUを計算
-            for bbox2 in bbox_list:
-                iou = calc_iou(bbox, bbox2)
-                if iou > 0.7:
-                    # 過去のbboxを復活させる
-                    self.key_list.append(i)
+        # 過去のbboxのIDの中で，self.key_listに含まれないものを取得
+        past_ids = [i for i in self.store.leaf_ids() if i not in self.key_list]
+        if len(past_ids) == 0:
+            return
+        # 過去のbboxと現在のbboxのIoUを一括で計算
+        iou = calc_iou_matrix(self.store.latest_bboxes(past_ids), bbox_list)
+        for i, revive in zip(past_ids, (iou > 0.7).any(axis=1)):
+            if revive:
+                # 過去のbboxを復活させる
+                self.key_list.append(i)
 
     def tracking(self):
         # 葉のBBox検出
-        images = os.listdir(self.image_dir)
-
-        if not images:
-            print("画像フォルダが存在しません")
-            return self.df
-
-        #now_timeの画像を取得
-        for i in range(3):
-            check_time = self.now_time - timedelta(minutes=i)
-            file_name = f"{self.edge_id}_{self.camera_usb}_{self.camera_type}_{check_time.strftime('%Y%m%d-%H%M')}.jpg"
-            print("file_name:", file_name)
-            if file_name in images:
-                break  # 見つかったらループ終了
-        else:
-            print("エラー: 対応する画像ファイルが3回試行しても見つかりません")
-            return self.df
-        image = cv2.imread(os.path.join(self.image_dir, file_name))
-        image = cv2.resize(image, (self.detect_size, self.detect_size))
-        self.key_list = [int(i.split("_")[0]) for i in self.df.columns if "_bbox_x1" in i]
+        with self.stage("image_load"):
+            image = self.load_image()
+        if image is None:
+            return self.store
+        self.key_list = self.store.leaf_ids()
         print("key_list:", self.key_list)
         try:
-            results = self.detect.predict(image, imgsz=self.detect_size, conf=0.3, save=False, project="/tmp")
-            result = results[0]
-            bbox_list = [box.xyxy[0].tolist() for box in result.boxes]
-
-            # ３種類の削除関数を実行し，key_listを更新
-            self.check_bbox()
-            self.check_bbox2()
-            self.check_bbox3()
-            self.check_bbox4()
-
-            # IoUが高いBBoxを用いて更新
-            # bbox情報を更新
-            self.df = self.get_best_bbox(bbox_list)
-            
-            for i in self.key_list:
-                x1 = self.df[str(i) + "_bbox_x1"].dropna().iloc[-1]
-                y1 = self.df[str(i) + "_bbox_y1"].dropna().iloc[-1]
-                x2 = self.df[str(i) + "_bbox_x2"].dropna().iloc[-1]
-                y2 = self.df[str(i) + "_bbox_y2"].dropna().iloc[-1]
-                # bboxから画像を切り出して640x640にリサイズ
-                clip, new_x1, new_y1, new_x2, new_y2 = get_frame(image, [x1, y1, x2, y2])
-                clip = cv2.resize(clip, (self.pose_size, self.pose_size))
-                # POSE推定
-                pose_results = self.pose.predict(clip, imgsz=640, conf=0.1, save=False, project="/tmp")
-                xys = pose_results[0].keypoints.xy[0].tolist()
-                if len(xys) == 0:
-                    # cv2.imwrite(f"clips/error_{self.now_time}.jpg", clip)
-                    print("xysが空です。")
-                    # key_listから削除
-                    self.key_list.remove(i)
-                    continue
-                base_x, base_y = xys[0][0], xys[0][1]
-                tip_x, tip_y = xys[1][0], xys[1][1]
-                base_x = base_x /self.pose_size * (new_x2 - new_x1) + new_x1
-                base_y = base_y /self.pose_size * (new_y2 - new_y1) + new_y1
-                tip_x = tip_x /self.pose_size * (new_x2 - new_x1) + new_x1
-                tip_y = tip_y /self.pose_size * (new_y2 - new_y1) + new_y1
-                # dfに保存
-                self.df.loc[self.now_time, [f'{i}_base_x', f'{i}_base_y', f'{i}_tip_x', f'{i}_tip_y', f'{i}_angle', f'{i}_length']] = [
-                    base_x, base_y, tip_x, tip_y,
-                    np.arctan2(tip_y - base_y, tip_x - base_x),
-                    np.sqrt((tip_x - base_x) ** 2 + (tip_y - base_y) ** 2),
-                ]
-            self.df.loc[self.now_time, 'now_leaf_num'] = len(self.key_list)
-            self.df.loc[self.now_time, 're_detection'] = 0
+            with self.stage("bbox"):
+                # ３種類の削除関数を実行し，key_listを更新
+                self.check_bbox()
+                self.check_bbox2()
+                self.check_bbox3()
+                self.check_bbox4()
+
+            # 前の時刻のbboxをオプティカルフローで移動させる(できない場合はdetectモデルで検出する)
+            bboxes = None
+            frame = None
+            if self.flow_tracking:
+                with self.stage("flow"):
+                    try:
+                        frame = self.flow_tracker.frame(image)
+                        bboxes = self.propagate_bbox(frame)
+                    except Exception as e:
+                        # フローで追跡できなくても再検出にはせず，detectモデルで検出する
+                        print("flow tracking failed:", e)
+                        bboxes = None
+            if bboxes is None:
+                with self.stage("detect"):
+                    bbox_list = self.detect.detect(image, self.detect_size, conf=0.3).tolist()
+                with self.stage("bbox"):
+                    # IoUが高いBBoxを用いて更新
+                    # bbox情報を更新
+                    self.get_best_bbox(bbox_list)
+            else:
+                with self.stage("bbox"):
+                    self.set_bboxes(bboxes)
+            if self.flow_tracking:
+                # 無効の場合はresult.csvに列を追加しない
+                self.store.set_global(self.now_time, 'flow_tracking', int(bboxes is not None))
+            if frame is not None:
+                self.store.flow_frame = (self.now_time, frame)
+
+            with self.stage("pose"):
+                self.estimate_pose(image)
+            self.store.set_global(self.now_time, 'now_leaf_num', len(self.key_list))
+            self.store.set_global(self.now_time, 're_detection', 0)
                 # 萎れ指標を計算
-            self.cal_wilt()
-            self.cal_final_wilt()
+            with self.stage("cal_wilt"):
+                self.cal_wilt()
+            with self.stage("cal_final_wilt"):
+                self.cal_final_wilt()
 
             if len(self.key_list) < self.tracking_num//3:
-                self.df.loc[self.now_time, 're_detection'] = 1
+                self.store.set_global(self.now_time, 're_detection', 1)
         except:
-            self.df.loc[self.now_time, 're_detection'] = 1
-        return self.df
+            self.store.set_global(self.now_time, 're_detection', 1)
+        return self.store
 
 
 if __name__ == "__main__":
@@ -0,0 +1,141 @@
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+import time
+from datetime import datetime
+
+# inotifyのイベント(linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+EVENT_HEADER = struct.Struct("iIII")
+
+class ImageWatcher:
+    """
+    inotifyでカメラの画像フォルダを監視し，書き込みが完了した画像のパスを通知するクラス
+
+    Args:
+        image_dir (str): 監視するフォルダ(config.jsonのwilt.image_dir)．日付ごとのサブフォルダも監視する
+        edge_id (str): デバイスID
+        camera_usb (str): カメラのUSBポート番号
+        camera_type (str): カメラの種類(HDR/RGB)
+
+    Notes:
+        "{device}_{usb}_{type}_{%Y%m%d-%H%M}.jpg"の形式のファイルが閉じられた時(IN_CLOSE_WRITE)，
+        または別の場所から移動された時(IN_MOVED_TO)に通知する．書き込み途中の画像は通知しない
+
+        新しい日付のフォルダが作成されたら，そのフォルダも監視対象に追加する．
+        追加するまでに書き込まれた画像はイベントが届かないため，追加した後にフォルダ内の画像を調べて通知する
+    """
+    def __init__(self, image_dir, edge_id, camera_usb, camera_type):
+        self.image_dir = image_dir
+        self.pattern = re.compile(rf"^{re.escape(str(edge_id))}_{re.escape(str(camera_usb))}_{re.escape(str(camera_type))}_(\d{{8}}-\d{{4}})\.jpg$")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+
+        os.makedirs(image_dir, exist_ok=True)
+        self._add_watch(image_dir, IN_CREATE | IN_MOVED_TO)
+        today = os.path.join(image_dir, datetime.now().strftime("%Y%m%d"))
+        if os.path.isdir(today):
+            self._add_watch(today, IN_CLOSE_WRITE | IN_MOVED_TO)
+
+    def _add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed: {path}")
+        self.dirs[wd] = path
+
+    def parse_time(self, file_name):
+        """
+        ファイル名から撮影時刻を返す．対象の画像でなければNone
+        """
+        match = self.pattern.match(file_name)
+        if match is None:
+            return None
+        return datetime.strptime(match.group(1), "%Y%m%d-%H%M")
+
+    def scan(self, path):
+        """
+        フォルダ内の書き込みが完了した画像を返す(監視を追加する前に書き込まれた画像)
+
+        Returns:
+            images (list): (画像のパス, 撮影時刻)のリスト
+
+        Notes:
+            JPEGの終端(FFD9)で終わっていない画像は書き込み途中とみなし，IN_CLOSE_WRITEで通知する
+        """
+        images = []
+        for file_name in sorted(os.listdir(path)):
+            capture_time = self.parse_time(file_name)
+            if capture_time is None:
+                continue
+            image_path = os.path.join(path, file_name)
+            try:
+                with open(image_path, "rb") as f:
+                    f.seek(-2, os.SEEK_END)
+                    complete = f.read(2) == b"\xff\xd9"
+            except OSError:
+                complete = False
+            if complete:
+                images.append((image_path, capture_time))
+        return images
+
+    def read(self, timeout=None):
+        """
+        書き込みが完了した画像を待つ
+
+        Args:
+            timeout (float): 待ち時間(秒)．Noneなら通知があるまで待つ
+
+        Returns:
+            images (list): (画像のパス, 撮影時刻, イベントを受け取った時刻(time.time()))のリスト．
+                タイムアウトした場合は空のリスト
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        event_time = time.time()
+        data = os.read(self.fd, 64 * 1024)
+
+        images = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0").decode()
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                print("inotify queue overflow")
+                continue
+            if mask & IN_IGNORED:
+                # 監視していたフォルダが削除された
+                self.dirs.pop(wd, None)
+                continue
+            if wd not in self.dirs:
+                continue
+            path = os.path.join(self.dirs[wd], name)
+            if self.dirs[wd] == self.image_dir:
+                # 新しい日付のフォルダ
+                if mask & IN_ISDIR and re.fullmatch(r"\d{8}", name):
+                    self._add_watch(path, IN_CLOSE_WRITE | IN_MOVED_TO)
+                    images += [(image_path, capture_time, event_time) for image_path, capture_time in self.scan(path)]
+                continue
+            capture_time = self.parse_time(name)
+            if capture_time is not None:
+                images.append((path, capture_time, event_time))
+        return images
+
+    def close(self):
+        os.close(self.fd)
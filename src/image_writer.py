@@ -0,0 +1,68 @@
+import queue
+import threading
+from pathlib import Path
+
+import cv2
+
+class ImageWriter:
+    """
+    撮影した画像を別のスレッドでファイルに書き込むクラス
+
+    Notes:
+        共有メモリでwilt_serverに画像を渡した後は，ファイルへの書き込みを撮影のスレッドで待つ必要がない．
+        write()は書き込みを依頼してすぐに戻り，書き込みは1つのスレッドで依頼された順に行う
+
+        書き込みが終わった後に呼ぶ関数(scpでの送信など)をdoneに指定できる．
+        プロセスを終了する前にflush()で書き込みが終わるまで待つ(スレッドはdaemonのため)
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def write(self, path, jpeg=None, frame=None, done=None):
+        """
+        画像の書き込みを依頼する
+
+        Args:
+            path (str): 保存するファイルのパス
+            jpeg (bytes): JPEGのバイト列(そのまま書き込む)
+            frame (ndarray): 画像(cv2.imwriteで符号化して書き込む)
+            done (function): 書き込みが終わった後に呼ぶ関数(引数なし)
+        """
+        self._start()
+        self.queue.put((str(path), jpeg, frame, done))
+
+    def _run(self):
+        while True:
+            path, jpeg, frame, done = self.queue.get()
+            try:
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                if jpeg is not None:
+                    with open(path, "wb") as f:
+                        f.write(jpeg)
+                else:
+                    cv2.imwrite(path, frame)
+                print(f"saved image : {path}")
+                if done is not None:
+                    done()
+            except Exception as e:
+                print(f"image write failed: {path}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+        依頼された書き込みが全て終わるまで待つ
+        """
+        if self.thread is not None:
+            self.queue.join()
+
+# 撮影プロセス内で共有する書き込み
+writer = ImageWriter()
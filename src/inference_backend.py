@@ -0,0 +1,490 @@
+import ast
+import os
+import threading
+import zipfile
+
+import cv2
+import numpy as np
+
+# 使用できる推論バックエンド(config.jsonのwilt.backend)
+BACKENDS = ("ultralytics", "onnx", "tflite")
+
+# 量子化したモデルの精度(config.jsonのwilt.precision)
+PRECISIONS = ("float32", "float16", "int8")
+
+def model_path(path, backend, precision="float32"):
+    """
+    ultralyticsのモデルのパスから，バックエンドと精度に対応するモデルファイルのパスを返す
+
+    Notes:
+        tfliteはultralyticsのexportの命名に従う．onnxの量子化モデルはscript/export_quantized.pyの命名に従う．
+        "{name}.pt" -> onnx: "{name}.onnx"(float32), "{name}_{precision}.onnx"
+                       tflite: "{name}_saved_model/{name}_{precision}.tflite"
+        ultralyticsでは.tfliteを精度に対応するファイルに読み替え，.ptはfloat32ならそのまま使い，
+        float16/int8ならexportしたtfliteモデル("{name}_saved_model/{name}_{precision}.tflite")に読み替える
+    """
+    stem, ext = os.path.splitext(path)
+    if ext == ".tflite":
+        # "{name}_saved_model/{name}_float32.tflite" -> "{name}"
+        stem = os.path.dirname(stem).removesuffix("_saved_model")
+    if backend == "onnx":
+        return f"{stem}.onnx" if precision == "float32" else f"{stem}_{precision}.onnx"
+    if backend == "tflite" or ext == ".tflite" or precision != "float32":
+        return os.path.join(f"{stem}_saved_model", f"{os.path.basename(stem)}_{precision}.tflite")
+    return path
+
+def letterbox(image, size, color=114):
+    """
+    アスペクト比を保ってsize x sizeにリサイズし，余白を埋める(ultralyticsのLetterBoxと同じ)
+
+    Returns:
+        (image, ratio, pad) (tuple): 変換後の画像，拡大率，左上の余白(x, y)
+    """
+    height, width = image.shape[:2]
+    ratio = min(size / height, size / width)
+    new_width, new_height = round(width * ratio), round(height * ratio)
+    if (new_width, new_height) != (width, height):
+        image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    pad_x, pad_y = (size - new_width) / 2, (size - new_height) / 2
+    if pad_x or pad_y:
+        top, bottom = round(pad_y - 0.1), round(pad_y + 0.1)
+        left, right = round(pad_x - 0.1), round(pad_x + 0.1)
+        image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(color, color, color))
+    else:
+        top = left = 0
+    return image, ratio, (left, top)
+
+def nms(boxes, scores, iou_threshold):
+    """
+    スコアの高い順にIoUがiou_thresholdを超えるbboxを除く
+
+    Returns:
+        keep (ndarray): 残したbboxのインデックス(スコアの高い順)
+    """
+    order = scores.argsort()[::-1]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        width = np.clip(np.minimum(boxes[i, 2], boxes[rest, 2]) - np.maximum(boxes[i, 0], boxes[rest, 0]), 0, None)
+        height = np.clip(np.minimum(boxes[i, 3], boxes[rest, 3]) - np.maximum(boxes[i, 1], boxes[rest, 1]), 0, None)
+        inter = width * height
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=int)
+
+def xywh2xyxy(xywh):
+    xyxy = np.empty_like(xywh)
+    xyxy[:, :2] = xywh[:, :2] - xywh[:, 2:] / 2
+    xyxy[:, 2:] = xywh[:, :2] + xywh[:, 2:] / 2
+    return xyxy
+
+class UltralyticsBackend:
+    """
+    ultralyticsのYOLOで推論するバックエンド
+
+    Args:
+        model (YOLO): ultralyticsのモデル(.pt/.onnx/.tfliteなど，YOLOで読み込めるもの)
+    """
+    def __init__(self, model):
+        self.model = model
+
+    def detect(self, image, size, conf):
+        """
+        葉のbboxを検出する
+
+        Args:
+            image (ndarray): 入力画像(BGR)
+            size (int): 推論サイズ
+            conf (float): 信頼度の閾値
+
+        Returns:
+            bboxes (ndarray): shape (N, 4) の [x1, y1, x2, y2]
+        """
+        return self.detect_batch([image], size, conf)[0]
+
+    def detect_batch(self, images, size, conf):
+        """
+        複数の画像(複数のカメラなど)の葉のbboxを1回の推論で検出する
+
+        Returns:
+            bboxes (list[ndarray]): 画像ごとのshape (N, 4) の [x1, y1, x2, y2]
+        """
+        source = images[0] if len(images) == 1 else list(images)
+        results = self.model.predict(source, imgsz=size, conf=conf, save=False, project="/tmp", verbose=False)
+        return [np.array([box.xyxy[0].tolist() for box in result.boxes], dtype=float).reshape(-1, 4) for result in results]
+
+    def keypoints(self, clips, size, conf):
+        """
+        切り出し画像ごとに最も信頼度の高い葉の付け根・先端の座標を推定する
+
+        Args:
+            clips (ndarray): shape (N, size, size, 3) の切り出し画像(BGR)
+            size (int): 推論サイズ
+            conf (float): 信頼度の閾値
+
+        Returns:
+            keypoints (ndarray): shape (N, 2, 2) の切り出し画像上の [[base_x, base_y], [tip_x, tip_y]]．推定できなかった画像はNaN
+        """
+        if len(clips) == 1:
+            source = clips[0]
+        else:
+            try:
+                # BGR(NHWC, uint8) -> RGB(NCHW, 0-1)のテンソルで渡し，ultralytics側の前処理を省略する
+                import torch
+                source = torch.from_numpy(clips).permute(0, 3, 1, 2).flip(1).float().div_(255)
+            except ImportError:
+                source = list(clips)
+        results = self.model.predict(source, imgsz=size, conf=conf, save=False, project="/tmp", verbose=False)
+
+        keypoints = np.full((len(clips), 2, 2), np.nan)
+        for k, result in enumerate(results):
+            xys = result.keypoints.xy
+            if len(xys) == 0 or len(xys[0]) < 2:
+                continue
+            keypoints[k] = xys[0][:2].cpu().numpy()
+        return keypoints
+
+class NativeBackend:
+    """
+    エクスポートしたモデルを直接推論するバックエンドの共通処理(前処理・NMS・キーポイントの取り出し)
+
+    Notes:
+        ultralyticsのpredictorを使わず，letterbox・正規化・NMSを行う．
+        モデルの出力はYOLOv8形式の (バッチ, 4 + クラス数 + キーポイント数 * 3, アンカー数) とする
+
+        サブクラスはinput_size, batch_size(Noneなら可変), nchw, normalized(座標が0-1か)を設定し，
+        run()を実装する．ultralyticsがexportしたモデルのメタデータ(names, kpt_shape)があればset_metadata()で設定する
+
+        poseモデルのクラス数はnamesの数，無ければ出力のチャンネル数からkpt_shape(既定は(2, 3))の分を引いて求める
+    """
+    input_size = None
+    batch_size = None
+    nchw = True
+    normalized = False
+    # クラス数(Noneなら出力のチャンネル数から求める)とキーポイントの形(キーポイント数, 2または3)
+    num_classes = None
+    kpt_shape = (2, 3)
+
+    def __init__(self, task, iou=0.7, max_det=300):
+        self.task = task
+        self.iou = iou
+        self.max_det = max_det
+
+    def run(self, batch):
+        raise NotImplementedError
+
+    def set_metadata(self, metadata):
+        """
+        ultralyticsのexportで埋め込まれたメタデータ(値は文字列またはPythonの値)からクラス数とキーポイントの形を設定する
+        """
+        def value(key):
+            item = metadata.get(key)
+            return ast.literal_eval(item) if isinstance(item, str) else item
+        try:
+            names = value("names")
+            kpt_shape = value("kpt_shape")
+        except (ValueError, SyntaxError) as e:
+            print("model metadata error:", e)
+            return
+        if names:
+            self.num_classes = len(names)
+        if kpt_shape:
+            self.kpt_shape = tuple(kpt_shape)
+
+    def classes(self, channels):
+        """
+        出力のチャンネル数に対するクラス数
+        """
+        if self.num_classes is not None:
+            return self.num_classes
+        if self.task == "pose":
+            return channels - 4 - self.kpt_shape[0] * self.kpt_shape[1]
+        return channels - 4
+
+    def preprocess(self, images, size):
+        """
+        BGR(NHWC, uint8)の画像をモデルの入力(RGB, 0-1, float32)に変換する
+        """
+        size = self.input_size or size
+        letterboxed = [letterbox(image, size) for image in images]
+        batch = np.stack([image for image, _, _ in letterboxed])[..., ::-1].astype(np.float32) / 255
+        if self.nchw:
+            batch = batch.transpose(0, 3, 1, 2)
+        return np.ascontiguousarray(batch), size, [(ratio, pad) for _, ratio, pad in letterboxed]
+
+    def infer(self, batch):
+        """
+        バッチサイズが固定のモデルは分割して推論する
+        """
+        if self.batch_size is None or len(batch) == self.batch_size:
+            return self.run(batch)
+        outputs = []
+        for start in range(0, len(batch), self.batch_size):
+            chunk = batch[start:start + self.batch_size]
+            if len(chunk) < self.batch_size:
+                chunk = np.concatenate([chunk, np.zeros((self.batch_size - len(chunk),) + chunk.shape[1:], chunk.dtype)])
+            outputs.append(self.run(chunk))
+        return np.concatenate(outputs)[:len(batch)]
+
+    def predictions(self, output, size):
+        """
+        1枚分の出力を (アンカー数, チャンネル数) にし，座標をピクセル単位にする
+        """
+        pred = output.T.astype(np.float32)
+        if self.normalized:
+            pred[:, :4] *= size
+            if self.task == "pose":
+                start, dims = 4 + self.classes(pred.shape[1]), self.kpt_shape[1]
+                pred[:, start::dims] *= size
+                pred[:, start + 1::dims] *= size
+        return pred
+
+    def detect(self, image, size, conf):
+        """
+        UltralyticsBackend.detectと同じ
+        """
+        return self.detect_batch([image], size, conf)[0]
+
+    def detect_batch(self, images, size, conf):
+        """
+        UltralyticsBackend.detect_batchと同じ
+        """
+        batch, size, transforms = self.preprocess(images, size)
+        outputs = self.infer(batch)
+        results = []
+        for image, output, (ratio, (pad_x, pad_y)) in zip(images, outputs, transforms):
+            pred = self.predictions(output, size)
+            class_scores = pred[:, 4:4 + self.classes(pred.shape[1])]
+            classes = class_scores.argmax(axis=1)
+            scores = class_scores[np.arange(len(pred)), classes]
+            candidates = scores > conf
+            boxes, scores, classes = xywh2xyxy(pred[candidates, :4]), scores[candidates], classes[candidates]
+            # クラスごとにNMSするため，クラス毎にbboxをずらす
+            keep = nms(boxes + classes[:, None] * 7680, scores, self.iou)[:self.max_det]
+            boxes = (boxes[keep] - [pad_x, pad_y, pad_x, pad_y]) / ratio
+            height, width = image.shape[:2]
+            results.append(np.clip(boxes, 0, [width, height, width, height]).astype(float))
+        return results
+
+    def keypoints(self, clips, size, conf):
+        """
+        UltralyticsBackend.keypointsと同じ
+
+        Notes:
+            NMSの結果の先頭は最もスコアの高い候補なので，NMSは行わずにスコア最大の候補を使う．
+            出力は (4 + クラス数 + キーポイント数 * 次元) で，スコアは全クラスの最大値とする
+
+            ultralyticsと同じく，可視度が0.5未満のキーポイントの座標は0にする
+        """
+        keypoints = np.full((len(clips), 2, 2), np.nan)
+        if len(clips) == 0:
+            return keypoints
+        batch, size, transforms = self.preprocess(clips, size)
+        outputs = self.infer(batch)
+        for k, (output, (ratio, (pad_x, pad_y))) in enumerate(zip(outputs, transforms)):
+            pred = self.predictions(output, size)
+            num_classes = self.classes(pred.shape[1])
+            scores = pred[:, 4:4 + num_classes].max(axis=1)
+            best = scores.argmax()
+            if scores[best] <= conf:
+                continue
+            kpts = pred[best, 4 + num_classes:].reshape(self.kpt_shape)[:2]
+            xys = (kpts[:, :2] - [pad_x, pad_y]) / ratio
+            if self.kpt_shape[1] == 3:
+                xys[kpts[:, 2] < 0.5] = 0
+            keypoints[k] = xys
+        return keypoints
+
+class OnnxBackend(NativeBackend):
+    """
+    ONNX Runtime(CPUExecutionProvider)で推論するバックエンド
+
+    Args:
+        path (str): onnxモデルのパス
+        task (str): "detect" または "pose"
+        threads (int): 推論のスレッド数．0ならONNX Runtimeの既定値
+    """
+    def __init__(self, path, task, threads=0):
+        super().__init__(task)
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # 動的な次元は文字列になる
+        batch_size, _, height, _ = model_input.shape
+        self.batch_size = batch_size if isinstance(batch_size, int) else None
+        self.input_size = height if isinstance(height, int) else None
+        self.dtype = np.float16 if model_input.type == "tensor(float16)" else np.float32
+        self.set_metadata(self.session.get_modelmeta().custom_metadata_map)
+
+    def run(self, batch):
+        return self.session.run(None, {self.input_name: batch.astype(self.dtype, copy=False)})[0]
+
+class TFLiteBackend(NativeBackend):
+    """
+    TensorFlow Liteで推論するバックエンド
+
+    Args:
+        path (str): tfliteモデルのパス
+        task (str): "detect" または "pose"
+        threads (int): 推論のスレッド数．0ならTensorFlow Liteの既定値
+
+    Notes:
+        tflite_runtimeが無ければtensorflowのInterpreterを使う．
+        INT8量子化モデルは入力を量子化し，出力を逆量子化する
+    """
+    nchw = False
+    # ultralyticsがexportしたtfliteモデルは0-1に正規化した座標を出力する
+    normalized = True
+
+    def __init__(self, path, task, threads=0):
+        super().__init__(task)
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite.python.interpreter import Interpreter
+        self.interpreter = Interpreter(model_path=path, num_threads=threads or None)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = int(self.input["shape"][0])
+        self.input_size = int(self.input["shape"][1])
+        # ultralyticsはメタデータをzipとしてtfliteファイルの末尾に追加する
+        try:
+            with zipfile.ZipFile(path) as model:
+                self.set_metadata(ast.literal_eval(model.read(model.namelist()[0]).decode()))
+        except (zipfile.BadZipFile, IndexError, ValueError, SyntaxError):
+            pass
+
+    def run(self, batch):
+        dtype = self.input["dtype"]
+        if dtype in (np.int8, np.uint8):
+            scale, zero_point = self.input["quantization"]
+            info = np.iinfo(dtype)
+            batch = np.clip(np.round(batch / scale + zero_point), info.min, info.max)
+        self.interpreter.set_tensor(self.input["index"], batch.astype(dtype))
+        self.interpreter.invoke()
+        output = self.interpreter.get_tensor(self.output["index"])
+        if output.dtype in (np.int8, np.uint8):
+            scale, zero_point = self.output["quantization"]
+            output = (output.astype(np.float32) - zero_point) * scale
+        # (バッチ, アンカー数, チャンネル数)で出力されるモデルもある
+        if output.shape[1] > output.shape[2]:
+            output = output.transpose(0, 2, 1)
+        return output
+
+class BatchScheduler:
+    """
+    複数のスレッド(カメラ)からの推論要求を集め，まとめて1回で推論するクラス
+
+    Args:
+        detect: detectモデルの推論バックエンド
+        pose: poseモデルの推論バックエンド
+        workers (int): 推論を要求するスレッドの数
+
+    Notes:
+        処理中の全てのスレッドが推論を要求するか処理を終える(leave())まで待ち，集まった要求を
+        モデル・推論サイズ毎に1回で推論する．推論は最後に要求したスレッドで行う
+
+        各スレッドはbackend()の推論バックエンドを通常のバックエンドと同じように使い，
+        処理を終えたら(例外の場合も)必ずleave()を呼ぶ
+    """
+    def __init__(self, detect, pose, workers):
+        self.models = {"detect": detect, "pose": pose}
+        self.workers = workers
+        self.pending = []
+        self.condition = threading.Condition()
+
+    def backend(self, task):
+        return BatchedBackend(self, task)
+
+    def leave(self):
+        """
+        スレッドの処理が終わったことを通知する(残りのスレッドの要求だけで推論する)
+        """
+        with self.condition:
+            self.workers -= 1
+            self._run_if_ready()
+
+    def submit(self, task, inputs, size, conf):
+        """
+        推論を要求し，結果を待つ
+
+        Args:
+            task (str): "detect" または "pose"
+            inputs (list): detectは画像のリスト，poseは切り出し画像
+        """
+        request = {"task": task, "inputs": inputs, "size": size, "conf": conf, "done": False}
+        with self.condition:
+            self.pending.append(request)
+            self._run_if_ready()
+            self.condition.wait_for(lambda: request["done"])
+        if "error" in request:
+            raise request["error"]
+        return request["result"]
+
+    def _run_if_ready(self):
+        if not self.pending or len(self.pending) < self.workers:
+            return
+        requests, self.pending = self.pending, []
+        groups = {}
+        for request in requests:
+            groups.setdefault((request["task"], request["size"], request["conf"]), []).append(request)
+        for (task, size, conf), group in groups.items():
+            try:
+                if task == "detect":
+                    results = self.models[task].detect_batch([image for r in group for image in r["inputs"]], size, conf)
+                else:
+                    results = self.models[task].keypoints(np.concatenate([r["inputs"] for r in group]), size, conf)
+                start = 0
+                for request in group:
+                    request["result"] = results[start:start + len(request["inputs"])]
+                    start += len(request["inputs"])
+            except Exception as e:
+                for request in group:
+                    request["error"] = e
+        for request in requests:
+            request["done"] = True
+        self.condition.notify_all()
+
+class BatchedBackend:
+    """
+    BatchScheduler経由で推論するバックエンド(UltralyticsBackendと同じ推論API)
+    """
+    def __init__(self, scheduler, task):
+        self.scheduler = scheduler
+        self.task = task
+
+    def detect(self, image, size, conf):
+        return self.scheduler.submit(self.task, [image], size, conf)[0]
+
+    def detect_batch(self, images, size, conf):
+        return self.scheduler.submit(self.task, list(images), size, conf)
+
+    def keypoints(self, clips, size, conf):
+        return self.scheduler.submit(self.task, clips, size, conf)
+
+def load_backend(path, task, backend="ultralytics", threads=0):
+    """
+    モデルを読み込み，推論バックエンドを返す
+
+    Args:
+        path (str): モデルファイルのパス
+        task (str): "detect" または "pose"
+        backend (str): "ultralytics", "onnx", "tflite"
+        threads (int): 推論のスレッド数(onnx/tfliteのみ)．0なら既定値
+    """
+    if backend == "ultralytics":
+        from ultralytics import YOLO
+        return UltralyticsBackend(YOLO(path, task=task))
+    if backend == "onnx":
+        return OnnxBackend(path, task, threads)
+    if backend == "tflite":
+        return TFLiteBackend(path, task, threads)
+    raise ValueError(f"unknown backend: {backend} (choose from {BACKENDS})")
@@ -32,6 +32,17 @@ class InfluxDBWrapper:
         point = Point(measurement).time(timestamp - pd.Timedelta(hours=9)).field(field, value)
         self.write_api.write(bucket=self.bucket, org=self.org, record=point)
 
+    def write_fields(self, measurement, timestamp, fields, tags=None):
+        """
+        複数のフィールドを1つのデータポイントとして書き込む(tagsを指定した場合はタグも付ける)
+        """
+        point = Point(measurement).time(timestamp - pd.Timedelta(hours=9))
+        for tag, value in (tags or {}).items():
+            point.tag(tag, value)
+        for field, value in fields.items():
+            point.field(field, value)
+        self.write_api.write(bucket=self.bucket, org=self.org, record=point)
+
     def write_dataframe(self, measurement, df):
         """
         DataFrameのデータを一括で書き込む
@@ -0,0 +1,150 @@
+import cProfile
+import pstats
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+CLEAR_REFS_PATH = "/proc/self/clear_refs"
+STATUS_PATH = "/proc/self/status"
+
+def reset_peak_rss():
+    """
+    プロセスのピークメモリ(VmHWM)を現在の使用量にリセットする
+
+    Returns:
+        success (bool): リセットできたかどうか(Linux 4.0未満や/procが無い環境ではFalse)
+    """
+    try:
+        with open(CLEAR_REFS_PATH, "w") as f:
+            # 5: ピークRSSのみをリセットする(ページの参照ビットなどは変更しない)
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss():
+    """
+    プロセスのピークメモリ(MB)を返す
+
+    Notes:
+        /proc/self/statusのVmHWMを読む．読めない場合はgetrusage(プロセス起動からのピーク)を使う
+    """
+    try:
+        with open(STATUS_PATH) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class StageProfiler:
+    """
+    処理段階ごとの実時間・CPU時間・ピークメモリを記録するクラス
+
+    Args:
+        memory (bool): ピークメモリを記録するかどうか
+
+    Notes:
+        CPU時間はプロセス全体(torchなどのスレッドを含む)の時間で，実時間より大きくなることがある．
+        ピークメモリは段階の開始時にVmHWMをリセットし，終了時のVmHWMをその段階のピークとする．
+        リセットできない環境ではピークメモリを記録しない
+
+        同じ段階が複数回あれば時間は合計し，ピークメモリは最大値とする
+    """
+    def __init__(self, memory=True):
+        self.wall = {}
+        self.cpu = {}
+        self.rss = {}
+        # 処理段階以外の計測値(深度キャッシュのヒットなど)
+        self.values = {}
+        self.memory = memory and reset_peak_rss()
+
+    @contextmanager
+    def stage(self, name):
+        if self.memory:
+            reset_peak_rss()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.wall[name] = self.wall.get(name, 0) + time.perf_counter() - wall_start
+            self.cpu[name] = self.cpu.get(name, 0) + time.process_time() - cpu_start
+            if self.memory:
+                self.rss[name] = max(self.rss.get(name, 0), peak_rss())
+
+    def record(self, name, value):
+        """
+        処理段階以外の計測値を記録する(fields()でそのままのフィールド名で返す)
+        """
+        self.values[name] = value
+
+    def fields(self):
+        """
+        InfluxDBに書き込むフィールド({段階}_time, {段階}_cpu, {段階}_rss と record()の値)を返す．時間は秒，メモリはMB
+        """
+        fields = dict(self.values)
+        for name in self.wall:
+            fields[f"{name}_time"] = self.wall[name]
+            fields[f"{name}_cpu"] = self.cpu[name]
+            if name in self.rss:
+                fields[f"{name}_rss"] = self.rss[name]
+        return fields
+
+class ThreadProfiles:
+    """
+    cprofile()のwith内で起動したスレッドの処理を計測するためのクラス
+
+    Notes:
+        cProfileは有効にしたスレッドの処理のみを計測するため，スレッドごとにthread()で計測し，保存時にまとめる．
+        Python 3.12以降はcProfileが全てのスレッドを計測し，同時に1つしか有効にできないため，thread()では何もしない
+    """
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def thread(self):
+        """
+        with内の処理(呼び出したスレッド)を計測する
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # 既に有効なcProfileが全てのスレッドを計測している
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.lock:
+                self.profiles.append(profile)
+
+@contextmanager
+def cprofile(path):
+    """
+    with内の処理をcProfileで計測し，pstats形式で保存する
+
+    Returns:
+        profiles (ThreadProfiles): with内で起動したスレッドを計測する場合に，スレッド内でprofiles.thread()を使う
+
+    Notes:
+        呼び出したスレッドと，profiles.thread()で計測したスレッドの処理をまとめて保存する．
+        結果は python -m pstats {path} などで確認する
+    """
+    profile = cProfile.Profile()
+    profiles = ThreadProfiles()
+    profile.enable()
+    try:
+        yield profiles
+    finally:
+        profile.disable()
+        stats = pstats.Stats(profile)
+        for thread_profile in profiles.profiles:
+            stats.add(thread_profile)
+        stats.dump_stats(path)
+        print("profile saved:", path)
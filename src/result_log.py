@@ -0,0 +1,219 @@
+import os
+import struct
+import sys
+
+import numpy as np
+import pandas as pd
+
+import util
+from track_store import TrackStore
+
+LOG_NAME = "result.log"
+CSV_NAME = "result.csv"
+
+# ファイル先頭の識別子
+MAGIC = b"PN3RLOG1"
+# レコードの先頭(種類1byte + 本体の長さ4byte)
+RECORD_HEADER = struct.Struct("<cI")
+# 列の追加(本体は列名のUTF-8)
+COLUMN = b"C"
+# 1行分の値(本体は時刻 + (列番号, 値)の組)
+ROW = b"R"
+ROW_TIME = struct.Struct("<q")
+ROW_VALUE = np.dtype([("column", "<u4"), ("value", "<f8")])
+
+class ResultLog:
+    """
+    1分毎の追跡結果を追記のみのバイナリログとして保存するクラス
+
+    Args:
+        image_dir (str): 日付ごとの画像ディレクトリ(result.logを保存する)
+        compact_records (int): 同じ時刻の行が上書きされたレコードがこの数を超えたらコンパクションする
+
+    Notes:
+        result.csvは毎分全体を読み込み・書き直していたが，ログには新しい1行(NaNでない値のみ)を追記する．
+        新しい列が初めて書き込まれた時は列の追加レコードを書き，行レコードでは列番号で参照する
+
+        同じ時刻の行が再度追記された場合は最後のレコードが有効になる．上書きされたレコードが増えたら，
+        有効な行のみのログに書き直す(コンパクション)
+
+        電源断などで末尾のレコードが途中で切れている場合は読込時に無視し，次の追記時に切り詰める
+
+        result.csvはexport_csv()で必要な時に作成する
+    """
+    def __init__(self, image_dir, compact_records=30):
+        self.path = os.path.join(image_dir, LOG_NAME)
+        self.csv_path = os.path.join(image_dir, CSV_NAME)
+        self.compact_records = compact_records
+        self.store = None
+        self.column_ids = {}
+        self.records = 0
+        self.size = 0
+
+    def load(self):
+        """
+        ログからTrackStoreを作成する．前回読み込んだ後にログが変更されていなければ保持しているものを返す
+
+        Notes:
+            ログが無くresult.csvがある場合はresult.csvから作成し，ログに変換する
+        """
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else None
+        if self.store is not None and size == self.size:
+            return self.store
+
+        if size:
+            self._read()
+        elif os.path.exists(self.csv_path):
+            self.store = TrackStore.from_frame(util.read_csv(self.csv_path))
+            self.compact()
+            # 時刻をログと同じ型(datetime)に揃える
+            self._read()
+        else:
+            self.store = TrackStore()
+            self.column_ids = {}
+            self.records = 0
+            self.size = 0
+        return self.store
+
+    def invalidate(self):
+        """
+        保持しているTrackStoreを破棄する(処理が途中で失敗し，ログと内容が一致しない場合など)
+        """
+        self.store = None
+
+    def _read(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            raise ValueError(f"{self.path} is not a result log")
+
+        columns = []
+        rows = {}
+        records = 0
+        offset = len(MAGIC)
+        while offset + RECORD_HEADER.size <= len(data):
+            kind, length = RECORD_HEADER.unpack_from(data, offset)
+            body = offset + RECORD_HEADER.size
+            if body + length > len(data):
+                # 書き込み途中で切れたレコード
+                break
+            if kind == COLUMN:
+                columns.append(data[body:body + length].decode())
+            elif kind == ROW:
+                time, = ROW_TIME.unpack_from(data, body)
+                # 同じ時刻の行は後のレコードで置き換える(時刻の順番は最初のレコードの位置)
+                rows[time] = np.frombuffer(data, ROW_VALUE, (length - ROW_TIME.size) // ROW_VALUE.itemsize, body + ROW_TIME.size)
+                records += 1
+            offset = body + length
+
+        times = list(rows)
+        values = np.full((len(columns), len(times)), np.nan)
+        for k, row in enumerate(rows.values()):
+            values[row["column"], k] = row["value"]
+        self.store = TrackStore.from_columns([pd.Timestamp(t).to_pydatetime() for t in times], dict(zip(columns, values)))
+        self.column_ids = {col: k for k, col in enumerate(columns)}
+        self.records = records
+        self.size = offset
+
+    def _row_record(self, time):
+        values = self.store.row_values(time)
+        body = np.empty(len(values), ROW_VALUE)
+        body["column"] = [self.column_ids[col] for col in values]
+        body["value"] = list(values.values())
+        payload = ROW_TIME.pack(pd.Timestamp(time).value) + body.tobytes()
+        return RECORD_HEADER.pack(ROW, len(payload)) + payload
+
+    def _column_records(self):
+        records = b""
+        for col in self.store.columns():
+            if col not in self.column_ids:
+                self.column_ids[col] = len(self.column_ids)
+                name = str(col).encode()
+                records += RECORD_HEADER.pack(COLUMN, len(name)) + name
+        return records
+
+    def append(self, time):
+        """
+        1行分の値をログに追記する
+
+        Args:
+            time (datetime): 追記する行の時刻(load()で返したTrackStoreに書き込まれていること)
+
+        Notes:
+            画像が無いなどで処理を飛ばし，timeの行が無い場合は何もしない
+        """
+        if not self.store.has_time(time):
+            return
+        if self.size == 0:
+            return self.compact()
+        records = self._column_records() + self._row_record(time)
+        with open(self.path, "r+b") as f:
+            # 途中で切れたレコードがあれば切り詰めてから追記する
+            f.truncate(self.size)
+            f.seek(self.size)
+            f.write(records)
+            f.flush()
+            os.fsync(f.fileno())
+        self.size += len(records)
+        self.records += 1
+        if self.records - len(self.store) > self.compact_records:
+            self.compact()
+
+    def compact(self):
+        """
+        有効な行のみのログに書き直す
+        """
+        self.column_ids = {}
+        records = [MAGIC, self._column_records()]
+        records += [self._row_record(time) for time in self.store.times]
+        data = b"".join(records)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.records = len(self.store)
+        self.size = len(data)
+
+    def export_csv(self, csv_path=None):
+        """
+        ログの内容をresult.csvとして保存する
+
+        Args:
+            csv_path (str): 保存先．Noneならログと同じディレクトリのresult.csv
+        """
+        store = self.load()
+        util.save_csv(store.to_frame(), csv_path or self.csv_path)
+        return csv_path or self.csv_path
+
+# 常駐プロセス(wilt_server)では読み込んだログを保持し，毎分の読込を省略する
+_logs = {}
+
+def open_log(image_dir, compact_records=30):
+    """
+    image_dirのResultLogを返す(同じプロセス内では同じインスタンスを使い回す)
+    """
+    if image_dir not in _logs:
+        # 前日以前のログは不要なので破棄する(複数のカメラの同じ日付のログは残す)
+        date = os.path.basename(os.path.normpath(image_dir))
+        for key in [key for key in _logs if os.path.basename(os.path.normpath(key)) != date]:
+            del _logs[key]
+        _logs[image_dir] = ResultLog(image_dir, compact_records)
+    return _logs[image_dir]
+
+def export_csv(image_dir):
+    """
+    image_dirにresult.logがあればresult.csvを作成する
+
+    Returns:
+        csv_path (str): 作成したresult.csvのパス．ログが無い場合はNone
+    """
+    if not os.path.exists(os.path.join(image_dir, LOG_NAME)):
+        return None
+    return ResultLog(image_dir).export_csv()
+
+if __name__ == "__main__":
+    # 実行例: python result_log.py /home/pinode3/data/image/image4/20250410
+    for image_dir in sys.argv[1:]:
+        print(export_csv(image_dir))
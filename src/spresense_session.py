@@ -0,0 +1,111 @@
+import os
+import time
+
+import serial
+
+class SpresenseSession:
+    """
+    SPRESENSEとのシリアル接続を撮影の間も開いたままにするクラス
+
+    Args:
+        port_num (str): 接続ポート番号ごとのデバイスファイルパス
+        baud_rate (int): ボーレート
+        settle (float): ポートを開いてから通信できるようになるまで待つ時間(秒)
+
+    Notes:
+        ポートを開くとSPRESENSEが再起動するため，開いた直後のみsettle秒待つ．2回目以降の撮影では開いたままのポートを使う
+
+        ping()はSPRESENSEのファームウェアを変更せずに行える軽い確認とする(デバイスファイルが同じttyを指していること，
+        ioctlで受信バッファを確認できること)．抜き差しやリセットでttyが変わった場合は開き直す
+    """
+    def __init__(self, port_num, baud_rate=115200, settle=2.0):
+        self.port_num = port_num
+        self.baud_rate = baud_rate
+        self.settle = settle
+        self.ser = None
+        # 開いたときのデバイスファイルの参照先(/dev/ttyUSB0など)
+        self.tty = None
+        self.opens = 0
+
+    def open(self):
+        """
+        ポートを開き，SPRESENSEが起動するまで待つ
+        """
+        self.close()
+        self.tty = os.path.realpath(self.port_num)
+        self.ser = serial.Serial(self.port_num, self.baud_rate, timeout=3)
+        self.opens += 1
+        time.sleep(self.settle)
+
+    def close(self):
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            except Exception as e:
+                print(e)
+        self.ser = None
+        self.tty = None
+
+    def ping(self):
+        """
+        開いているポートが使えるかどうかを確認する
+
+        Returns:
+            alive (bool): 使える場合はTrue
+        """
+        if self.ser is None or not self.ser.is_open:
+            return False
+        try:
+            if os.path.realpath(self.port_num) != self.tty:
+                return False
+            # 切断されたデバイスではioctlがOSErrorになる
+            self.ser.in_waiting
+        except (OSError, serial.SerialException):
+            return False
+        return True
+
+    def acquire(self):
+        """
+        撮影に使うシリアルを返す．閉じている，またはping()に失敗した場合は開き直す
+
+        Returns:
+            (ser, opened) (tuple): 接続しているシリアルと，今回開いたかどうか
+        """
+        opened = not self.ping()
+        if opened:
+            self.open()
+        else:
+            # 前回の撮影の残り(再送の重複など)を捨てる
+            self.ser.reset_input_buffer()
+        return self.ser, opened
+
+class SpresenseSessions:
+    """
+    接続しているSPRESENSEごとのSpresenseSessionを保持するクラス(常駐する撮影プロセスで使う)
+
+    Args:
+        baud_rate (int): ボーレート
+        settle (float): ポートを開いてから待つ時間(秒)
+    """
+    def __init__(self, baud_rate=115200, settle=2.0):
+        self.baud_rate = baud_rate
+        self.settle = settle
+        self.sessions = {}
+
+    def get(self, port_num):
+        if port_num not in self.sessions:
+            self.sessions[port_num] = SpresenseSession(port_num, self.baud_rate, self.settle)
+        return self.sessions[port_num]
+
+    def retain(self, port_nums):
+        """
+        接続されていないポートのセッションを閉じる
+        """
+        for port_num in list(self.sessions):
+            if port_num not in port_nums:
+                self.sessions.pop(port_num).close()
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+        self.sessions = {}
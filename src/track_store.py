@@ -0,0 +1,310 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+# 葉ごとに保存する値(result.csvでは"{葉ID}_{項目名}"の列になる)
+LEAF_FIELDS = [
+    "bbox_x1", "bbox_y1", "bbox_x2", "bbox_y2",
+    "bbox_center_x1", "bbox_center_y1", "center_x", "center_y",
+    "base_x", "base_y", "tip_x", "tip_y", "angle", "length",
+    "angle_diff", "sin", "center_diff", "std_center_diff", "wilt",
+]
+# 葉に依存しない値(result.csvではそのままの列名になる)
+GLOBAL_FIELDS = [
+    "re_detection", "all_leaf_num", "now_leaf_num", "final_wilt",
+    "1_top_key", "2_top_key", "3_top_key", "flow_tracking",
+]
+
+_LEAF_COLUMN = re.compile(r"^(\d+)_(" + "|".join(LEAF_FIELDS) + r")$")
+
+class TrackStore:
+    """
+    葉の追跡結果を保存するクラス．葉ごとに固定型(float64)の配列を持ち，最新値をO(1)で参照できる
+
+    Args:
+        capacity (int): 最初に確保する行数(時刻数)．足りなくなったら倍に拡張する
+
+    Notes:
+        行は時刻に対応し，全ての葉で共通の行番号を使う
+
+        葉ごとに各項目の最新の値とその行番号(最新インデックス)を保持しているため，
+        df[col].dropna().iloc[-1] に相当する参照を列の走査なしで行える
+
+        result.csvの列構成への変換はto_frame()で保存時にのみ行う
+    """
+    def __init__(self, capacity=720):
+        self.capacity = capacity
+        self.times = []
+        self._rows = {}
+        self._leaves = {}
+        self._latest = {}
+        self._latest_row = {}
+        self._written = {}
+        self._globals = np.full((capacity, len(GLOBAL_FIELDS)), np.nan)
+        self._global_written = np.zeros(len(GLOBAL_FIELDS), dtype=bool)
+        self._field_index = {field: k for k, field in enumerate(LEAF_FIELDS)}
+        self._global_index = {field: k for k, field in enumerate(GLOBAL_FIELDS)}
+        self.extra = pd.DataFrame()
+        # 萎れ指標の逐次計算の状態(image_processor.cal_wiltで作成する)
+        self.wilt_engine = None
+        # オプティカルフローで使う最新時刻の縮小画像((時刻, 画像)．image_processorで作成する)
+        self.flow_frame = None
+
+    def __len__(self):
+        return len(self.times)
+
+    def __contains__(self, leaf_id):
+        return leaf_id in self._leaves
+
+    def has_time(self, time):
+        """
+        timeの行が書き込まれているかどうか(画像が無く処理を飛ばした時刻はFalse)
+        """
+        return time in self._rows
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        result.csvの列構成のDataFrameからTrackStoreを作成する
+
+        Notes:
+            LEAF_FIELDS/GLOBAL_FIELDSに含まれない列はextraとしてそのまま保持する
+        """
+        if df.empty:
+            return cls()
+        store = cls.from_columns(list(df.index), {col: pd.to_numeric(df[col], errors="coerce").to_numpy(dtype=np.float64) for col in df.columns})
+        store.extra = df[list(store.extra.columns)]
+        return store
+
+    @classmethod
+    def from_columns(cls, times, columns):
+        """
+        時刻のリストと列名ごとの配列からTrackStoreを作成する
+
+        Args:
+            times (list): 各行の時刻
+            columns (dict): result.csvの列名と値の配列(float64，長さはtimesと同じ)
+        """
+        n = len(times)
+        store = cls(capacity=max(720, n))
+        store.times = list(times)
+        store._rows = {t: k for k, t in enumerate(store.times)}
+
+        extra = {}
+        for col, values in columns.items():
+            match = _LEAF_COLUMN.match(str(col))
+            if match:
+                leaf_id = int(match.group(1))
+                block = store._leaf_block(leaf_id)
+                f = store._field_index[match.group(2)]
+                block[:n, f] = values
+                store._written[leaf_id][f] = True
+            elif col in store._global_index:
+                g = store._global_index[col]
+                store._globals[:n, g] = values
+                store._global_written[g] = True
+            else:
+                extra[col] = values
+        if extra:
+            store.extra = pd.DataFrame(extra, index=pd.Index(store.times))
+
+        # 最新値と最新インデックスを求める
+        for leaf_id, block in store._leaves.items():
+            valid = ~np.isnan(block[:n])
+            has_value = valid.any(axis=0)
+            last_row = n - 1 - np.argmax(valid[::-1], axis=0)
+            store._latest_row[leaf_id] = np.where(has_value, last_row, -1)
+            store._latest[leaf_id] = np.where(has_value, block[last_row, np.arange(len(LEAF_FIELDS))], np.nan)
+        return store
+
+    def columns(self):
+        """
+        書き込まれている列名(result.csvの列名)のリストを返す
+        """
+        columns = [f"{leaf_id}_{field}" for leaf_id in sorted(self._leaves) for f, field in enumerate(LEAF_FIELDS) if self._written[leaf_id][f]]
+        columns += [field for g, field in enumerate(GLOBAL_FIELDS) if self._global_written[g]]
+        return columns + list(self.extra.columns)
+
+    def row_values(self, time):
+        """
+        1行分のNaNでない値を返す
+
+        Returns:
+            values (dict): result.csvの列名と値
+        """
+        row = self._rows[time]
+        values = {}
+        for leaf_id in sorted(self._leaves):
+            block = self._leaves[leaf_id]
+            for f in np.flatnonzero(self._written[leaf_id] & ~np.isnan(block[row])):
+                values[f"{leaf_id}_{LEAF_FIELDS[f]}"] = block[row, f]
+        for g in np.flatnonzero(self._global_written & ~np.isnan(self._globals[row])):
+            values[GLOBAL_FIELDS[g]] = self._globals[row, g]
+        if not self.extra.empty and time in self.extra.index:
+            for col, value in self.extra.loc[time].items():
+                value = pd.to_numeric(value, errors="coerce")
+                if not np.isnan(value):
+                    values[col] = value
+        return values
+
+    def to_frame(self):
+        """
+        result.csvと同じ列構成("{葉ID}_{項目名}"と全体の列)のDataFrameに変換する
+        """
+        n = len(self.times)
+        data = {}
+        for leaf_id in sorted(self._leaves):
+            block = self._leaves[leaf_id]
+            for f, field in enumerate(LEAF_FIELDS):
+                if self._written[leaf_id][f]:
+                    data[f"{leaf_id}_{field}"] = block[:n, f]
+        for g, field in enumerate(GLOBAL_FIELDS):
+            if self._global_written[g]:
+                data[field] = self._globals[:n, g]
+        df = pd.DataFrame(data, index=pd.Index(self.times))
+        if not self.extra.empty:
+            df = df.join(self.extra.reindex(df.index))
+        return df
+
+    def _grow(self, capacity):
+        for leaf_id, block in self._leaves.items():
+            new_block = np.full((capacity, len(LEAF_FIELDS)), np.nan)
+            new_block[:self.capacity] = block
+            self._leaves[leaf_id] = new_block
+        new_globals = np.full((capacity, len(GLOBAL_FIELDS)), np.nan)
+        new_globals[:self.capacity] = self._globals
+        self._globals = new_globals
+        self.capacity = capacity
+
+    def _leaf_block(self, leaf_id):
+        if leaf_id not in self._leaves:
+            self._leaves[leaf_id] = np.full((self.capacity, len(LEAF_FIELDS)), np.nan)
+            self._latest[leaf_id] = np.full(len(LEAF_FIELDS), np.nan)
+            self._latest_row[leaf_id] = np.full(len(LEAF_FIELDS), -1)
+            self._written[leaf_id] = np.zeros(len(LEAF_FIELDS), dtype=bool)
+        return self._leaves[leaf_id]
+
+    def row(self, time):
+        """
+        時刻に対応する行番号を返す．存在しない時刻の場合は末尾に行を追加する
+        """
+        if time not in self._rows:
+            if len(self.times) == self.capacity:
+                self._grow(self.capacity * 2)
+            self._rows[time] = len(self.times)
+            self.times.append(time)
+        return self._rows[time]
+
+    def set(self, time, leaf_id, values):
+        """
+        葉の値を書き込む
+
+        Args:
+            time (datetime): 書き込む時刻
+            leaf_id (int): 葉ID
+            values (dict): 項目名と値
+        """
+        row = self.row(time)
+        block = self._leaf_block(leaf_id)
+        for field, value in values.items():
+            f = self._field_index[field]
+            block[row, f] = value
+            self._written[leaf_id][f] = True
+            if not np.isnan(value) and row >= self._latest_row[leaf_id][f]:
+                self._latest[leaf_id][f] = value
+                self._latest_row[leaf_id][f] = row
+
+    def set_column(self, leaf_id, field, values):
+        """
+        葉の1項目の全時刻分の値をまとめて書き込む(スカラーの場合は全時刻に同じ値)
+        """
+        n = len(self.times)
+        block = self._leaf_block(leaf_id)
+        f = self._field_index[field]
+        block[:n, f] = values
+        self._written[leaf_id][f] = True
+        valid = np.flatnonzero(~np.isnan(block[:n, f]))
+        self._latest_row[leaf_id][f] = valid[-1] if len(valid) else -1
+        self._latest[leaf_id][f] = block[valid[-1], f] if len(valid) else np.nan
+
+    def set_global(self, time, field, value):
+        """
+        葉に依存しない値を書き込む
+        """
+        row = self.row(time)
+        g = self._global_index[field]
+        self._globals[row, g] = value
+        self._global_written[g] = True
+
+    def set_global_column(self, field, values):
+        """
+        葉に依存しない値の全時刻分をまとめて書き込む(スカラーの場合は全時刻に同じ値)
+        """
+        g = self._global_index[field]
+        self._globals[:len(self.times), g] = values
+        self._global_written[g] = True
+
+    def has_global(self, field):
+        return bool(self._global_written[self._global_index[field]])
+
+    def global_column(self, field):
+        """
+        葉に依存しない値の全時刻分の配列(ビュー)を返す
+        """
+        return self._globals[:len(self.times), self._global_index[field]]
+
+    def latest_global(self, field):
+        """
+        葉に依存しない値のNaNでない最新の値を返す．存在しない場合はNaN
+        """
+        column = self.global_column(field)
+        valid = np.flatnonzero(~np.isnan(column))
+        return column[valid[-1]] if len(valid) else np.nan
+
+    def column(self, leaf_id, field):
+        """
+        葉の1項目の全時刻分の配列(ビュー)を返す．NaNは値が無い時刻
+        """
+        return self._leaves[leaf_id][:len(self.times), self._field_index[field]]
+
+    def valid(self, leaf_id, field):
+        """
+        葉の1項目のNaNを除いた値の配列を返す(df[col].dropna()に相当)
+        """
+        column = self.column(leaf_id, field)
+        return column[~np.isnan(column)]
+
+    def has(self, leaf_id, field):
+        """
+        葉の項目が一度でも書き込まれているかを返す
+        """
+        return leaf_id in self._leaves and bool(self._written[leaf_id][self._field_index[field]])
+
+    def latest(self, leaf_id, field):
+        """
+        葉の項目のNaNでない最新の値を返す．存在しない場合はNaN
+        """
+        if leaf_id not in self._leaves:
+            return np.nan
+        return self._latest[leaf_id][self._field_index[field]]
+
+    def latest_bboxes(self, leaf_ids):
+        """
+        各葉の最新のbboxを返す
+
+        Returns:
+            bboxes (ndarray): shape (len(leaf_ids), 4)．bboxが存在しない葉はNaN
+        """
+        bboxes = np.full((len(leaf_ids), 4), np.nan)
+        for k, leaf_id in enumerate(leaf_ids):
+            if leaf_id in self._latest:
+                bboxes[k] = self._latest[leaf_id][:4]
+        return bboxes
+
+    def leaf_ids(self, field="bbox_x1"):
+        """
+        指定した項目が書き込まれている葉IDのリストを返す
+        """
+        f = self._field_index[field]
+        return [leaf_id for leaf_id in sorted(self._leaves) if self._written[leaf_id][f]]
@@ -1,10 +1,24 @@
 import os
 import subprocess
+import time
+
+# デバイスの名前(1-1.2など)を書き込むとUSB機器を切り離す/接続するファイル
+USB_DRIVER_DIR = '/sys/bus/usb/drivers/usb'
+# 機器を特定できない場合にリセットするハブ
+USB_HUB = '1-1'
 
 class USB:
     """
     USBからの情報取得をするためのクラス
+
+    Args:
+        dev_dir (str): デバイスファイルのフォルダ(ベンチマークでは偽の/devを指定する)
+        cpuinfo_path (str): 機種名を読むファイル
     """
+    def __init__(self, dev_dir='/dev', cpuinfo_path='/proc/cpuinfo'):
+        self.dev_dir = dev_dir
+        self.cpuinfo_path = cpuinfo_path
+
     def get(self):
         """
         USB接続されている機器の情報をリストとして一括で取得するメソッド.USB機器が複数接続されている場合は各要素は配列として取得される
@@ -46,7 +60,7 @@ class USB:
             # 4 -> USB端子 右下 に接続
         """
         usb_ports = []
-        devices = os.listdir('/dev/')
+        devices = os.listdir(self.dev_dir)
         for device in devices:
             if 'ttyUSB_' in device:
                 usb_ports.append(int(device[-1]))
@@ -68,7 +82,7 @@ class USB:
             
             シンボリックリンクの参照物のパス内にttyUSBが含まれていればSPRESENSE,入っていなければUSB Cameraの文字列を返す
         """
-        device = '/dev/ttyUSB_' + str(port)
+        device = os.path.join(self.dev_dir, 'ttyUSB_' + str(port))
         if 'ttyUSB' in os.readlink(device):
             return 'SPRESENSE'
         else:
@@ -83,7 +97,7 @@ class USB:
             SPRESENSEのデバイスファイルへのパス(str)
 
         """
-        return '/dev/ttyUSB_' + str(port)
+        return os.path.join(self.dev_dir, 'ttyUSB_' + str(port))
 
     def _get_usb_camera_name(self, port):
         """
@@ -104,11 +118,11 @@ class USB:
 
         assert port in [1, 2, 3, 4]
         try:
-            model = subprocess.check_output('sudo cat /proc/cpuinfo'.split()).decode()
+            model = subprocess.check_output(['sudo', 'cat', self.cpuinfo_path]).decode()
         except Exception as e:
             print(e)
             # model = subprocess.check_output('cat /proc/cpuinfo'.split()).decode()
-            with open("/proc/cpuinfo", "r") as f:
+            with open(self.cpuinfo_path, "r") as f:
                 model = f.read()
         device_name = ''
         if 'Raspberry Pi 3 Model B Plus' in model:
@@ -136,10 +150,53 @@ class USB:
         else:
             device_name = '0:1.' + str(port + 1) + ':1.0-video'
 
-        devices = os.listdir('/dev/v4l/by-path')
+        by_path = os.path.join(self.dev_dir, 'v4l', 'by-path')
+        devices = os.listdir(by_path)
         for device in devices:
             if device_name in device:
-                retVal = int(os.readlink('/dev/v4l/by-path/' + device)[-1])
+                retVal = int(os.readlink(os.path.join(by_path, device))[-1])
                 if retVal % 2 == 0:
                     return retVal
-        raise ValueError("unknown port")
\ No newline at end of file
+        raise ValueError("unknown port")
+
+    def get_usb_device(self, device):
+        """
+        シリアルのデバイスファイルが属するUSB機器の名前を取得
+
+        Args:
+            device (str): デバイスファイルのパス('/dev/ttyUSB_4'などのシンボリックリンクでもよい)
+
+        Returns:
+            name (str): /sys/bus/usb/devicesでのUSB機器の名前(例: '1-1.2')．特定できない場合はNone
+
+        Notes:
+            /sys/class/tty/ttyUSB0/device はUSBのインターフェース(1-1.2:1.0)の下のttyUSB0を指すため，
+            そこから親をたどって最初の':'を含まない名前をUSB機器とする
+        """
+        tty = os.path.basename(os.path.realpath(device))
+        path = os.path.realpath(f'/sys/class/tty/{tty}/device')
+        while path != '/':
+            name = os.path.basename(path)
+            if name[:1].isdigit() and '-' in name and ':' not in name:
+                return name
+            path = os.path.dirname(path)
+        return None
+
+    def reset(self, device):
+        """
+        シリアルのデバイスファイルが属するUSB機器のみを一度切り離し再び接続する
+
+        Args:
+            device (str): デバイスファイルのパス
+
+        Returns:
+            name (str): リセットしたUSB機器の名前
+
+        Notes:
+            同じハブにつながる他のカメラの撮影を妨げないよう，機器を特定できない場合のみハブ(1-1)全体をリセットする
+        """
+        name = self.get_usb_device(device) or USB_HUB
+        subprocess.call(f"sudo sh -c \"echo -n \"{name}\" > {USB_DRIVER_DIR}/unbind\"", shell=True)
+        time.sleep(1)
+        subprocess.call(f"sudo sh -c \"echo -n \"{name}\" > {USB_DRIVER_DIR}/bind\"", shell=True)
+        return name
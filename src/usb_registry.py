@@ -0,0 +1,149 @@
+import json
+import os
+import socket
+
+from usb import USB
+
+# カーネルのuevent(機器の接続・取り外し)を受け取るnetlinkのプロトコルとグループ
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP = 1
+# 撮影する機器の構成が変わりうるサブシステム
+UEVENT_SUBSYSTEMS = (b"SUBSYSTEM=usb", b"SUBSYSTEM=tty", b"SUBSYSTEM=video4linux")
+
+def open_uevent_socket():
+    """
+    カーネルのueventを受信するソケットを開く(ノンブロッキング)．開けない環境ではNone
+    """
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK, NETLINK_KOBJECT_UEVENT)
+        sock.bind((0, UEVENT_GROUP))
+        return sock
+    except (AttributeError, OSError) as e:
+        print("uevent socket is not available:", e)
+        return None
+
+def is_hotplug_event(message):
+    """
+    USB機器・シリアル・カメラの接続または取り外しのueventかどうか
+
+    Args:
+        message (bytes): "add@/devices/...\\0ACTION=add\\0SUBSYSTEM=usb\\0..." の形のuevent
+    """
+    fields = message.split(b"\0")
+    if not fields[0].startswith((b"add@", b"remove@")):
+        return False
+    return any(field in UEVENT_SUBSYSTEMS for field in fields[1:])
+
+class UsbRegistry:
+    """
+    USBポートと機器(SPRESENSE / USB Camera, デバイスファイルパス / デバイスID)の対応をキャッシュするクラス
+
+    Args:
+        cache_path (str): 対応を保存するJSONファイル．Noneなら保存しない
+        usb (USB): 対応を調べるUSB．Noneなら/devを調べる
+        watch (bool): ueventを受信して接続・取り外しを検出する(常駐する撮影プロセスで使う)
+
+    Notes:
+        USB().get()は毎回/devの一覧・シンボリックリンクの参照・機種名の取得(sudoのサブプロセス)・/dev/v4l/by-pathの一覧を行う．
+        機器の構成はほとんど変わらないため，一度調べた対応を使い回し，以下の場合のみ調べ直す
+
+            ・ueventで機器の接続・取り外しを受信した(watch=True)
+
+            ・/devの更新時刻が保存したときと異なる(デバイスファイルの追加・削除．別のプロセスで保存した対応を使う場合)
+
+            ・保存した対応のデバイスファイルが存在しない，またはinvalidate()が呼ばれた(撮影の失敗など)
+    """
+    def __init__(self, cache_path=None, usb=None, watch=False):
+        self.cache_path = cache_path
+        self.usb = usb or USB()
+        self.devices = None
+        self.dev_mtime = None
+        self.scans = 0
+        self.uevent_socket = open_uevent_socket() if watch else None
+
+    def _dev_mtime(self):
+        return os.stat(self.usb.dev_dir).st_mtime_ns
+
+    def _device_file(self, type, name):
+        """
+        対応に含まれる機器のデバイスファイル
+        """
+        if type == 'SPRESENSE':
+            return name
+        return os.path.join(self.usb.dev_dir, f'video{name}')
+
+    def _hotplugged(self):
+        """
+        前回からueventで機器の接続・取り外しを受信したかどうか(受信済みのueventは全て読み捨てる)
+        """
+        hotplugged = False
+        while self.uevent_socket is not None:
+            try:
+                message = self.uevent_socket.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                # 受信バッファが溢れた場合(ENOBUFS)はイベントを取りこぼしているため調べ直す
+                print(e)
+                hotplugged = True
+                continue
+            hotplugged = hotplugged or is_hotplug_event(message)
+        return hotplugged
+
+    def _load(self):
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+            self.devices = [tuple(device) for device in cache["devices"]]
+            self.dev_mtime = cache["dev_mtime"]
+        except (OSError, ValueError, KeyError, TypeError):
+            self.devices = None
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = self.cache_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"dev_mtime": self.dev_mtime, "devices": self.devices}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print("usb cache save failed:", e)
+
+    def _valid(self):
+        if self.devices is None:
+            return False
+        if self._dev_mtime() != self.dev_mtime:
+            return False
+        return all(os.path.exists(self._device_file(type, name)) for port, type, name in self.devices)
+
+    def invalidate(self):
+        """
+        次のget()で対応を調べ直す
+        """
+        self.devices = None
+        if self.cache_path is not None:
+            try:
+                os.remove(self.cache_path)
+            except FileNotFoundError:
+                pass
+
+    def get(self):
+        """
+        USB().get()と同じ形の対応を返す
+
+        Returns:
+            [(port, identify, name)] list (int,str,str or int): ポート番号順に整列
+        """
+        if self._hotplugged():
+            print("usb hotplug detected")
+            self.devices = None
+        if self.devices is None and self.cache_path is not None:
+            self._load()
+        if not self._valid():
+            # 調べている間の変更を取りこぼさないよう，先に更新時刻を記録する
+            self.dev_mtime = self._dev_mtime()
+            self.devices = self.usb.get()
+            self.scans += 1
+            if self.cache_path is not None:
+                self._save()
+        return list(self.devices)
@@ -21,6 +21,26 @@ def get_pinode_config(config_path="/home/pinode3/config.json"):
     else:
         raise FileNotFoundError("Config file not found")
 
+def get_wilt_cameras(wilt_config):
+    """
+    萎れ指標を計算するカメラの設定を取得
+
+    Args:
+        wilt_config (dict): config.jsonのwilt
+
+    Returns:
+        cameras (list[dict]): カメラごとの{"camera_usb", "camera_type", "image_dir"}
+
+    Notes:
+        wilt.camerasが空(または無い)場合は，wilt.camera_usb/camera_type/image_dirの1台とする
+    """
+    cameras = wilt_config.get("cameras") or [{}]
+    return [{
+        "camera_usb": camera.get("camera_usb", wilt_config["camera_usb"]),
+        "camera_type": camera.get("camera_type", wilt_config["camera_type"]),
+        "image_dir": camera.get("image_dir", wilt_config["image_dir"]),
+    } for camera in cameras]
+
 def read_csv(file_path):
     if os.path.exists(file_path) and file_path.endswith(".csv"):
         try:
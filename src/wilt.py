@@ -1,79 +1,261 @@
 import util
-from image_processor import image_processor
+import result_log
+import profiler
 from influxdb import InfluxDBWrapper
 
+import contextlib
 import os
+import socket
+import threading
 import time
 from datetime import datetime
 import json
 
-def cal_wilt():
+# wilt_server.pyと通信するソケットのパス
+SOCKET_PATH = "/tmp/pinode3_wilt.sock"
+
+def upload(edge_id, now_time, fields, tags=None):
+    """
+    萎れ指標などの値をInfluxDB(edge/server)に書き込む
+
+    Args:
+        edge_id (str): デバイスID
+        now_time (datetime): 処理対象の時刻
+        fields (dict): フィールド名と値
+        tags (dict): タグ(複数のカメラの場合はカメラのUSBポート番号)
+    """
+    try:
+        infdb = InfluxDBWrapper("influxdb_edge")
+        infdb.write_fields(edge_id, now_time, fields, tags)
+    except Exception as e:
+        print("InfluxDB(edge) Error")
+        print(e)
+    try:
+        infdb_server = InfluxDBWrapper("influxdb")
+        infdb_server.write_fields(edge_id, now_time, fields, tags)
+    except Exception as e:
+        print("InfluxDB(server) Error")
+        print(e)
+
+def run_cycle(img_pro, store):
+    """
+    その日の初回画像であったり，再検出フラグ列が1だったら初回処理，それ以外は追跡処理を行う
+    """
+    if len(store) == 0:
+        print("df is empty")
+        return img_pro.first_detection()
+    elif not store.has_global('re_detection'):
+        print("re_detection is not in df.columns")
+        return img_pro.first_detection()
+    elif store.global_column('re_detection')[-1] == 1:
+        print("re_detection is 1")
+        return img_pro.first_detection()
+    else:
+        print("tracking")
+        return img_pro.tracking()
+
+def camera_inputs(edge_id, cameras, image_path=None, image=None):
+    """
+    通知された画像のパスと共有メモリの画像をカメラごとに振り分ける
+
+    Args:
+        image_path (str or dict): 画像のパス，または{camera_usb: 画像のパス}
+        image (ndarray or dict): 共有メモリで受け取った画像，または{camera_usb: 画像}．1枚の場合はimage_pathのカメラの画像
+
+    Returns:
+        inputs (list): カメラごとの(画像のパス, 画像)．無いカメラはNone(now_timeから探す)
+    """
+    if isinstance(image_path, str):
+        name = os.path.basename(image_path)
+        camera = next((c for c in cameras if name.startswith(f"{edge_id}_{c['camera_usb']}_{c['camera_type']}_")), cameras[0])
+        image_path = {camera["camera_usb"]: image_path}
+        image = {camera["camera_usb"]: image}
+    image_path = image_path or {}
+    image = image if isinstance(image, dict) else {}
+    return [(image_path.get(c["camera_usb"]), image.get(c["camera_usb"])) for c in cameras]
+
+def process_camera(camera, now_time, result_format, image_path=None, image=None, models=None):
+    """
+    1台のカメラの1分間分の萎れ指標計算を行い，カメラの画像フォルダのresult.csv(wilt.result_formatがlogの場合はresult.log)に保存する
+
+    Returns:
+        (store, img_pro) (tuple): 追跡結果と処理したimage_processor
+    """
+    # torch/ultralyticsの読込は重いため，wilt_serverに処理を任せる場合は読み込まない
+    from image_processor import image_processor
+    from track_store import TrackStore
+
+    image_dir = os.path.join(camera["image_dir"], now_time.strftime('%Y%m%d'))
+    os.makedirs(image_dir, exist_ok=True)
+    if result_format == "csv":
+        # csv読込
+        csv_path = os.path.join(image_dir, "result.csv")
+        store = TrackStore.from_frame(util.read_csv(csv_path))
+
+        img_pro = image_processor(store, image_dir, now_time, image_path, image, camera, models)
+        store = run_cycle(img_pro, store)
+
+        # csv保存・更新
+        util.save_csv(store.to_frame(), csv_path)
+    else:
+        # ログ読込(wilt_serverでは前回の結果を保持しているため読み込まない)
+        log = result_log.open_log(image_dir)
+        store = log.load()
+        try:
+            img_pro = image_processor(store, image_dir, now_time, image_path, image, camera, models)
+            store = run_cycle(img_pro, store)
+        except Exception:
+            log.invalidate()
+            raise
+
+        # 新しい行のみを追記
+        log.append(now_time)
+    return store, img_pro
+
+def process_cameras(wilt_config, cameras, now_time, result_format, inputs, profiles=None):
+    """
+    複数のカメラをスレッドで並行して処理する
+
+    Args:
+        profiles (ThreadProfiles): cProfileで計測する場合に指定する(カメラごとのスレッドを計測する)
+
+    Returns:
+        results (list): カメラごとの(store, img_pro, 処理時間)．失敗したカメラは例外
+
+    Notes:
+        読み込んだdetect/poseモデルは全てのカメラで共有し，各カメラの推論要求はBatchSchedulerで
+        まとめて1回で推論する(first_detectionとtrackingのカメラが混在する場合もまとめる)
+        処理段階ごとの時間には他のカメラの推論を待つ時間も含まれる．ピークメモリはプロセス全体の値になる
+    """
+    import image_processor
+    import inference_backend
+
+    detect, pose = image_processor.load_configured_models(wilt_config)
+    scheduler = inference_backend.BatchScheduler(detect, pose, len(cameras))
+    models = (scheduler.backend("detect"), scheduler.backend("pose"))
+    results = [None] * len(cameras)
+
+    def worker(k):
+        start_time = time.time()
+        try:
+            with profiles.thread() if profiles is not None else contextlib.nullcontext():
+                results[k] = process_camera(cameras[k], now_time, result_format, *inputs[k], models) + (time.time() - start_time,)
+        except Exception as e:
+            results[k] = e
+        finally:
+            scheduler.leave()
+
+    threads = [threading.Thread(target=worker, args=(k,)) for k in range(len(cameras))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def cal_wilt(now_time=None, cold_start_time=None, image_path=None, capture_time=None, image=None):
+    """
+    1分間分の萎れ指標の計算を行い，result.csv(wilt.result_formatがlogの場合はresult.log)とInfluxDBに保存する
+
+    Args:
+        now_time (datetime): 処理対象の時刻．Noneなら現在時刻
+        cold_start_time (float): wilt_serverのモデル読込時間．初回のみInfluxDBに記録する
+        image_path (str or dict): 処理する画像のパス(複数のカメラの場合は{camera_usb: パス})．Noneならnow_timeから探す
+        capture_time (float): 画像の書き込みが完了した時刻(time.time())．指定した場合は萎れ指標の計算までの遅延を記録する
+        image (ndarray or dict): 共有メモリで受け取った画像．Noneなら画像ファイルを読み込む
+
+    Returns:
+        fields (dict): InfluxDBに書き込んだ値．複数のカメラの場合は{camera_usb: 値}．動作時間外の場合はNone
+
+    Notes:
+        wilt.camerasに複数のカメラがある場合は，カメラごとの画像フォルダにresult.log(result.csv)を保存し，
+        InfluxDBにはcameraタグ(USBポート番号)を付けて書き込む
+    """
     # 設定読み込み
     setting = util.get_pinode_config()
     edge_id = setting["device_id"]
     wilt_flag = setting["wilt"]["wilt_flag"]
-    source_dir = setting["wilt"]["image_dir"]
+    cameras = util.get_wilt_cameras(setting["wilt"])
+    result_format = setting["wilt"].get("result_format", "csv")
+    profile_time = setting["wilt"].get("profile_time", "")
     if wilt_flag == False:
         print("wilt_flag is 0")
         return
 
     # 撮影前準備
-    now_time = datetime.now().replace(second=0, microsecond=0)
+    if now_time is None:
+        now_time = datetime.now().replace(second=0, microsecond=0)
     start_time = datetime.strptime(setting["wilt"]["start_time"], "%H%M").time()
     end_time = datetime.strptime(setting["wilt"]["end_time"], "%H%M").time()
-    start_datetime = datetime.combine(datetime.today().date(), start_time)
-    end_datetime = datetime.combine(datetime.today().date(), end_time)
-    
-    date = now_time.strftime('%Y%m%d')
-    image_dir = os.path.join(source_dir, date)
-    os.makedirs(image_dir, exist_ok=True)
-    csv_path = os.path.join(image_dir, "result.csv")
+    start_datetime = datetime.combine(now_time.date(), start_time)
+    end_datetime = datetime.combine(now_time.date(), end_time)
 
-    if start_datetime <= now_time <= end_datetime:    
+    if start_datetime <= now_time <= end_datetime:
         # ベンチマーク用の時刻取得
         start_time = time.time()
 
-        # csv読込
-        df = util.read_csv(csv_path)
-
-        # その日の初回画像であったり，再検出フラグ列が1だったら初回処理
-        img_pro = image_processor(df, image_dir, now_time)
-
-        if df.empty:
-            print("df is empty")
-            df = img_pro.first_detection()
-        elif 're_detection' not in df.columns:
-            print("re_detection is not in df.columns")
-            df = img_pro.first_detection()
-        elif df['re_detection'].iloc[-1] == 1:
-            print("re_detection is 1")
-            df = img_pro.first_detection()
+        # profile_time("HHMM")の回のみcProfileで計測し，(1台目のカメラの)画像フォルダに保存する
+        if now_time.strftime("%H%M") == profile_time:
+            profile_dir = os.path.join(cameras[0]["image_dir"], now_time.strftime('%Y%m%d'))
+            os.makedirs(profile_dir, exist_ok=True)
+            cycle_profile = profiler.cprofile(os.path.join(profile_dir, f"profile_{now_time.strftime('%Y%m%d-%H%M')}.pstats"))
         else:
-            print("tracking")
-            df = img_pro.tracking()
+            cycle_profile = contextlib.nullcontext()
 
-        # csv保存・更新
-        util.save_csv(df, csv_path)
+        inputs = camera_inputs(edge_id, cameras, image_path, image)
+        with cycle_profile as profiles:
+            if len(cameras) == 1:
+                results = [process_camera(cameras[0], now_time, result_format, *inputs[0]) + (time.time() - start_time,)]
+            else:
+                results = process_cameras(setting["wilt"], cameras, now_time, result_format, inputs, profiles)
 
-        # 時刻を取得
-        end_time = time.time()
-        inference_time = end_time - start_time
-
-        try:
-            infdb = InfluxDBWrapper("influxdb_edge")
-            infdb.write_single_point(edge_id, now_time, "wilt", float(df['final_wilt'].iloc[-1]))
-            infdb.write_single_point(edge_id, now_time, "inference_time", inference_time)
-        except Exception as e:
-            print("InfluxDB(edge) Error")
-            print(e)
-        try:
-            infdb_server = InfluxDBWrapper("influxdb")
-            infdb_server.write_single_point(edge_id, now_time, "wilt", float(df['final_wilt'].iloc[-1]))
-            infdb_server.write_single_point(edge_id, now_time, "inference_time", inference_time)
-        except Exception as e:
-            print("InfluxDB(server) Error")
-            print(e)
+        all_fields = {}
+        for camera, result in zip(cameras, results):
+            if isinstance(result, Exception):
+                print(f"camera {camera['camera_usb']} error:", result)
+                continue
+            store, img_pro, inference_time = result
+            fields = {"wilt": float(store.global_column('final_wilt')[-1]), "inference_time": inference_time}
+            # 処理段階ごとの実時間・CPU時間・ピークメモリと，その時の葉の数
+            fields.update(img_pro.profiler.fields())
+            fields["leaf_num"] = len(img_pro.key_list)
+            if cold_start_time is not None:
+                fields["cold_start_time"] = cold_start_time
+            if capture_time is not None:
+                fields["capture_latency"] = time.time() - capture_time
+            upload(edge_id, now_time, fields, {"camera": camera["camera_usb"]} if len(cameras) > 1 else None)
+            all_fields[camera["camera_usb"]] = fields
+        if len(cameras) == 1:
+            return all_fields[cameras[0]["camera_usb"]]
+        return all_fields
     else:
         print("動作時間外：",now_time)
+
+def request_server(now_time, socket_path=SOCKET_PATH, timeout=55):
+    """
+    常駐しているwilt_serverに1分間分の処理を依頼する
+
+    Args:
+        now_time (datetime): 処理対象の時刻
+        socket_path (str): wilt_serverのUNIXソケットのパス
+        timeout (int): 応答待ちのタイムアウト(秒)
+
+    Returns:
+        response (dict): wilt_serverからの応答
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        request = {"cmd": "cycle", "now_time": now_time.isoformat()}
+        sock.sendall((json.dumps(request) + "\n").encode())
+        with sock.makefile("r") as f:
+            return json.loads(f.readline())
+
 if __name__ == "__main__":
-    cal_wilt()
\ No newline at end of file
+    setting = util.get_pinode_config()
+    now_time = datetime.now().replace(second=0, microsecond=0)
+    try:
+        print(request_server(now_time, setting["wilt"].get("socket_path", SOCKET_PATH)))
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        # wilt_serverが起動していない場合は単体で処理する
+        print("wilt_server is not running:", e)
+        cal_wilt(now_time)
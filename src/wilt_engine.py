@@ -0,0 +1,311 @@
+from collections import deque
+
+import numpy as np
+
+class LeafWiltState:
+    """
+    1枚の葉の萎れ指標を逐次計算するための状態
+
+    Args:
+        lookback (int): 基準とする何時点前の値を参照するか
+        window (int): 移動平均の窓幅
+
+    Notes:
+        直近lookback時点分の角度・中心座標と，最後に揃った移動平均の窓(window時点分)，
+        および1日分の集計値(葉の長さの合計，角度差分の平均・分散)のみを保持する
+    """
+    def __init__(self, lookback=30, window=5):
+        self.lookback = lookback
+        self.window = window
+        # 直近lookback時点分の値(行番号 % lookback の位置に保存)
+        self.ring_row = np.full(lookback, -1)
+        self.ring_angle = np.full(lookback, np.nan)
+        self.ring_center_y = np.full(lookback, np.nan)
+        # 角度と中心座標が揃っている直近の値と連続数
+        self.recent = deque(maxlen=window)
+        self.run = 0
+        self.last_valid_row = -2
+        # 最後に揃った移動平均の窓と，その最後/最初の行番号
+        self.window_values = None
+        self.window_end = -1
+        self.first_window_end = -1
+        # 1日分の集計値
+        self.length_sum = 0.0
+        self.length_n = 0
+        self.angle_n = 0
+        self.prev_angle = np.nan
+        self.diff_n = 0
+        self.diff_mean = 0.0
+        self.diff_m2 = 0.0
+
+    def update(self, row, angle, center_y, length):
+        """
+        1時点分の値を追加する．計算量はO(1)
+
+        Args:
+            row (int): 行番号(時刻の通し番号)
+            angle (float): 葉の角度．無い場合はNaN
+            center_y (float): bboxの中心y座標．無い場合はNaN
+            length (float): 葉の長さ．無い場合はNaN
+        """
+        k = row % self.lookback
+        self.ring_row[k] = row
+        self.ring_angle[k] = angle
+        self.ring_center_y[k] = center_y
+
+        if not np.isnan(length):
+            self.length_sum += length
+            self.length_n += 1
+        if not np.isnan(angle):
+            # 角度差分の平均と分散(Welford法)
+            if not np.isnan(self.prev_angle):
+                diff = angle - self.prev_angle
+                self.diff_n += 1
+                delta = diff - self.diff_mean
+                self.diff_mean += delta / self.diff_n
+                self.diff_m2 += delta * (diff - self.diff_mean)
+            self.prev_angle = angle
+            self.angle_n += 1
+
+        if np.isnan(angle) or np.isnan(center_y):
+            self.run = 0
+            return
+        self.run = self.run + 1 if self.last_valid_row == row - 1 else 1
+        self.last_valid_row = row
+        self.recent.append((angle, center_y))
+        if self.run >= self.window:
+            self.window_values = np.array(self.recent)
+            self.window_end = row
+            if self.first_window_end < 0:
+                self.first_window_end = row
+
+    def reference(self, row):
+        """
+        指定した行の角度と中心y座標を返す．直近lookback時点に無い場合はNaN
+        """
+        k = row % self.lookback
+        if row < 0 or self.ring_row[k] != row:
+            return np.nan, np.nan
+        return self.ring_angle[k], self.ring_center_y[k]
+
+    def smoothness(self):
+        """
+        角度差分の標準偏差(不偏)を返す．計算できない場合はNaN
+        """
+        if self.diff_n < 2:
+            return np.nan
+        return np.sqrt(self.diff_m2 / (self.diff_n - 1))
+
+class WiltEngine:
+    """
+    葉ごとの萎れ指標と最終的な萎れ指標(final_wilt)を1分毎に逐次計算するクラス
+
+    Args:
+        detect_size (int): 検出画像のサイズ
+        lookback (int): 基準とする何時点前の値を参照するか
+        window (int): 移動平均の窓幅
+        min_rows (int): 萎れ指標を計算し始める行数
+
+    Notes:
+        従来のcal_wilt/cal_final_wiltは毎分1日分の列を再計算していたが，
+        最新時刻の値は直近lookback時点と移動平均の窓，1日分の集計値のみから求まるため，
+        1時点の追加をO(1)で行う．結果は最新時刻の値が従来の全再計算と一致する
+
+        追跡時間は最初の移動平均の窓が揃ってからの行数とする．従来は全再計算した列の0でない値の数であり，
+        窓の値が基準時点と完全に同じ(萎れ指標がちょうど0)になった時点がある場合のみ異なる
+    """
+    def __init__(self, detect_size=1024, lookback=30, window=5, min_rows=35):
+        self.detect_size = detect_size
+        self.lookback = lookback
+        self.window = window
+        self.min_rows = min_rows
+        self.leaves = {}
+        self.rows = 0
+
+    @classmethod
+    def from_store(cls, store, rows=None, detect_size=1024):
+        """
+        TrackStoreに保存済みの行から状態を作成する
+
+        Args:
+            store (TrackStore): 追跡結果
+            rows (int): 取り込む行数．Noneなら全ての行
+        """
+        engine = cls(detect_size)
+        rows = len(store) if rows is None else rows
+        for leaf_id in store.leaf_ids():
+            engine._prime(leaf_id, store, rows)
+        engine.rows = rows
+        return engine
+
+    def _prime(self, leaf_id, store, rows):
+        """
+        1枚の葉の状態を保存済みの配列から一括で作成する
+        """
+        def column(field):
+            if store.has(leaf_id, field):
+                return store.column(leaf_id, field)[:rows]
+            return np.full(rows, np.nan)
+
+        angle = column("angle")
+        center_y = column("center_y")
+        length = column("length")
+        state = LeafWiltState(self.lookback, self.window)
+
+        valid_length = length[~np.isnan(length)]
+        state.length_sum = float(valid_length.sum())
+        state.length_n = len(valid_length)
+        valid_angle = angle[~np.isnan(angle)]
+        state.angle_n = len(valid_angle)
+        if state.angle_n:
+            state.prev_angle = valid_angle[-1]
+        diffs = np.diff(valid_angle)
+        state.diff_n = len(diffs)
+        if state.diff_n:
+            state.diff_mean = float(diffs.mean())
+            state.diff_m2 = float(((diffs - state.diff_mean) ** 2).sum())
+
+        start = max(0, rows - self.lookback)
+        for row in range(start, rows):
+            k = row % self.lookback
+            state.ring_row[k] = row
+            state.ring_angle[k] = angle[row]
+            state.ring_center_y[k] = center_y[row]
+
+        valid = ~np.isnan(angle) & ~np.isnan(center_y)
+        valid_rows = np.flatnonzero(valid)
+        if len(valid_rows):
+            state.last_valid_row = valid_rows[-1]
+            # 最後の有効な行で終わる連続数
+            breaks = np.flatnonzero(~valid[:state.last_valid_row + 1])
+            run_start = breaks[-1] + 1 if len(breaks) else 0
+            state.run = state.last_valid_row - run_start + 1
+            if state.last_valid_row != rows - 1:
+                state.run = 0
+            for row in valid_rows[-self.window:]:
+                state.recent.append((angle[row], center_y[row]))
+        if len(valid) >= self.window:
+            window_ends = np.flatnonzero(np.convolve(valid, np.ones(self.window, dtype=int), "valid") == self.window) + self.window - 1
+            if len(window_ends):
+                state.first_window_end = window_ends[0]
+                state.window_end = window_ends[-1]
+                window_rows = slice(state.window_end - self.window + 1, state.window_end + 1)
+                state.window_values = np.stack([angle[window_rows], center_y[window_rows]], axis=1)
+        self.leaves[leaf_id] = state
+
+    def update(self, row, leaf_id, angle, center_y, length):
+        """
+        1枚の葉の1時点分の値を追加する
+        """
+        if leaf_id not in self.leaves:
+            self.leaves[leaf_id] = LeafWiltState(self.lookback, self.window)
+        self.leaves[leaf_id].update(row, angle, center_y, length)
+        self.rows = max(self.rows, row + 1)
+
+    def cal_wilt(self, leaf_id, angle, center_y):
+        """
+        最新時刻の葉の萎れ指標を計算する
+
+        Args:
+            leaf_id (int): 葉ID
+            angle (float): 最新時刻の角度
+            center_y (float): 最新時刻の中心y座標
+
+        Returns:
+            values (dict): 最新時刻のangle_diff, sin, center_diff, std_center_diff, wilt．
+                萎れ指標を計算できない場合はwiltのみ0
+        """
+        state = self.leaves.get(leaf_id)
+        if self.rows < self.min_rows or state is None or state.angle_n == 0:
+            return {"wilt": 0}
+        lookback_row = self.rows - self.lookback if self.rows > self.lookback else 0
+        ref_angle, ref_center_y = state.reference(lookback_row)
+        # 30時点前が無ければ0
+        if np.isnan(ref_angle):
+            return {"wilt": 0}
+
+        def angle_diff(a):
+            if np.pi / 2 <= ref_angle <= 3 * np.pi / 2:
+                return ref_angle - a
+            return a - ref_angle
+
+        values = {"angle_diff": angle_diff(angle)}
+        values["sin"] = np.sin(values["angle_diff"]) * -1
+        if np.isnan(ref_center_y):
+            values["wilt"] = 0
+            return values
+
+        leaf_length = state.length_sum / state.length_n if state.length_n else np.nan
+        values["center_diff"] = (self.detect_size - center_y) - (self.detect_size - ref_center_y)
+        values["std_center_diff"] = values["center_diff"] / leaf_length
+
+        # 最後に揃った窓の移動平均(窓が無ければNaN)．最新時刻が欠損していても直前の値で補間される
+        if state.window_values is None:
+            values["wilt"] = np.nan
+        else:
+            window_angle, window_center_y = state.window_values.T
+            raw = np.sin(angle_diff(window_angle)) * -1 + ((self.detect_size - window_center_y) - (self.detect_size - ref_center_y)) / leaf_length
+            values["wilt"] = raw.mean()
+        return values
+
+    def tracking_time(self, leaf_id):
+        """
+        萎れ指標が計算されている時点数(移動平均の最初の窓が揃ってからの行数)を返す
+        """
+        state = self.leaves[leaf_id]
+        if state.first_window_end < 0:
+            return 0
+        return self.rows - state.first_window_end
+
+    def cal_final_wilt(self, wilts, top_n=None):
+        """
+        葉ごとの萎れ指標を追跡時間と角度変化の滑らかさで重み付けして合成する
+
+        Args:
+            wilts (dict): 葉IDと最新時刻の萎れ指標．0/NaNの葉(計算できなかった葉)は対象外
+            top_n (int): 合成に使う葉の数．Noneなら全て
+
+        Returns:
+            (final_wilt, top_keys) (tuple): 最新時刻の萎れ指標と，選ばれた葉IDのリスト(重みの大きい順)
+        """
+        if self.rows < self.min_rows:
+            return 0, []
+
+        candidates = []
+        for leaf_id, wilt in wilts.items():
+            state = self.leaves.get(leaf_id)
+            if state is None or state.angle_n == 0:
+                continue
+            # 追跡時間（wiltが0でないデータ点の数）．最新のwiltが0/NaNなら全時刻が0/NaN
+            tracking_time = self.tracking_time(leaf_id) if wilt != 0 and not np.isnan(wilt) else 0
+            if tracking_time < 10:
+                continue
+            # 角度変化の滑らかさ（差分の標準偏差の逆数）
+            if state.angle_n < 5:
+                continue
+            std_diff = state.smoothness()
+            if std_diff == 0 or np.isnan(std_diff):
+                continue
+            candidates.append((leaf_id, tracking_time, 1 / std_diff))
+
+        if len(candidates) == 0:
+            return 0, []
+
+        # tracking_time 降順、同点は smoothness 降順でソート
+        candidates.sort(key=lambda x: (x[1], x[2]), reverse=True)
+        top_keys = candidates if top_n is None else candidates[:top_n]
+
+        max_tracking = max([t for _, t, _ in top_keys])
+        max_smoothness = max([s for _, _, s in top_keys])
+        weighted_wilt = 0
+        total_weight = 0
+        for leaf_id, tracking_time, smoothness in top_keys:
+            tracking_score = tracking_time / max_tracking if max_tracking > 0 else 0
+            smooth_score = smoothness / max_smoothness if max_smoothness > 0 else 0
+            weight = (tracking_score + smooth_score) / 2
+            weighted_wilt += np.nan_to_num(wilts[leaf_id], nan=0.0) * weight
+            total_weight += weight
+
+        if total_weight == 0:
+            return 0, [key for key, _, _ in top_keys]
+        return weighted_wilt / total_weight, [key for key, _, _ in top_keys]
@@ -0,0 +1,212 @@
+import json
+import os
+import select
+import signal
+import socketserver
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import util
+import wilt
+import image_processor
+from image_watcher import ImageWatcher
+from frame_ring import FrameRing, RING_NAME
+
+class WiltServer:
+    """
+    detect/pose/depthモデルを読み込んだまま常駐し，1分毎の萎れ指標計算をUNIXソケット経由で受け付けるクラス
+
+    Notes:
+        wilt.timerから起動されたwilt.pyが{"cmd": "cycle", "now_time": "..."}の1行JSONを送信する
+
+        wilt.frame_ringが有効な場合は共有メモリのリングバッファを作成し，撮影プロセスから{"cmd": "frame", "seq": ...}で
+        通知された画像をファイルを経由せずに処理する
+
+        wilt.watch_imagesが有効な場合は画像フォルダをinotifyで監視し，画像の書き込みが完了した時点で処理する．
+        この場合wilt.timerからの要求は取りこぼし時の予備とし，watch_grace秒待っても画像が届かなければ従来通り処理する
+
+        コールドスタート(モデル読込+初回処理)と定常時の処理時間を分けて記録する
+
+        wilt.camerasに複数のカメラがある場合は，同じ時刻の全てのカメラの画像が届いてからまとめて処理する
+    """
+    def __init__(self):
+        self.config = util.get_pinode_config()
+        self.socket_path = self.config["wilt"].get("socket_path", wilt.SOCKET_PATH)
+        self.watch_images = self.config["wilt"].get("watch_images", True)
+        self.watch_grace = self.config["wilt"].get("watch_grace", 15)
+        self.cameras = util.get_wilt_cameras(self.config["wilt"])
+        # 時刻ごとに届いたカメラの画像({now_time: {camera_usb: (画像のパス, 撮影時刻, 画像)}})
+        self.arrivals = {}
+        self.arrival_lock = threading.Lock()
+        self.frame_ring = None
+        self.load_time = None
+        self.cycle_times = []
+        # 処理済みの時刻(画像の監視とwilt.timerで同じ時刻を二重に処理しないため)
+        self.processed = set()
+        self.condition = threading.Condition()
+
+    def load(self):
+        """
+        モデルを読み込み，読込時間(コールドスタート時間)を記録する
+        """
+        start_time = time.time()
+        wilt_config = self.config["wilt"]
+        image_processor.load_configured_models(wilt_config)
+        if wilt_config.get("depth_keep_loaded", True):
+            image_processor.load_depth_model(wilt_config.get("depth_encoder", "vits"), wilt_config.get("depth_mmap", True), wilt_config.get("depth_precision", "float32"))
+        self.load_time = time.time() - start_time
+        print(f"cold start (model load): {self.load_time:.2f}s")
+
+    def cycle(self, now_time, image_path=None, capture_time=None, image=None):
+        """
+        1分間分の萎れ指標計算を行う
+
+        Args:
+            now_time (datetime): 処理対象の時刻
+            image_path (dict): カメラごとの処理する画像のパス({camera_usb: パス})．Noneならnow_timeから探す
+            capture_time (float): 画像の書き込みが完了した時刻(time.time())．複数のカメラの場合は最後の画像の時刻
+            image (dict): 共有メモリで受け取ったカメラごとの画像({camera_usb: 画像})
+
+        Returns:
+            response (dict): 処理結果と処理時間
+        """
+        with self.condition:
+            if now_time in self.processed:
+                return {"status": "skip", "message": "already processed"}
+            cold_start_time = self.load_time if len(self.cycle_times) == 0 else None
+            start_time = time.time()
+            fields = wilt.cal_wilt(now_time, cold_start_time=cold_start_time, image_path=image_path, capture_time=capture_time, image=image)
+            self.processed = {t for t in self.processed if t > now_time - timedelta(hours=1)}
+            self.processed.add(now_time)
+            self.condition.notify_all()
+        elapsed = time.time() - start_time
+        if fields is None:
+            return {"status": "skip"}
+
+        self.cycle_times.append(elapsed)
+        if cold_start_time is not None:
+            print(f"cold start (load + first cycle): {cold_start_time + elapsed:.2f}s")
+        else:
+            steady = self.cycle_times[1:]
+            print(f"steady state: {elapsed:.2f}s (mean {sum(steady) / len(steady):.2f}s, n={len(steady)})")
+        if capture_time is not None:
+            print(f"capture-to-wilt latency: {time.time() - capture_time:.2f}s (since {now_time.strftime('%H:%M')}:00: {time.time() - now_time.timestamp():.2f}s)")
+        return {"status": "ok", **fields}
+
+    def cycle_frame(self, seq):
+        """
+        共有メモリで受け取った画像を処理する
+        """
+        frame = self.frame_ring.read(seq)
+        if frame is None:
+            # 読み出し前に上書きされた場合は画像ファイルから処理する
+            print(f"frame {seq} was overwritten")
+            return
+        name, capture_time, image = frame
+        now_time = datetime.strptime(os.path.splitext(name)[0].rsplit("_", 1)[-1], "%Y%m%d-%H%M")
+        camera = next((c for c in self.cameras if name.startswith(f"{self.config['device_id']}_{c['camera_usb']}_{c['camera_type']}_")), None)
+        if camera is None:
+            print(f"frame {name} is not a wilt camera")
+            return
+        image_path = os.path.join(camera["image_dir"], now_time.strftime("%Y%m%d"), name)
+        self.arrive(camera["camera_usb"], now_time, image_path, capture_time, image)
+
+    def arrive(self, camera_usb, now_time, image_path, capture_time, image=None):
+        """
+        カメラの画像が届いたことを記録し，同じ時刻の全てのカメラの画像が揃ったら処理する
+        """
+        with self.arrival_lock:
+            # 揃わなかった古い時刻(wilt.timerからの要求で処理済み)は破棄する
+            self.arrivals = {t: v for t, v in self.arrivals.items() if t > now_time - timedelta(minutes=10)}
+            arrived = self.arrivals.setdefault(now_time, {})
+            arrived[camera_usb] = (image_path, capture_time, image)
+            if len(arrived) < len(self.cameras):
+                return
+            del self.arrivals[now_time]
+        image_paths = {usb: path for usb, (path, _, _) in arrived.items()}
+        images = {usb: image for usb, (_, _, image) in arrived.items()}
+        capture_time = max(capture_time for _, capture_time, _ in arrived.values())
+        try:
+            print(self.cycle(now_time, image_paths, capture_time, images))
+        except Exception as e:
+            print(e)
+
+    def wait_image(self, now_time):
+        """
+        画像の監視でnow_timeが処理されるまで最大watch_grace秒待つ(wilt.timerからの要求時)
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: now_time in self.processed, timeout=self.watch_grace)
+
+    def watch(self):
+        """
+        カメラごとの画像フォルダを監視し，書き込みが完了した画像を順に処理する
+        """
+        watchers = {}
+        for camera in self.cameras:
+            watcher = ImageWatcher(camera["image_dir"], self.config["device_id"], camera["camera_usb"], camera["camera_type"])
+            watchers[watcher.fd] = (camera["camera_usb"], watcher)
+            print(f"watching {watcher.image_dir}")
+        while True:
+            ready, _, _ = select.select(list(watchers), [], [])
+            for fd in ready:
+                camera_usb, watcher = watchers[fd]
+                for image_path, now_time, event_time in watcher.read(0):
+                    self.arrive(camera_usb, now_time, image_path, event_time)
+
+    def serve_forever(self):
+        """
+        UNIXソケットで処理要求を待ち受ける
+        """
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline())
+                    if request.get("cmd") == "cycle":
+                        now_time = datetime.fromisoformat(request["now_time"])
+                        if server.watch_images and server.wait_image(now_time):
+                            response = {"status": "skip", "message": "already processed"}
+                        else:
+                            response = server.cycle(now_time)
+                    elif request.get("cmd") == "frame" and server.frame_ring is not None:
+                        # 撮影プロセスを待たせないよう，処理の完了を待たずに応答する
+                        threading.Thread(target=server.cycle_frame, args=(request["seq"],), daemon=True).start()
+                        response = {"status": "queued"}
+                    else:
+                        response = {"status": "error", "message": "unknown command"}
+                except Exception as e:
+                    print(e)
+                    response = {"status": "error", "message": str(e)}
+                self.wfile.write((json.dumps(response) + "\n").encode())
+
+        if self.watch_images:
+            threading.Thread(target=self.watch, daemon=True).start()
+        if self.config["wilt"].get("frame_ring", False):
+            self.frame_ring = FrameRing.create(self.config["wilt"].get("frame_ring_name", RING_NAME))
+
+        # 要求はスレッドごとに受け付けるが，萎れ指標の計算はcycle()内で1件ずつ順番に行う(同じresult.logを同時に更新しないため)
+        try:
+            with socketserver.ThreadingUnixStreamServer(self.socket_path, Handler) as unix_server:
+                print(f"wilt_server listening on {self.socket_path}")
+                unix_server.serve_forever()
+        finally:
+            if self.frame_ring is not None:
+                self.frame_ring.close()
+
+if __name__ == "__main__":
+    # systemctl stop(SIGTERM)でも共有メモリを削除してから終了する
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    wilt_server = WiltServer()
+    if not wilt_server.config["wilt"]["wilt_flag"]:
+        # 萎れ指標を計算しない端末ではモデルを読み込まずに終了する
+        print("wilt_flag is 0")
+        sys.exit(0)
+    wilt_server.load()
+    wilt_server.serve_forever()
@@ -33,6 +33,14 @@ sudo systemctl enable cpu_checker.service
 sudo systemctl start wilt.timer
 sudo systemctl enable wilt.timer
 sudo systemctl start wilt.service
+# 萎れ指標を計算する端末(wilt_flagがtrue)のみ常駐サーバを起動する
+if python3 -c 'import json, sys; sys.exit(0 if json.load(open("/home/pinode3/config.json"))["wilt"]["wilt_flag"] else 1)'; then
+    sudo systemctl enable wilt_server.service
+    sudo systemctl restart wilt_server.service
+else
+    sudo systemctl disable wilt_server.service
+    sudo systemctl stop wilt_server.service
+fi
 sudo systemctl enable daily_reboot.timer
 sudo systemctl start daily_reboot.timer
 